@@ -2,7 +2,14 @@
 Examination Middleware Application Package
 """
 
-from app.main import app
-
 __version__ = "1.0.0"
 __all__ = ["app"]
+
+
+def __getattr__(name):
+    # Import the FastAPI app on first use only, so CLI entrypoints such as
+    # app.cli.migrate don't build the whole web application
+    if name == "app":
+        from app.main import app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -7,6 +7,7 @@ from app.api.routes.upload import router as upload_router
 from app.api.routes.student import router as student_router
 from app.api.routes.admin import router as admin_router
 from app.api.routes.health import router as health_router
+from app.api.routes.extract import router as extract_router
 
 __all__ = [
     "auth_router",
@@ -14,4 +15,5 @@ __all__ = [
     "student_router",
     "admin_router",
     "health_router",
+    "extract_router",
 ]
@@ -20,10 +20,18 @@ from app.schemas import (
     AuditLogResponse,
     SystemStatsResponse,
 )
-from app.services.artifact_service import ArtifactService, SubjectMappingService, AuditService
+from app.services.artifact_service import (
+    ArtifactService,
+    SubjectMappingService,
+    AuditService,
+    invalidate_subject_mapping_cache,
+    invalidate_stats_cache,
+)
 from app.services.submission_service import SubmissionService
 from app.services.moodle_client import MoodleClient, MoodleAPIError
 from app.services.notification_service import NotificationService
+from app.services.moodle_user_cache import invalidate_cached_user
+from app.services import username_map_cache
 from app.api.routes.auth import get_current_staff
 from app.core.config import settings
 from app.core.security import generate_transaction_id
@@ -130,7 +138,7 @@ async def create_subject_mapping(
     mapping_service = SubjectMappingService(db)
     
     # Check if mapping already exists
-    existing = await mapping_service.get_mapping(mapping.subject_code)
+    existing = await mapping_service.get_mapping(mapping.subject_code, cached=False)
     if existing:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -147,6 +155,7 @@ async def create_subject_mapping(
     )
     
     await db.commit()
+    invalidate_subject_mapping_cache()
     
     return SubjectMappingResponse(
         id=new_mapping.id,
@@ -173,6 +182,8 @@ async def sync_mappings_from_config(
     mapping_service = SubjectMappingService(db)
     created = await mapping_service.sync_from_config()
     await db.commit()
+    if created:
+        invalidate_subject_mapping_cache()
     
     return {
         "message": f"Synced {created} new mappings from configuration",
@@ -303,6 +314,7 @@ async def auto_create_subject_mapping(
             existing.exam_session = exam_session
             existing.is_active = True
             await db.commit()
+            invalidate_subject_mapping_cache()
             action = "Updated"
             mapping = existing
         else:
@@ -318,6 +330,7 @@ async def auto_create_subject_mapping(
             )
             db.add(mapping)
             await db.commit()
+            invalidate_subject_mapping_cache()
             await db.refresh(mapping)
             action = "Created"
 
@@ -373,6 +386,7 @@ async def delete_subject_mapping(
     subject_code = mapping.subject_code
     await db.delete(mapping)
     await db.commit()
+    invalidate_subject_mapping_cache()
     
     return {"message": f"Mapping {subject_code} deleted"}
 
@@ -390,7 +404,7 @@ async def get_system_stats(
     Get system-wide statistics
     """
     artifact_service = ArtifactService(db)
-    stats = await artifact_service.get_stats()
+    stats = await artifact_service.get_stats(cached=False)
     
     # Count active sessions
     from app.db.models import StudentSession
@@ -588,6 +602,7 @@ async def reset_artifact_status(
     artifact.moodle_draft_item_id = None
     
     await db.commit()
+    invalidate_stats_cache()
     
     return {"message": "Artifact status reset to pending"}
 
@@ -729,6 +744,9 @@ async def edit_artifact_metadata(
         related_logs = related_logs_q.scalars().all()
         for rlog in related_logs:
             rlog.artifact_id = new_artifact.id
+        await db.flush()
+        await audit_service.refresh_report_count(artifact.id)
+        await audit_service.refresh_report_count(new_artifact.id)
 
         # Auto-resolve reports if requested
         resolve_reports = payload.get("resolve_reports", False)
@@ -785,6 +803,7 @@ async def edit_artifact_metadata(
         )
 
         await db.commit()
+        invalidate_stats_cache()
 
         msg = "Artifact replaced by new artifact with updated metadata"
         if resolved_report_ids:
@@ -843,6 +862,7 @@ async def purge_all_artifacts(
     await db.execute(delete(SubmissionQueue))
     await db.execute(delete(ExaminationArtifact))
     await db.commit()
+    invalidate_stats_cache()
 
     # Reset the auto-increment sequences
     try:
@@ -921,6 +941,7 @@ async def delete_artifact(
     # Hard-delete the artifact row
     await db.delete(artifact)
     await db.commit()
+    invalidate_stats_cache()
 
     logger.info("Hard-deleted artifact id=%s uuid=%s by staff=%s reason=%s",
                 artifact_id, artifact_uuid, current_staff.username, reason)
@@ -1279,6 +1300,8 @@ async def create_username_mapping(
     if existing:
         existing.register_number = register
         await db.commit()
+        invalidate_cached_user(username)
+        username_map_cache.invalidate()
         return {
             "message": f"Updated mapping: {username} → {register}",
             "id": existing.id,
@@ -1292,6 +1315,7 @@ async def create_username_mapping(
         )
         db.add(new_mapping)
         await db.commit()
+        username_map_cache.invalidate()
         await db.refresh(new_mapping)
         return {
             "message": f"Created mapping: {username} → {register}",
@@ -1321,9 +1345,30 @@ async def delete_username_mapping(
 
     await db.delete(mapping)
     await db.commit()
+    invalidate_cached_user(mapping.moodle_username)
+    username_map_cache.invalidate()
     return {"message": f"Deleted mapping for {mapping.moodle_username}"}
 
 
+@router.post("/breaker/hf")
+async def reset_hf_breaker(
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """Close the HF Space circuit breaker so the next extraction tries the Space again."""
+    from app.services.remote_extraction_service import hf_breaker
+    hf_breaker.reset()
+    return {"message": "HF Space circuit breaker reset", "state": hf_breaker.state}
+
+
+@router.post("/moodle-user-cache/clear")
+async def clear_moodle_user_cache(
+    current_staff: StaffUser = Depends(get_current_staff)
+):
+    """Forget cached Moodle profiles (e.g. after students change their email in Moodle)."""
+    invalidate_cached_user()
+    return {"message": "Moodle user cache cleared"}
+
+
 # ============================================
 # Artifact File Preview (for staff)
 # ============================================
@@ -224,10 +224,11 @@ async def student_login(
         # Step 3: Validate mapping between Moodle username and provided register number
         # Look up mapping table to ensure the Moodle account is allowed to claim the provided register number
         result_map = await db.execute(
-            select(StudentUsernameRegister).where(StudentUsernameRegister.moodle_username == moodle_username)
+            select(StudentUsernameRegister.register_number)
+            .where(StudentUsernameRegister.moodle_username == moodle_username)
         )
-        mapping = result_map.scalar_one_or_none()
-        if mapping is None:
+        mapped_register_number = result_map.scalar_one_or_none()
+        if mapped_register_number is None:
             # No explicit mapping found; deny login to prevent unauthorized access
             logger.warning(f"Login denied: no username->register mapping for {moodle_username}")
             raise HTTPException(
@@ -235,8 +236,8 @@ async def student_login(
                 detail="Account not mapped to a register number. Contact administration."
             )
 
-        if mapping.register_number != credentials.register_number:
-            logger.warning(f"Login denied: register mismatch for {moodle_username} (provided {credentials.register_number} expected {mapping.register_number})")
+        if mapped_register_number != credentials.register_number:
+            logger.warning(f"Login denied: register mismatch for {moodle_username} (provided {credentials.register_number} expected {mapped_register_number})")
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Register number does not match the account. Access denied."
@@ -7,7 +7,7 @@ Also provides a one-shot /scan-upload endpoint that does
 extraction + rename + artifact creation in a single call.
 """
 
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, Request, BackgroundTasks
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, Request
 from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
@@ -15,6 +15,7 @@ import logging
 
 from app.db.database import get_db
 from app.api.routes.auth import get_current_staff
+from app.services.artifact_service import invalidate_stats_cache
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -132,7 +133,6 @@ async def scan_extract_and_upload(
     file: UploadFile = File(...),
     exam_type: str = Form("CIA1"),
     request: Request = None,
-    background_tasks: BackgroundTasks = BackgroundTasks(),
     db: AsyncSession = Depends(get_db),
     current_staff = Depends(get_current_staff),
 ):
@@ -213,6 +213,7 @@ async def scan_extract_and_upload(
 
         # ---- 6. Create artifact record --------------------------------------
         from app.services.artifact_service import ArtifactService, AuditService
+        from app.services.notification_service import upload_notification_queue
         artifact_service = ArtifactService(db)
         audit_service = AuditService(db)
 
@@ -254,11 +255,10 @@ async def scan_extract_and_upload(
         )
 
         await db.commit()
+        invalidate_stats_cache()
 
         # ---- 7. Background notification ------------------------------------
-        from app.api.routes.upload import _bg_notify_student
-        background_tasks.add_task(
-            _bg_notify_student,
+        upload_notification_queue.enqueue(
             artifact_id=artifact.id,
             uploaded_by_username=current_staff.username,
             actor_ip=request.client.host if request and request.client else None,
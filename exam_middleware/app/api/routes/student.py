@@ -22,7 +22,7 @@ from app.schemas import (
     ArtifactResponse,
     WorkflowStatusEnum,
 )
-from app.services.artifact_service import ArtifactService, SubjectMappingService, AuditService
+from app.services.artifact_service import ArtifactService, SubjectMappingService, AuditService, invalidate_stats_cache
 from app.services.submission_service import SubmissionService
 from app.api.routes.auth import get_current_student_session, get_decrypted_token
 
@@ -208,7 +208,7 @@ async def get_dashboard(
             mapping = await mapping_service.get_mapping(artifact.parsed_subject_code, exam_type)
         
         # Check if we have a valid assignment mapping
-        assignment_id = await mapping_service.get_assignment_id(artifact.parsed_subject_code, exam_type) if artifact.parsed_subject_code else None
+        assignment_id = mapping.moodle_assignment_id if mapping else None
         
         pending_papers.append(StudentPendingPaper(
             artifact_uuid=str(artifact.artifact_uuid),
@@ -615,6 +615,7 @@ async def submit_paper_by_uuid(
     )
     
     await db.commit()
+    invalidate_stats_cache()
     
     if not success:
         if result and result.get("queued"):
@@ -702,6 +703,7 @@ async def submit_paper(
     )
     
     await db.commit()
+    invalidate_stats_cache()
     
     if not success:
         # Check if it was queued
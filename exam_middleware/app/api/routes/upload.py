@@ -3,14 +3,19 @@ Upload API Routes
 Handles file uploads from staff
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Request, Query, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Request, Query
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_
-from typing import List, Optional, Dict
+from sqlalchemy import select, and_, or_, literal, union_all, String
+from sqlalchemy.engine import RowMapping
+from typing import Iterator, List, Optional, Dict
 import logging
+import os
 
-from app.db.database import get_db, async_session_maker
+import orjson
+
+from app.core.config import settings
+from app.db.database import get_db
 from app.db.models import StaffUser
 from app.schemas import (
     FileUploadResponse,
@@ -18,8 +23,8 @@ from app.schemas import (
     ErrorResponse,
 )
 from app.services.file_processor import file_processor
-from app.services.artifact_service import ArtifactService, SubjectMappingService, AuditService
-from app.services.notification_service import NotificationService
+from app.services.artifact_service import ArtifactService, SubjectMappingService, AuditService, invalidate_stats_cache
+from app.services.notification_service import upload_notification_queue
 from app.api.routes.auth import get_current_staff
 from app.db.models import WorkflowStatus, ExaminationArtifact, SubjectMapping, StudentUsernameRegister
 
@@ -28,31 +33,17 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
-async def _bg_notify_student(
-    artifact_id: int,
-    uploaded_by_username: str,
-    actor_ip: Optional[str],
-) -> None:
-    """Run student notification in the background with its own DB session."""
-    try:
-        async with async_session_maker() as session:
-            from app.db.models import ExaminationArtifact
-            result = await session.execute(
-                select(ExaminationArtifact).where(ExaminationArtifact.id == artifact_id)
-            )
-            artifact = result.scalar_one_or_none()
-            if artifact:
-                notification_service = NotificationService(session)
-                await notification_service.notify_student_on_upload(
-                    artifact=artifact,
-                    uploaded_by_username=uploaded_by_username,
-                    actor_ip=actor_ip,
-                )
-                await session.commit()
-    except Exception as exc:
-        logging.getLogger(__name__).error(
-            "Background notification failed for artifact %s: %s", artifact_id, exc
-        )
+def _precheck_upload(file: UploadFile) -> Optional[str]:
+    """
+    Per-file checks on the spooled upload: size and extension.
+    Returns an error message, or None if the file may be read.
+    """
+    if file.size and file.size > settings.max_file_size_bytes:
+        return f"File too large. Max size: {settings.max_file_size_mb}MB"
+    ext = os.path.splitext(file.filename)[1].lower()
+    if ext not in settings.allowed_extensions_list:
+        return f"Invalid file type. Allowed: {settings.allowed_extensions}"
+    return None
 
 
 @router.post("/single", response_model=FileUploadResponse)
@@ -60,7 +51,6 @@ async def upload_single_file(
     file: UploadFile = File(...),
     exam_type: str = Form("CIA1"),
     request: Request = None,
-    background_tasks: BackgroundTasks = BackgroundTasks(),
     db: AsyncSession = Depends(get_db),
     current_staff: StaffUser = Depends(get_current_staff)
 ):
@@ -82,6 +72,16 @@ async def upload_single_file(
             detail="Filename is required"
         )
     
+    # Reject oversized or wrong-type uploads before loading them into memory
+    precheck_error = _precheck_upload(file)
+    if precheck_error:
+        logger.warning(f"File validation failed: {precheck_error}")
+        return FileUploadResponse(
+            success=False,
+            message=precheck_error,
+            errors=[precheck_error]
+        )
+    
     # Read file content
     content = await file.read()
     
@@ -129,6 +129,8 @@ async def upload_single_file(
             uploaded_by_staff_id=current_staff.id,
             file_content=content
         )
+        # The bytes are stored now; don't keep them for the rest of the request
+        del content
         
         # Log the upload
         await audit_service.log_action(
@@ -144,10 +146,10 @@ async def upload_single_file(
         )
         
         await db.commit()
+        invalidate_stats_cache()
 
-        # Schedule non-blocking student notification in background
-        background_tasks.add_task(
-            _bg_notify_student,
+        # Queue non-blocking student notification
+        upload_notification_queue.enqueue(
             artifact_id=artifact.id,
             uploaded_by_username=current_staff.username,
             actor_ip=request.client.host if request and request.client else None,
@@ -184,7 +186,6 @@ async def upload_bulk_files(
     files: List[UploadFile] = File(...),
     exam_type: str = Form("CIA1"),
     request: Request = None,
-    background_tasks: BackgroundTasks = BackgroundTasks(),
     db: AsyncSession = Depends(get_db),
     current_staff: StaffUser = Depends(get_current_staff)
 ):
@@ -193,9 +194,17 @@ async def upload_bulk_files(
     
     Each file should follow the pattern: REGISTER_SUBJECT.pdf
     """
+    # The request body size is capped by UploadSizeLimitMiddleware before parsing
+    if len(files) > settings.max_files_per_upload:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Too many files. Max per upload: {settings.max_files_per_upload}"
+        )
+
     results = []
     successful = 0
     failed = 0
+    uploaded_artifact_ids: List[int] = []
     
     for file in files:
         if not file.filename:
@@ -208,6 +217,17 @@ async def upload_bulk_files(
             failed += 1
             continue
         
+        precheck_error = _precheck_upload(file)
+        if precheck_error:
+            results.append(FileUploadResponse(
+                success=False,
+                filename=file.filename,
+                message=precheck_error,
+                errors=[precheck_error]
+            ))
+            failed += 1
+            continue
+        
         # Read file content
         content = await file.read()
         
@@ -235,7 +255,6 @@ async def upload_bulk_files(
                 original_filename=file.filename,
                 subfolder="pending"
             )
-            
             # Use a nested transaction (savepoint) per file
             async with db.begin_nested():
                 artifact_service = ArtifactService(db)
@@ -252,14 +271,10 @@ async def upload_bulk_files(
                     uploaded_by_staff_id=current_staff.id,
                     file_content=content
                 )
+            # Release this file's bytes before the next one is read
+            del content
 
-            # Schedule non-blocking student notification in background
-            background_tasks.add_task(
-                _bg_notify_student,
-                artifact_id=artifact.id,
-                uploaded_by_username=current_staff.username,
-                actor_ip=request.client.host if request and request.client else None,
-            )
+            uploaded_artifact_ids.append(artifact.id)
             
             results.append(FileUploadResponse(
                 success=True,
@@ -301,6 +316,16 @@ async def upload_bulk_files(
     )
     
     await db.commit()
+    invalidate_stats_cache()
+    
+    # Queue non-blocking student notifications; the queue worker batches
+    # them so they share one mail connection
+    for artifact_id in uploaded_artifact_ids:
+        upload_notification_queue.enqueue(
+            artifact_id=artifact_id,
+            uploaded_by_username=current_staff.username,
+            actor_ip=request.client.host if request and request.client else None,
+        )
     
     return BulkUploadResponse(
         total_files=len(files),
@@ -366,7 +391,7 @@ async def check_duplicates(
                 "exam_type": exam_type,
                 "exists": True,
                 "status": latest.workflow_status.value,
-                "uploaded_at": latest.uploaded_at.isoformat() if latest.uploaded_at else None,
+                "uploaded_at": latest.uploaded_at,
                 "attempt_2_locked": attempt_2_locked,
                 "max_attempt": max_attempt,
                 "can_upload_as_attempt_2": can_upload_as_attempt_2
@@ -384,7 +409,7 @@ async def check_duplicates(
                 "can_upload_as_attempt_2": False
             })
 
-    return {"results": results}
+    return ORJSONResponse(content={"results": results})
 
 
 @router.post("/validate-mappings")
@@ -402,37 +427,52 @@ async def validate_mappings(
     if not items:
         return {"results": []}
 
-    # Batch-load all active subject mappings for these codes and types
+    # Batch-load active subject mappings and student username/register
+    # mappings in a single UNION ALL round-trip, tagged by kind
     criteria = []
     for item in items:
         sc = (item.get("subject_code") or "").strip().upper()
         et = (item.get("exam_type") or "CIA1").strip().upper()
         if sc:
             criteria.append(and_(SubjectMapping.subject_code == sc, SubjectMapping.exam_type == et))
-    
-    mapped_keys = set()
+
+    reg_nos = list(set((item.get("reg_no") or "").strip() for item in items if item.get("reg_no")))
+
+    queries = []
     if criteria:
-        from sqlalchemy import or_
-        sm_result = await db.execute(
-            select(SubjectMapping.subject_code, SubjectMapping.exam_type).where(
+        queries.append(
+            select(
+                literal("subj").label("kind"),
+                SubjectMapping.subject_code.label("val"),
+                SubjectMapping.exam_type.label("exam_type"),
+            ).where(
                 and_(
                     or_(*criteria),
                     SubjectMapping.is_active == True
                 )
             )
         )
-        mapped_keys = set((row[0], row[1]) for row in sm_result.all())
-
-    # Batch-load all student username/register mappings
-    reg_nos = list(set((item.get("reg_no") or "").strip() for item in items if item.get("reg_no")))
-    mapped_registers = set()
     if reg_nos:
-        sr_result = await db.execute(
-            select(StudentUsernameRegister.register_number).where(
+        queries.append(
+            select(
+                literal("reg").label("kind"),
+                StudentUsernameRegister.register_number.label("val"),
+                literal(None, type_=String).label("exam_type"),
+            ).where(
                 StudentUsernameRegister.register_number.in_(reg_nos)
             )
         )
-        mapped_registers = set(row[0] for row in sr_result.all())
+
+    mapped_keys = set()
+    mapped_registers = set()
+    if queries:
+        stmt = queries[0] if len(queries) == 1 else union_all(*queries)
+        rows = (await db.execute(stmt)).all()
+        for kind, val, et in rows:
+            if kind == "subj":
+                mapped_keys.add((val, et))
+            else:
+                mapped_registers.add(val)
 
     results = []
     for item in items:
@@ -451,7 +491,38 @@ async def validate_mappings(
             "student_mapped": reg_no in mapped_registers
         })
 
-    return {"results": results}
+    return ORJSONResponse(content={"results": results})
+
+
+def _stream_artifact_list(
+    artifacts: List[RowMapping],
+    total: int,
+    limit: int,
+    offset: int,
+) -> Iterator[bytes]:
+    """
+    Yield the artifact list as a JSON document, one row at a time, so the
+    serialized page is never held in memory as a whole.
+    """
+    yield b'{"total":%d,"limit":%d,"offset":%d,"artifacts":[' % (total, limit, offset)
+    first = True
+    for a in artifacts:
+        row = orjson.dumps({
+            "artifact_uuid": a["artifact_uuid"],
+            "filename": a["original_filename"],
+            "register_number": a["parsed_reg_no"],
+            "subject_code": a["parsed_subject_code"],
+            "exam_type": a["exam_type"] or 'CIA1',
+            "attempt_number": a["attempt_number"] or 1,
+            "attempt_2_locked": a["attempt_2_locked"],
+            # WorkflowStatus is a str enum; orjson emits its value directly
+            "status": a["workflow_status"],
+            "uploaded_at": a["uploaded_at"],
+            "report_count": a["report_count_active"] or 0
+        })
+        yield row if first else b"," + row
+        first = False
+    yield b"]}"
 
 
 @router.get("/all")
@@ -466,35 +537,12 @@ async def get_all_uploads(
     Deleted artifacts are hard-deleted and won't appear here.
     """
     artifact_service = ArtifactService(db)
-    artifacts, total = await artifact_service.get_all_artifacts(limit=limit, offset=offset)
-    audit_service = AuditService(db)
-
-    artifacts_list = []
-    for a in artifacts:
-        logs = await audit_service.get_for_artifact(a.id)
-        deleted_targets = {str(l.target_id) for l in logs if l.action == 'report_deleted'}
-        resolved_targets = {str(l.target_id) for l in logs if l.action == 'report_resolved'}
-        # Count only ACTIVE reports (not withdrawn, not resolved)
-        report_count = sum(1 for l in logs if l.action == 'report_issue' and str(l.id) not in deleted_targets and str(l.id) not in resolved_targets)
-        artifacts_list.append({
-            "artifact_uuid": str(a.artifact_uuid),
-            "filename": a.original_filename,
-            "register_number": a.parsed_reg_no,
-            "subject_code": a.parsed_subject_code,
-            "exam_type": getattr(a, 'exam_type', 'CIA1') or 'CIA1',
-            "attempt_number": getattr(a, 'attempt_number', 1) or 1,
-            "attempt_2_locked": getattr(a, 'attempt_2_locked', True),
-            "status": a.workflow_status.value,
-            "uploaded_at": a.uploaded_at.isoformat() if a.uploaded_at else None,
-            "report_count": report_count
-        })
+    artifacts, total = await artifact_service.list_artifact_rows(limit=limit, offset=offset)
 
-    return {
-        "total": total,
-        "limit": limit,
-        "offset": offset,
-        "artifacts": artifacts_list
-    }
+    return StreamingResponse(
+        _stream_artifact_list(artifacts, total, limit, offset),
+        media_type="application/json",
+    )
 
 
 @router.get("/pending")
@@ -508,35 +556,12 @@ async def get_pending_uploads(
     Get list of pending uploads (staff view)
     """
     artifact_service = ArtifactService(db)
-    artifacts, total = await artifact_service.get_all_pending(limit=limit, offset=offset)
-    audit_service = AuditService(db)
-    
-    artifacts_list = []
-    for a in artifacts:
-        logs = await audit_service.get_for_artifact(a.id)
-        deleted_targets = {str(l.target_id) for l in logs if l.action == 'report_deleted'}
-        resolved_targets = {str(l.target_id) for l in logs if l.action == 'report_resolved'}
-        # Count only ACTIVE reports (not withdrawn, not resolved)
-        report_count = sum(1 for l in logs if l.action == 'report_issue' and str(l.id) not in deleted_targets and str(l.id) not in resolved_targets)
-        artifacts_list.append({
-            "artifact_uuid": str(a.artifact_uuid),
-            "filename": a.original_filename,
-            "register_number": a.parsed_reg_no,
-            "subject_code": a.parsed_subject_code,
-            "exam_type": getattr(a, 'exam_type', 'CIA1') or 'CIA1',
-            "attempt_number": getattr(a, 'attempt_number', 1) or 1,
-            "attempt_2_locked": getattr(a, 'attempt_2_locked', True),
-            "status": a.workflow_status.value,
-            "uploaded_at": a.uploaded_at.isoformat() if a.uploaded_at else None,
-            "report_count": report_count
-        })
+    artifacts, total = await artifact_service.list_pending_rows(limit=limit, offset=offset)
 
-    return {
-        "total": total,
-        "limit": limit,
-        "offset": offset,
-        "artifacts": artifacts_list
-    }
+    return StreamingResponse(
+        _stream_artifact_list(artifacts, total, limit, offset),
+        media_type="application/json",
+    )
 
 
 @router.get("/auto-processed")
@@ -0,0 +1,214 @@
+"""
+Database migration entrypoint
+
+Brings the database schema up to date. Run once per deploy, before the web
+workers start:
+
+    python -m app.cli.migrate
+
+The app lifespan only checks the recorded schema version and falls back to
+running these migrations itself when the database is behind.
+"""
+
+import asyncio
+import logging
+from typing import Optional
+
+from sqlalchemy import text
+
+from app.db.database import engine, Base
+import app.db.models  # noqa: F401  (register tables on Base.metadata)
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for pg_advisory_xact_lock so concurrent starters migrate one at a time
+MIGRATION_LOCK_KEY = 724_311_001
+
+# Bump when a migration step is added
+CURRENT_SCHEMA_VERSION = 1
+
+# Recomputes examination_artifacts.report_count_active from audit_logs
+REPORT_COUNT_BACKFILL_SQL = """
+UPDATE examination_artifacts a SET report_count_active = (
+    SELECT COUNT(*) FROM audit_logs i
+    WHERE i.artifact_id = a.id
+      AND i.action = 'report_issue'
+      AND NOT EXISTS (
+          SELECT 1 FROM audit_logs c
+          WHERE c.action IN ('report_deleted', 'report_resolved')
+            AND c.target_id = i.id::text
+      )
+)
+"""
+
+
+async def apply_migrations(conn) -> None:
+    """
+    Apply the transactional schema steps (columns, constraints).
+    Every step is guarded, so re-running it against a migrated schema is a no-op.
+    """
+    # Introspect existing columns/constraints once, then branch locally
+    res = await conn.execute(text(
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = 'public' "
+        "AND table_name IN ('examination_artifacts', 'subject_mappings')"
+    ))
+    cols = {(row.table_name, row.column_name) for row in res}
+    res = await conn.execute(
+        text("SELECT conname FROM pg_constraint WHERE conname = ANY(:names)"),
+        {"names": ["uq_subject_exam_type", "uq_paper_submission"]},
+    )
+    constraints = {row[0] for row in res}
+
+    # 1. Handle examination_artifacts table
+    # Collect missing columns and add them in one ALTER (one lock, one table rewrite)
+    artifact_columns = [
+        ("file_content", "ADD COLUMN file_content BYTEA"),
+        ("exam_type", "ADD COLUMN exam_type VARCHAR(10) NOT NULL DEFAULT 'CIA1'"),
+        ("attempt_number", "ADD COLUMN attempt_number INTEGER NOT NULL DEFAULT 1"),
+        ("attempt_2_locked", "ADD COLUMN attempt_2_locked BOOLEAN NOT NULL DEFAULT TRUE"),
+        ("auto_processed", "ADD COLUMN auto_processed BOOLEAN NOT NULL DEFAULT FALSE"),
+        # Denormalized active report count
+        ("report_count_active", "ADD COLUMN report_count_active INTEGER NOT NULL DEFAULT 0"),
+    ]
+    missing = [(name, clause) for name, clause in artifact_columns
+               if ('examination_artifacts', name) not in cols]
+    if missing:
+        logger.info(f"Adding {', '.join(name for name, _ in missing)} to examination_artifacts...")
+        await conn.execute(text(
+            f"ALTER TABLE examination_artifacts {', '.join(clause for _, clause in missing)}"
+        ))
+        missing_names = {name for name, _ in missing}
+        if "auto_processed" in missing_names:
+            # Create index for fast filtering
+            await conn.execute(text("CREATE INDEX IF NOT EXISTS idx_examination_artifacts_auto_processed ON examination_artifacts(auto_processed) WHERE auto_processed = true"))
+        if "report_count_active" in missing_names:
+            # Backfill from existing report audit logs
+            await conn.execute(text(REPORT_COUNT_BACKFILL_SQL))
+
+    # Migrate FK constraints to CASCADE on delete (for hard-delete support)
+    try:
+        # audit_logs.artifact_id FK
+        await conn.execute(text("ALTER TABLE audit_logs DROP CONSTRAINT IF EXISTS audit_logs_artifact_id_fkey"))
+        await conn.execute(text("ALTER TABLE audit_logs ADD CONSTRAINT audit_logs_artifact_id_fkey FOREIGN KEY (artifact_id) REFERENCES examination_artifacts(id) ON DELETE CASCADE"))
+        # submission_queue.artifact_id FK
+        await conn.execute(text("ALTER TABLE submission_queue DROP CONSTRAINT IF EXISTS submission_queue_artifact_id_fkey"))
+        await conn.execute(text("ALTER TABLE submission_queue ADD CONSTRAINT submission_queue_artifact_id_fkey FOREIGN KEY (artifact_id) REFERENCES examination_artifacts(id) ON DELETE CASCADE"))
+        logger.info("FK constraints updated to CASCADE on delete")
+    except Exception as fke:
+        logger.debug(f"FK CASCADE migration skipped or already done: {fke}")
+
+    # 2. Handle subject_mappings table
+    # Check for exam_type
+    if ('subject_mappings', 'exam_type') not in cols:
+        logger.info("Adding exam_type to subject_mappings...")
+        await conn.execute(text("ALTER TABLE subject_mappings ADD COLUMN exam_type VARCHAR(10) NOT NULL DEFAULT 'CIA1'"))
+
+    # 3. Update Constraints
+    # Drop old subject_mappings unique constraints/indices if they exist
+    try:
+        # SQLAlchemy often creates an index named ix_subject_mappings_subject_code
+        await conn.execute(text("DROP INDEX IF EXISTS ix_subject_mappings_subject_code"))
+        await conn.execute(text("ALTER TABLE subject_mappings DROP CONSTRAINT IF EXISTS subject_mappings_subject_code_key"))
+        await conn.execute(text("ALTER TABLE subject_mappings DROP CONSTRAINT IF EXISTS uq_subject_code"))
+        
+        # Add new one if not exists
+        # Check if uq_subject_exam_type already exists to avoid redundant errors
+        if 'uq_subject_exam_type' not in constraints:
+            await conn.execute(text("ALTER TABLE subject_mappings ADD CONSTRAINT uq_subject_exam_type UNIQUE (subject_code, exam_type)"))
+    except Exception as ce:
+        logger.debug(f"Constraint update (subject_mappings) skipped or already done: {ce}")
+
+    # Drop old examination_artifacts unique constraints/indices
+    try:
+        await conn.execute(text("DROP INDEX IF EXISTS ix_examination_artifacts_parsed_reg_no"))
+        await conn.execute(text("DROP INDEX IF EXISTS ix_examination_artifacts_parsed_subject_code"))
+        await conn.execute(text("ALTER TABLE examination_artifacts DROP CONSTRAINT IF EXISTS examination_artifacts_parsed_reg_no_parsed_subject_code_key"))
+        await conn.execute(text("ALTER TABLE examination_artifacts DROP CONSTRAINT IF EXISTS uq_paper_submission"))
+        constraints.discard('uq_paper_submission')
+        
+        # Add new one if not exists
+        if 'uq_paper_submission' not in constraints:
+            await conn.execute(text("ALTER TABLE examination_artifacts ADD CONSTRAINT uq_paper_submission UNIQUE (parsed_reg_no, parsed_subject_code, exam_type, attempt_number)"))
+    except Exception as ce:
+        logger.debug(f"Constraint update (artifacts) skipped or already done: {ce}")
+
+
+async def add_enum_values() -> None:
+    """
+    Add new workflowstatus labels. ALTER TYPE ... ADD VALUE must not run inside
+    a transaction block, so this uses its own AUTOCOMMIT connection.
+    """
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("ALTER TYPE workflowstatus ADD VALUE IF NOT EXISTS 'SUPERSEDED'"))
+
+
+async def record_schema_version(conn) -> None:
+    """Record the version so later startups can skip the migration probes"""
+    await conn.execute(
+        text(
+            "INSERT INTO system_config (key, value, value_type, description) "
+            "VALUES ('schema_version', :version, 'int', 'Auto-migration schema version') "
+            "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()"
+        ),
+        {"version": str(CURRENT_SCHEMA_VERSION)},
+    )
+
+
+async def get_schema_version(conn) -> Optional[int]:
+    """Return the recorded schema version, or None if not recorded yet"""
+    res = await conn.execute(
+        text("SELECT value FROM system_config WHERE key = 'schema_version'")
+    )
+    row = res.fetchone()
+    if row and row[0] and row[0].isdigit():
+        return int(row[0])
+    return None
+
+
+async def schema_is_current() -> bool:
+    """Single-query check used by the app lifespan"""
+    try:
+        async with engine.connect() as conn:
+            version = await get_schema_version(conn)
+    except Exception:
+        # system_config missing -> fresh database
+        return False
+    return version is not None and version >= CURRENT_SCHEMA_VERSION
+
+
+async def run_migrations() -> None:
+    """Create missing tables and apply pending migrations"""
+    async with engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        await conn.run_sync(Base.metadata.create_all)
+
+        # Another process may have finished while we waited for the lock
+        version = await get_schema_version(conn)
+        if version is not None and version >= CURRENT_SCHEMA_VERSION:
+            logger.info(f"Schema at version {version}, nothing to migrate")
+            return
+
+        await apply_migrations(conn)
+
+    await add_enum_values()
+
+    async with engine.begin() as conn:
+        await record_schema_version(conn)
+    logger.info(f"Schema migrated to version {CURRENT_SCHEMA_VERSION}")
+
+
+async def _main() -> None:
+    try:
+        await run_migrations()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    asyncio.run(_main())
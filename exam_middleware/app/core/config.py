@@ -20,6 +20,8 @@ class Settings(BaseSettings):
     secret_key: str = Field(default="change-this-secret-key")
     algorithm: str = Field(default="HS256")
     access_token_expire_minutes: int = Field(default=60)
+    # Re-check (and reset if needed) the default admin password on startup
+    reset_admin_password: bool = Field(default=False)
     
     # Server
     host: str = Field(default="0.0.0.0")
@@ -33,6 +35,8 @@ class Settings(BaseSettings):
     postgres_password: str = Field(default="")
     postgres_db: str = Field(default="exam_middleware")
     database_url: Optional[str] = None
+    db_pool_size: int = Field(default=5)
+    db_max_overflow: int = Field(default=5)
     
     # Redis
     redis_host: str = Field(default="localhost")
@@ -68,12 +72,18 @@ class Settings(BaseSettings):
     # File Storage
     upload_dir: str = Field(default="./uploads")
     max_file_size_mb: int = Field(default=50)
+    max_files_per_upload: int = Field(default=100)  # Files accepted in one /upload/bulk request
     allowed_extensions: str = Field(default=".pdf,.jpg,.jpeg,.png")
     
     # ML Service - HuggingFace Spaces for extraction
     hf_space_url: str = Field(default="https://kavinraja-ml-service.hf.space")
     ml_service_url: str = Field(default="http://localhost:8501")  # Local fallback
     ml_service_enabled: bool = Field(default=False)
+    # Load the local extraction models at startup even when the HF Space is
+    # configured (they are only a fallback then); always loaded when it isn't
+    warm_extractor_on_startup: bool = Field(default=True)
+    # Reuse extraction results for byte-identical uploads (content-hash cache)
+    extraction_cache_enabled: bool = Field(default=False)
     
     # Logging
     log_level: str = Field(default="INFO")
@@ -4,7 +4,6 @@ SQLAlchemy Database Configuration and Session Management
 
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.pool import NullPool
 from typing import AsyncGenerator
 import logging
 
@@ -13,10 +12,18 @@ from app.core.config import settings
 logger = logging.getLogger(__name__)
 
 # Create async engine
+# Pooled connections keep asyncpg's per-connection prepared statement cache
+# warm across requests (with NullPool every session re-parsed and re-planned
+# its statements on a fresh connection). pre_ping/recycle guard against
+# connections dropped by the server.
 engine = create_async_engine(
     settings.database_url_computed,
     echo=settings.debug,
-    poolclass=NullPool,  # Disable pooling for async
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    connect_args={"prepared_statement_cache_size": 256},
     future=True,
 )
 
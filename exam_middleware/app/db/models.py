@@ -83,6 +83,10 @@ class ExaminationArtifact(Base):
     # Auto-Processing Tracking
     auto_processed = Column(Boolean, nullable=False, default=False, server_default="false")  # Set to True if extracted and renamed via ML
     
+    # Denormalized count of ACTIVE student reports (not withdrawn, not resolved),
+    # kept in sync by AuditService so list views never scan audit_logs
+    report_count_active = Column(Integer, nullable=False, default=0, server_default="0")
+    
     # Moodle Submission Tracking
     moodle_draft_item_id = Column(BigInteger, nullable=True)  # For retry logic
     moodle_submission_id = Column(String(100), nullable=True)
@@ -5,26 +5,39 @@ This is the main entry point for the FastAPI application that bridges
 scanned examination papers with Moodle LMS for student submissions.
 """
 
+import asyncio
+import atexit
 import logging
 import os
+import queue
 from contextlib import asynccontextmanager
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 
+import structlog
 from fastapi import FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-
+from starlette.datastructures import Headers
 from app.core.config import settings
-from app.db.database import engine, Base
+from app.db.database import engine
+from app.cli.migrate import schema_is_current, run_migrations
+from app.services.notification_service import upload_notification_queue
+from app.services.artifact_service import audit_log_batcher
+from app.services.mail_service import mail_service
+from app.services.moodle_client import moodle_client
+from app.services.remote_extraction_service import close_hf_client, get_extractor_mode, warm_local_extractor
 from app.api.routes import (
     auth_router,
     upload_router,
     student_router,
     admin_router,
     health_router,
+    extract_router,
 )
 
 # Configure logging - use stdout only in production (Render)
@@ -37,17 +50,45 @@ if not _is_production:
     except Exception:
         pass  # Skip file logging if not writable
 
+# Handlers run on a QueueListener thread, so formatting and stream/file I/O
+# stay off the event loop; request code only enqueues the record
+_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+for _handler in _handlers:
+    _handler.setFormatter(_formatter)
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, *_handlers, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+_queue_handler = QueueHandler(_log_queue)
+# Only merge msg % args here; the listener's handlers apply the full format
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
 logging.basicConfig(
     level=logging.DEBUG if not _is_production else logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=_handlers,
+    handlers=[_queue_handler],
 )
 # Set specific loggers to INFO to reduce SQLAlchemy noise
 logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
+# structlog loggers (remote extraction) default to printing straight to
+# stdout; route them through stdlib logging so they share the queue above
+structlog.configure(
+    processors=[
+        structlog.stdlib.filter_by_level,
+        structlog.processors.format_exc_info,
+        structlog.dev.ConsoleRenderer(colors=False),
+    ],
+    logger_factory=structlog.stdlib.LoggerFactory(),
+    wrapper_class=structlog.stdlib.BoundLogger,
+    cache_logger_on_first_use=True,
+)
+
 logger = logging.getLogger(__name__)
 
+# Read once; used on every error path
+DEBUG_MODE: bool = bool(settings.debug)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -58,111 +99,31 @@ async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting Examination Middleware...")
     
-    # Create database tables
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-        
-        # Auto-migration: Update for CIA types and attempts
-        try:
-            from sqlalchemy import text
-            
-            # 1. Handle examination_artifacts table
-            # Check for file_content
-            res = await conn.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='examination_artifacts' AND column_name='file_content'"))
-            if not res.fetchone():
-                logger.info("Adding file_content to examination_artifacts...")
-                await conn.execute(text("ALTER TABLE examination_artifacts ADD COLUMN file_content BYTEA"))
-
-            # Check for exam_type
-            res = await conn.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='examination_artifacts' AND column_name='exam_type'"))
-            if not res.fetchone():
-                logger.info("Adding exam_type to examination_artifacts...")
-                await conn.execute(text("ALTER TABLE examination_artifacts ADD COLUMN exam_type VARCHAR(10) NOT NULL DEFAULT 'CIA1'"))
-
-            # Check for attempt_number
-            res = await conn.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='examination_artifacts' AND column_name='attempt_number'"))
-            if not res.fetchone():
-                logger.info("Adding attempt_number to examination_artifacts...")
-                await conn.execute(text("ALTER TABLE examination_artifacts ADD COLUMN attempt_number INTEGER NOT NULL DEFAULT 1"))
-
-            # Check for attempt_2_locked
-            res = await conn.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='examination_artifacts' AND column_name='attempt_2_locked'"))
-            if not res.fetchone():
-                logger.info("Adding attempt_2_locked to examination_artifacts...")
-                await conn.execute(text("ALTER TABLE examination_artifacts ADD COLUMN attempt_2_locked BOOLEAN NOT NULL DEFAULT TRUE"))
-
-            # Check for auto_processed
-            res = await conn.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='examination_artifacts' AND column_name='auto_processed'"))
-            if not res.fetchone():
-                logger.info("Adding auto_processed to examination_artifacts...")
-                await conn.execute(text("ALTER TABLE examination_artifacts ADD COLUMN auto_processed BOOLEAN NOT NULL DEFAULT FALSE"))
-                # Create index for fast filtering
-                await conn.execute(text("CREATE INDEX IF NOT EXISTS idx_examination_artifacts_auto_processed ON examination_artifacts(auto_processed) WHERE auto_processed = true"))
-
-            # Migrate FK constraints to CASCADE on delete (for hard-delete support)
-            try:
-                # audit_logs.artifact_id FK
-                await conn.execute(text("ALTER TABLE audit_logs DROP CONSTRAINT IF EXISTS audit_logs_artifact_id_fkey"))
-                await conn.execute(text("ALTER TABLE audit_logs ADD CONSTRAINT audit_logs_artifact_id_fkey FOREIGN KEY (artifact_id) REFERENCES examination_artifacts(id) ON DELETE CASCADE"))
-                # submission_queue.artifact_id FK
-                await conn.execute(text("ALTER TABLE submission_queue DROP CONSTRAINT IF EXISTS submission_queue_artifact_id_fkey"))
-                await conn.execute(text("ALTER TABLE submission_queue ADD CONSTRAINT submission_queue_artifact_id_fkey FOREIGN KEY (artifact_id) REFERENCES examination_artifacts(id) ON DELETE CASCADE"))
-                logger.info("FK constraints updated to CASCADE on delete")
-            except Exception as fke:
-                logger.debug(f"FK CASCADE migration skipped or already done: {fke}")
-
-            # 2. Handle subject_mappings table
-            # Check for exam_type
-            res = await conn.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='subject_mappings' AND column_name='exam_type'"))
-            if not res.fetchone():
-                logger.info("Adding exam_type to subject_mappings...")
-                await conn.execute(text("ALTER TABLE subject_mappings ADD COLUMN exam_type VARCHAR(10) NOT NULL DEFAULT 'CIA1'"))
-
-            # 3. Update Constraints
-            # Drop old subject_mappings unique constraints/indices if they exist
-            try:
-                # SQLAlchemy often creates an index named ix_subject_mappings_subject_code
-                await conn.execute(text("DROP INDEX IF EXISTS ix_subject_mappings_subject_code"))
-                await conn.execute(text("ALTER TABLE subject_mappings DROP CONSTRAINT IF EXISTS subject_mappings_subject_code_key"))
-                await conn.execute(text("ALTER TABLE subject_mappings DROP CONSTRAINT IF EXISTS uq_subject_code"))
-                
-                # Add new one if not exists
-                # Check if uq_subject_exam_type already exists to avoid redundant errors
-                res = await conn.execute(text("SELECT conname FROM pg_constraint WHERE conname='uq_subject_exam_type'"))
-                if not res.fetchone():
-                    await conn.execute(text("ALTER TABLE subject_mappings ADD CONSTRAINT uq_subject_exam_type UNIQUE (subject_code, exam_type)"))
-            except Exception as ce:
-                logger.debug(f"Constraint update (subject_mappings) skipped or already done: {ce}")
-
-            # Drop old examination_artifacts unique constraints/indices
-            try:
-                await conn.execute(text("DROP INDEX IF EXISTS ix_examination_artifacts_parsed_reg_no"))
-                await conn.execute(text("DROP INDEX IF EXISTS ix_examination_artifacts_parsed_subject_code"))
-                await conn.execute(text("ALTER TABLE examination_artifacts DROP CONSTRAINT IF EXISTS examination_artifacts_parsed_reg_no_parsed_subject_code_key"))
-                await conn.execute(text("ALTER TABLE examination_artifacts DROP CONSTRAINT IF EXISTS uq_paper_submission"))
-                
-                # Add new one if not exists
-                res = await conn.execute(text("SELECT conname FROM pg_constraint WHERE conname='uq_paper_submission'"))
-                if not res.fetchone():
-                    await conn.execute(text("ALTER TABLE examination_artifacts ADD CONSTRAINT uq_paper_submission UNIQUE (parsed_reg_no, parsed_subject_code, exam_type, attempt_number)"))
-            except Exception as ce:
-                logger.debug(f"Constraint update (artifacts) skipped or already done: {ce}")
-
-            # 4. Update Enum
-            try:
-                # PostgreSQL specific: check if value exists in enum
-                res = await conn.execute(text("SELECT 1 FROM pg_type t JOIN pg_enum e ON t.oid = e.enumtypid WHERE t.typname = 'workflowstatus' AND e.enumlabel = 'SUPERSEDED'"))
-                if not res.fetchone():
-                    logger.info("Adding SUPERSEDED to workflowstatus enum...")
-                    # Note: ALTER TYPE ... ADD VALUE cannot run in a transaction block in some PG versions
-                    # But engine.begin() is a transaction. We try it anyway as async pg handles this usually
-                    await conn.execute(text("COMMIT")) # End current transaction if needed
-                    await conn.execute(text("ALTER TYPE workflowstatus ADD VALUE 'SUPERSEDED'"))
-            except Exception as ee:
-                logger.debug(f"Enum update skipped or failed: {ee}")
-
-        except Exception as e:
-            logger.error(f"Migration error during startup: {e}")
+    # Preload AI extraction models at startup to avoid timeout on first request.
+    # Kicked off first so the (~30s) load overlaps the DB work below.
+    # It runs on the extraction service's dedicated thread, off the default
+    # pool that serves sync routes.
+    model_preload = None
+    try:
+        from app.services.extraction_service import is_extraction_available
+        if not is_extraction_available():
+            logger.warning("AI extraction models not found — skipping preload")
+        elif get_extractor_mode() == "local" or settings.warm_extractor_on_startup:
+            logger.info("Preloading AI extraction models (this may take ~30s)...")
+            model_preload = asyncio.ensure_future(warm_local_extractor())
+        else:
+            logger.info("HF Space configured — local extraction models load on first fallback")
+    except Exception as e:
+        logger.warning(f"Could not preload extraction models: {e}")
+    
+    # Migrations normally run once per deploy (python -m app.cli.migrate);
+    # only fall back to running them here when the schema is behind
+    try:
+        if not await schema_is_current():
+            logger.warning("Database schema is behind, running migrations at startup")
+            await run_migrations()
+    except Exception as e:
+        logger.error(f"Migration error during startup: {e}")
             
     logger.info("Database tables created/verified")
     
@@ -193,6 +154,9 @@ async def lifespan(app: FastAPI):
                 session.add(admin)
                 await session.commit()
                 logger.info("Default admin user CREATED (admin/admin123)")
+            elif not settings.reset_admin_password:
+                # Skip the bcrypt verify on normal startups
+                logger.info("Admin user exists")
             else:
                 # Admin exists - verify password works, update if not
                 if not verify_password("admin123", row[1]):
@@ -208,43 +172,47 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"Error seeding admin user: {e}", exc_info=True)
     
-    # Ensure upload and storage directories exist
-    upload_path = Path(settings.upload_dir)
-    upload_path.mkdir(parents=True, exist_ok=True)
-    logger.info(f"Upload directory: {upload_path.absolute()}")
-    
-    storage_path = Path("./storage")
-    storage_path.mkdir(parents=True, exist_ok=True)
-    logger.info(f"Storage directory: {storage_path.absolute()}")
+    # Ensure upload and storage directories exist (the Docker image creates
+    # them at build time; app/templates and app/static ship with the code)
+    if not _is_production:
+        upload_path = Path(settings.upload_dir)
+        upload_path.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Upload directory: {upload_path.absolute()}")
+        
+        storage_path = Path("./storage")
+        storage_path.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Storage directory: {storage_path.absolute()}")
     
-    # Create templates directory
-    templates_path = Path("app/templates")
-    templates_path.mkdir(parents=True, exist_ok=True)
+    # Pre-render the static portal pages
+    try:
+        _render_portal("staff_upload.html", "Staff Upload Portal")
+        _render_portal("student_portal.html", "Student Submission Portal")
+    except Exception as e:
+        logger.warning(f"Could not pre-render portal pages: {e}")
     
-    # Create static directory
-    static_path = Path("app/static")
-    static_path.mkdir(parents=True, exist_ok=True)
+    # Student notifications are sent in batches by a background worker
+    upload_notification_queue.start()
+    audit_log_batcher.start()
     
     logger.info("Examination Middleware started successfully")
 
-    # Preload AI extraction models at startup to avoid timeout on first request
-    try:
-        import asyncio
-        from app.services.extraction_service import is_extraction_available, get_extractor
-        if is_extraction_available():
-            logger.info("Preloading AI extraction models (this may take ~30s)...")
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, get_extractor)
+    # Wait for the model preload started above
+    if model_preload is not None:
+        try:
+            await model_preload
             logger.info("✓ AI extraction models loaded and ready")
-        else:
-            logger.warning("AI extraction models not found — skipping preload")
-    except Exception as e:
-        logger.warning(f"Could not preload extraction models: {e}")
+        except Exception as e:
+            logger.warning(f"Could not preload extraction models: {e}")
 
     yield
     
     # Shutdown
     logger.info("Shutting down Examination Middleware...")
+    await upload_notification_queue.stop()
+    await audit_log_batcher.stop()
+    await mail_service.close()
+    await moodle_client.close()
+    await close_hf_client()
     await engine.dispose()
     logger.info("Database connections closed")
 
@@ -287,21 +255,110 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Add GZip compression
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+# Per-file allowance for multipart part headers and form fields
+UPLOAD_PART_OVERHEAD_BYTES = 64 * 1024
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Rejects upload requests whose declared Content-Length is over the cap.
+
+    FastAPI parses and spools the whole multipart body before a route or
+    its dependencies run, so the check has to happen here. /upload/single
+    takes one file and /upload/bulk up to settings.max_files_per_upload.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        per_file = settings.max_file_size_bytes + UPLOAD_PART_OVERHEAD_BYTES
+        self.limits = {
+            "/upload/single": per_file,
+            "/upload/bulk": settings.max_files_per_upload * per_file,
+        }
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is not None:
+            content_length = Headers(scope=scope).get("content-length", "")
+            if content_length.isdigit() and int(content_length) > limit:
+                response = JSONResponse(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    content={"detail": f"Upload too large. Max size per file: {settings.max_file_size_mb}MB"},
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+# Turn away oversized uploads before their bodies are read
+app.add_middleware(UploadSizeLimitMiddleware)
+
+# Content types that are already compressed; PDF answer sheets and scanned
+# images make up most of the bytes served
+GZIP_SKIP_CONTENT_TYPES = (
+    "application/pdf",
+    "image/",
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+)
+
+
+class SkipCompressedGZipMiddleware:
+    """
+    GZipMiddleware that sends already-compressed responses as they are.
+
+    The stock middleware has no content-type exclusion in the Starlette
+    version we pin, so responses matching GZIP_SKIP_CONTENT_TYPES are sent
+    straight to the server and GZip never sees them.
+    """
+
+    def __init__(self, app, minimum_size: int = 500):
+        self.app = app
+        self.gzip = GZipMiddleware(self._send_compressed_raw, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        # The server's send, for responses that bypass GZip
+        scope["_raw_send"] = send
+        await self.gzip(scope, receive, send)
+
+    async def _send_compressed_raw(self, scope, receive, gzip_send):
+        target = gzip_send
+
+        async def route(message):
+            nonlocal target
+            if message["type"] == "http.response.start":
+                content_type = Headers(raw=message["headers"]).get("content-type", "")
+                if content_type.lower().startswith(GZIP_SKIP_CONTENT_TYPES):
+                    target = scope["_raw_send"]
+            await target(message)
+
+        await self.app(scope, receive, route)
+
+
+# Add GZip compression, skipping bodies that are already compressed
+app.add_middleware(SkipCompressedGZipMiddleware, minimum_size=1000)
 
 
 # Global exception handler
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     """Handle all unhandled exceptions."""
-    logger.error(f"Unhandled exception: {exc}", exc_info=True)
+    # Full tracebacks only in debug; production gets a one-line summary
+    logger.error(
+        "Unhandled exception on %s %s: %s: %s",
+        request.method, request.url.path, type(exc).__name__, exc,
+        exc_info=DEBUG_MODE,
+    )
     return JSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={
             "success": False,
             "message": "An internal server error occurred",
-            "detail": str(exc) if settings.debug else None,
+            "detail": str(exc) if DEBUG_MODE else None,
         },
     )
 
@@ -344,7 +401,6 @@ app.include_router(
 )
 
 # Extraction (OCR) router
-from app.api.routes.extract import router as extract_router
 app.include_router(
     extract_router,
     prefix="/extract",
@@ -380,22 +436,22 @@ async def root():
 templates = Jinja2Templates(directory="app/templates")
 
 
+@lru_cache(maxsize=None)
+def _render_portal(template_name: str, title: str) -> str:
+    """Portal pages are the same for every visitor; render each once per process."""
+    return templates.get_template(template_name).render(title=title)
+
+
 @app.get("/portal/staff", tags=["Portal"], include_in_schema=False)
 async def staff_portal(request: Request):
     """Staff upload portal page."""
-    return templates.TemplateResponse(
-        "staff_upload.html",
-        {"request": request, "title": "Staff Upload Portal"},
-    )
+    return HTMLResponse(_render_portal("staff_upload.html", "Staff Upload Portal"))
 
 
 @app.get("/portal/student", tags=["Portal"], include_in_schema=False)
 async def student_portal(request: Request):
     """Student submission portal page."""
-    return templates.TemplateResponse(
-        "student_portal.html",
-        {"request": request, "title": "Student Submission Portal"},
-    )
+    return HTMLResponse(_render_portal("student_portal.html", "Student Submission Portal"))
 
 
 if __name__ == "__main__":
@@ -1,29 +1,38 @@
 """
 Services module initialization
+
+Re-exports are resolved lazily (PEP 562) so importing one service module,
+e.g. app.services.mail_service, does not import every other service and
+build their singletons. The singletons themselves (moodle_client,
+file_processor, mail_service) share their module's name, so import them
+from the module: from app.services.mail_service import mail_service
 """
 
-from app.services.moodle_client import MoodleClient, MoodleAPIError, moodle_client
-from app.services.file_processor import FileProcessor, file_processor
-from app.services.artifact_service import (
-    ArtifactService,
-    SubjectMappingService,
-    AuditService,
-)
-from app.services.submission_service import SubmissionService
-from app.services.mail_service import MailService, mail_service
-from app.services.notification_service import NotificationService
-
-__all__ = [
-    "MoodleClient",
-    "MoodleAPIError",
-    "moodle_client",
-    "FileProcessor",
-    "file_processor",
-    "ArtifactService",
-    "SubjectMappingService",
-    "AuditService",
-    "SubmissionService",
-    "MailService",
-    "mail_service",
-    "NotificationService",
-]
+import importlib
+
+_EXPORTS = {
+    "MoodleClient": "app.services.moodle_client",
+    "MoodleAPIError": "app.services.moodle_client",
+    "FileProcessor": "app.services.file_processor",
+    "ArtifactService": "app.services.artifact_service",
+    "SubjectMappingService": "app.services.artifact_service",
+    "AuditService": "app.services.artifact_service",
+    "SubmissionService": "app.services.submission_service",
+    "MailService": "app.services.mail_service",
+    "NotificationService": "app.services.notification_service",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module_path = _EXPORTS.get(name)
+    if module_path is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_path), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
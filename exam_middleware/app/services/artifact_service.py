@@ -4,10 +4,13 @@ Business logic for managing examination artifacts
 """
 
 import logging
-from typing import Optional, List, Dict, Any, Tuple
+import time
+from typing import Optional, List, Dict, Any, Tuple, NamedTuple
 from datetime import datetime, timezone
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, and_, or_
+from sqlalchemy import select, insert, update, and_, or_, func, exists, cast, String, tuple_
+from sqlalchemy.engine import RowMapping
+from sqlalchemy.orm import aliased
 from sqlalchemy.orm import selectinload
 from sqlalchemy.exc import IntegrityError
 
@@ -26,9 +29,31 @@ from app.schemas import (
 )
 from app.core.security import generate_transaction_id
 from app.core.config import settings
+from app.db.database import async_session_maker
+from app.services.batching import BatchWorker
 
 logger = logging.getLogger(__name__)
 
+# Columns reloaded after an artifact is flushed; file_content is left out so
+# the upload bytes aren't read straight back from the database
+_ARTIFACT_REFRESH_ATTRS = [
+    attr.key for attr in ExaminationArtifact.__mapper__.column_attrs if attr.key != "file_content"
+]
+
+# Columns written by the streamed /upload/all and /upload/pending listings
+_ARTIFACT_LIST_COLUMNS = (
+    ExaminationArtifact.artifact_uuid,
+    ExaminationArtifact.original_filename,
+    ExaminationArtifact.parsed_reg_no,
+    ExaminationArtifact.parsed_subject_code,
+    ExaminationArtifact.exam_type,
+    ExaminationArtifact.attempt_number,
+    ExaminationArtifact.attempt_2_locked,
+    ExaminationArtifact.workflow_status,
+    ExaminationArtifact.uploaded_at,
+    ExaminationArtifact.report_count_active,
+)
+
 
 class ArtifactService:
     """
@@ -163,7 +188,7 @@ class ArtifactService:
                     except Exception:
                         pass
                     await self.db.flush()
-                    await self.db.refresh(existing)
+                    await self._refresh_without_content(existing)
                     return existing
 
         # Pre-check uniqueness of parsed_reg_no + parsed_subject_code + exam_type to avoid DB constraint failure
@@ -202,7 +227,7 @@ class ArtifactService:
                     except Exception:
                         pass
                     await self.db.flush()
-                    await self.db.refresh(latest)
+                    await self._refresh_without_content(latest)
                     return latest
                 
                 # If only 1 attempt exists, create attempt 2
@@ -293,10 +318,19 @@ class ArtifactService:
             logger.exception("Failed to flush new artifact - unexpected error")
             raise
 
-        await self.db.refresh(artifact)
+        await self._refresh_without_content(artifact)
         
         logger.info(f"Created artifact: {artifact.artifact_uuid}")
         return artifact
+
+    async def _refresh_without_content(self, artifact: ExaminationArtifact) -> None:
+        """
+        Reload a flushed artifact's columns except the file bytes, and drop
+        the bytes from the session: they are in the database now, and bulk
+        uploads create many artifacts before committing.
+        """
+        await self.db.refresh(artifact, attribute_names=_ARTIFACT_REFRESH_ATTRS)
+        self.db.expire(artifact, ["file_content"])
     
     async def get_by_uuid(self, artifact_uuid: str) -> Optional[ExaminationArtifact]:
         """Get artifact by UUID"""
@@ -657,30 +691,149 @@ class ArtifactService:
         
         return list(result.scalars().all()), total
     
-    async def get_stats(self) -> Dict[str, int]:
-        """Get artifact statistics"""
-        stats = {}
+    async def list_pending_rows(
+        self,
+        limit: int = 100,
+        offset: int = 0
+    ) -> Tuple[List[RowMapping], int]:
+        """
+        Get listing columns of pending artifacts (for admin view).
+
+        Only the columns the listing shows are selected, so file contents
+        aren't loaded and no entities are kept in the session.
+        """
+        condition = ExaminationArtifact.workflow_status.in_([
+            WorkflowStatus.PENDING,
+            WorkflowStatus.PENDING_REVIEW
+        ])
+        total = await self.db.scalar(
+            select(func.count()).select_from(ExaminationArtifact).where(condition)
+        )
+        result = await self.db.execute(
+            select(*_ARTIFACT_LIST_COLUMNS)
+            .where(condition)
+            .order_by(ExaminationArtifact.uploaded_at.desc())
+            .limit(limit)
+            .offset(offset)
+        )
+        return list(result.mappings().all()), total or 0
+
+    async def list_artifact_rows(
+        self,
+        limit: int = 100,
+        offset: int = 0
+    ) -> Tuple[List[RowMapping], int]:
+        """Get listing columns of all artifacts regardless of status (for admin view)"""
+        total = await self.db.scalar(
+            select(func.count()).select_from(ExaminationArtifact)
+        )
+        result = await self.db.execute(
+            select(*_ARTIFACT_LIST_COLUMNS)
+            .order_by(ExaminationArtifact.uploaded_at.desc())
+            .limit(limit)
+            .offset(offset)
+        )
+        return list(result.mappings().all()), total or 0
+    
+    async def get_stats(self, cached: bool = True) -> Dict[str, int]:
+        """
+        Get artifact statistics (one grouped count over ix_artifacts_status).
+
+        With cached=True the counts may be up to STATS_CACHE_TTL_SECONDS old;
+        invalidate_stats_cache() only clears this worker's copy.
+        """
+        global _stats_cache
+        if cached and _stats_cache and _stats_cache[0] > time.monotonic():
+            return dict(_stats_cache[1])
+        generation = _stats_cache_generation
+
+        stats = {status.value.lower(): 0 for status in WorkflowStatus}
         
-        for status in WorkflowStatus:
-            result = await self.db.execute(
-                select(ExaminationArtifact)
-                .where(ExaminationArtifact.workflow_status == status)
-            )
-            stats[status.value.lower()] = len(result.scalars().all())
+        result = await self.db.execute(
+            select(ExaminationArtifact.workflow_status, func.count())
+            .group_by(ExaminationArtifact.workflow_status)
+        )
+        for status, count in result.all():
+            stats[status.value.lower()] = count
         
+        if generation == _stats_cache_generation:
+            _stats_cache = (time.monotonic() + STATS_CACHE_TTL_SECONDS, dict(stats))
         return stats
 
 
+# get_stats counts, polled by every open staff dashboard. Artifact writes clear
+# the cache once committed, but only in the worker that made them; the other
+# workers (the Dockerfile runs two) and background submission retries show
+# within the TTL.
+STATS_CACHE_TTL_SECONDS = 30
+_stats_cache: Optional[Tuple[float, Dict[str, int]]] = None  # (expires_at, stats)
+# Bumped on every invalidation, as for _mapping_cache_generation below
+_stats_cache_generation = 0
+
+
+def invalidate_stats_cache() -> None:
+    """Drop this worker's cached artifact counts (call after an artifact write is committed)."""
+    global _stats_cache, _stats_cache_generation
+    _stats_cache_generation += 1
+    _stats_cache = None
+
+
+class SubjectMappingInfo(NamedTuple):
+    """Read-only columns of a subject mapping used by lookups"""
+    subject_name: Optional[str]
+    exam_session: Optional[str]
+    moodle_assignment_id: int
+    moodle_assignment_name: Optional[str]
+
+
+_MAPPING_INFO_COLUMNS = (
+    SubjectMapping.subject_name,
+    SubjectMapping.exam_session,
+    SubjectMapping.moodle_assignment_id,
+    SubjectMapping.moodle_assignment_name,
+)
+
+# get_mapping results shared across requests, keyed by (SUBJECT_CODE, exam_type).
+# Misses are cached too; admin writes clear the cache once committed, and the
+# TTL bounds staleness for writes made by other workers.
+SUBJECT_MAPPING_CACHE_TTL_SECONDS = 300
+SUBJECT_MAPPING_CACHE_MAX_ENTRIES = 4096
+_mapping_cache: Dict[Tuple[str, str], Tuple[float, Optional[SubjectMappingInfo]]] = {}
+# Bumped on every invalidation; a lookup that was in flight across one
+# may have read the old row, so it doesn't store its result
+_mapping_cache_generation = 0
+
+
+def invalidate_subject_mapping_cache() -> None:
+    """Drop cached subject mappings (call after a mapping change is committed)."""
+    global _mapping_cache_generation
+    _mapping_cache_generation += 1
+    _mapping_cache.clear()
+
+
 class SubjectMappingService:
     """Service for managing subject to assignment mappings"""
     
     def __init__(self, db: AsyncSession):
         self.db = db
     
-    async def get_mapping(self, subject_code: str, exam_type: str = "CIA1") -> Optional[SubjectMapping]:
-        """Get mapping for a subject code + exam type"""
+    async def get_mapping(
+        self, subject_code: str, exam_type: str = "CIA1", cached: bool = True
+    ) -> Optional[SubjectMappingInfo]:
+        """
+        Get mapping for a subject code + exam type.
+        cached=False bypasses the shared cache (write paths that must see
+        the current row).
+        """
+        key = (subject_code.upper(), exam_type)
+        if cached:
+            entry = _mapping_cache.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+        generation = _mapping_cache_generation
+
         result = await self.db.execute(
-            select(SubjectMapping)
+            select(*_MAPPING_INFO_COLUMNS)
             .where(
                 and_(
                     SubjectMapping.subject_code == subject_code.upper(),
@@ -689,16 +842,46 @@ class SubjectMappingService:
                 )
             )
         )
-        return result.scalar_one_or_none()
+        row = result.one_or_none()
+        mapping = SubjectMappingInfo(*row) if row else None
+        if generation == _mapping_cache_generation:
+            if len(_mapping_cache) >= SUBJECT_MAPPING_CACHE_MAX_ENTRIES:
+                _mapping_cache.clear()
+            _mapping_cache[key] = (time.monotonic() + SUBJECT_MAPPING_CACHE_TTL_SECONDS, mapping)
+        return mapping
+    
+    async def get_mappings(
+        self, keys: List[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], SubjectMappingInfo]:
+        """Get active mappings for several (subject_code, exam_type) pairs in one query"""
+        keys = {(code.upper(), exam_type) for code, exam_type in keys}
+        if not keys:
+            return {}
+        result = await self.db.execute(
+            select(SubjectMapping.subject_code, SubjectMapping.exam_type, *_MAPPING_INFO_COLUMNS)
+            .where(
+                and_(
+                    tuple_(SubjectMapping.subject_code, SubjectMapping.exam_type).in_(list(keys)),
+                    SubjectMapping.is_active == True
+                )
+            )
+        )
+        return {(row[0], row[1]): SubjectMappingInfo(*row[2:]) for row in result.all()}
     
     async def get_assignment_id(self, subject_code: str, exam_type: str = "CIA1") -> Optional[int]:
         """Get assignment ID for a subject code + exam type"""
         # Strictly use database mappings
-        mapping = await self.get_mapping(subject_code, exam_type)
-        if mapping:
-            return mapping.moodle_assignment_id
-        
-        return None
+        result = await self.db.execute(
+            select(SubjectMapping.moodle_assignment_id)
+            .where(
+                and_(
+                    SubjectMapping.subject_code == subject_code.upper(),
+                    SubjectMapping.exam_type == exam_type,
+                    SubjectMapping.is_active == True
+                )
+            )
+        )
+        return result.scalar_one_or_none()
     
     async def create_mapping(
         self,
@@ -710,7 +893,10 @@ class SubjectMappingService:
         exam_session: Optional[str] = None,
         exam_type: str = "CIA1"
     ) -> SubjectMapping:
-        """Create a new subject mapping"""
+        """
+        Create a new subject mapping. The caller commits, then calls
+        invalidate_subject_mapping_cache().
+        """
         mapping = SubjectMapping(
             subject_code=subject_code.upper(),
             subject_name=subject_name,
@@ -743,7 +929,7 @@ class SubjectMappingService:
         created = 0
         
         for subject_code, assignment_id in config_mapping.items():
-            existing = await self.get_mapping(subject_code)
+            existing = await self.get_mapping(subject_code, cached=False)
             if not existing:
                 await self.create_mapping(
                     subject_code=subject_code,
@@ -758,8 +944,17 @@ class SubjectMappingService:
 class AuditService:
     """Service for audit logging"""
     
-    def __init__(self, db: AsyncSession):
+    # Actions that change an artifact's active report count
+    REPORT_ACTIONS = ("report_issue", "report_deleted", "report_resolved")
+    
+    def __init__(self, db: AsyncSession, deferred: bool = False):
+        """
+        deferred=True hands rows to audit_log_batcher instead of writing
+        them in this session (for best-effort background work such as
+        notifications, where the row need not commit with the caller).
+        """
         self.db = db
+        self.deferred = deferred
     
     async def log_action(
         self,
@@ -780,7 +975,7 @@ class AuditService:
         target_id: Optional[str] = None
     ) -> AuditLog:
         """Create an audit log entry"""
-        log = AuditLog(
+        row = dict(
             action=action,
             action_category=action_category,
             actor_type=actor_type,
@@ -798,11 +993,49 @@ class AuditService:
             target_id=target_id
         )
         
+        # Report actions update report_count_active, so they are never deferred
+        if self.deferred and action not in self.REPORT_ACTIONS:
+            audit_log_batcher.enqueue(row)
+            return AuditLog(**row)
+        
+        log = AuditLog(**row)
         self.db.add(log)
         await self.db.flush()
         
+        if action in self.REPORT_ACTIONS and artifact_id:
+            await self.refresh_report_count(artifact_id)
+        
         return log
     
+    async def refresh_report_count(self, artifact_id: int) -> None:
+        """
+        Recompute the denormalized report_count_active for an artifact.
+
+        Counts report_issue entries that have no report_deleted or
+        report_resolved entry targeting them. Recomputing (rather than
+        incrementing) keeps the count correct when a report is resolved
+        twice or reports are migrated between artifacts.
+        """
+        issue = aliased(AuditLog)
+        closing = aliased(AuditLog)
+        active_count = (
+            select(func.count(issue.id))
+            .where(
+                issue.artifact_id == artifact_id,
+                issue.action == "report_issue",
+                ~exists().where(
+                    closing.action.in_(("report_deleted", "report_resolved")),
+                    closing.target_id == cast(issue.id, String),
+                ),
+            )
+            .scalar_subquery()
+        )
+        await self.db.execute(
+            update(ExaminationArtifact)
+            .where(ExaminationArtifact.id == artifact_id)
+            .values(report_count_active=active_count)
+        )
+    
     async def get_for_artifact(self, artifact_id: int) -> List[AuditLog]:
         """Get all audit logs for an artifact"""
         # Primary logs tied to the artifact
@@ -846,3 +1079,31 @@ class AuditService:
             .limit(limit)
         )
         return list(result.scalars().all())
+
+
+class AuditLogBatcher(BatchWorker):
+    """
+    Buffers deferred audit rows and writes them with one multi-row INSERT
+    per flush (up to BATCH_SIZE rows or every BATCH_WINDOW_SECONDS).
+    """
+
+    BATCH_SIZE = 200
+    BATCH_WINDOW_SECONDS = 0.05
+
+    def enqueue(self, row: Dict[str, Any]) -> None:
+        """Buffer one audit row (AuditLog column values)."""
+        self._submit(row)
+
+    async def _process_batch(self, rows: List[Dict[str, Any]]) -> None:
+        await self._flush(rows)
+
+    async def _flush(self, rows: List[Dict[str, Any]]) -> None:
+        try:
+            async with async_session_maker() as session:
+                await session.execute(insert(AuditLog), rows)
+                await session.commit()
+        except Exception as exc:
+            logger.error("Failed to write %d audit log rows: %s", len(rows), exc)
+
+
+audit_log_batcher = AuditLogBatcher()
@@ -0,0 +1,105 @@
+"""
+Batch Worker
+Shared in-process queue that drains items in time/size-bounded batches
+"""
+
+import abc
+import asyncio
+import logging
+from typing import Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Queued by stop(): the worker handles what it holds and exits when it sees it
+_STOP = object()
+
+
+class BatchWorker(abc.ABC):
+    """
+    Queue drained by one worker task in batches of up to BATCH_SIZE items,
+    or whatever arrives within BATCH_WINDOW_SECONDS of the first one.
+
+    Subclasses implement _process_batch(). start()/stop() belong in the app
+    lifespan; while no worker is running (scripts, tests) each item is
+    handled on its own task, at most MAX_DIRECT_BATCHES at a time.
+    """
+
+    BATCH_SIZE = 20
+    BATCH_WINDOW_SECONDS = 1.0
+    MAX_DIRECT_BATCHES = 4
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._direct_tasks: set = set()
+        self._direct_slots = asyncio.Semaphore(self.MAX_DIRECT_BATCHES)
+
+    def start(self) -> None:
+        """Start the drain worker on the running event loop."""
+        if self._worker and not self._worker.done():
+            return
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Handle everything queued or in progress, then stop the worker."""
+        if self._worker:
+            if not self._worker.done():
+                # The sentinel lands behind everything already queued, so the
+                # worker finishes its current batch and the rest before exiting
+                self._queue.put_nowait(_STOP)
+                await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+        leftover = []
+        while self._queue and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP:
+                leftover.append(item)
+        if leftover:
+            await self._process_batch(leftover)
+        if self._direct_tasks:
+            await asyncio.gather(*self._direct_tasks, return_exceptions=True)
+
+    def _submit(self, item: Any) -> None:
+        if self._worker is None or self._worker.done():
+            task = asyncio.get_running_loop().create_task(self._process_direct(item))
+            self._direct_tasks.add(task)
+            task.add_done_callback(self._direct_tasks.discard)
+            return
+        self._queue.put_nowait(item)
+
+    async def _process_direct(self, item: Any) -> None:
+        async with self._direct_slots:
+            await self._process_batch([item])
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = loop.time() + self.BATCH_WINDOW_SECONDS
+            while len(batch) < self.BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                await self._process_batch(batch)
+            except Exception as exc:
+                # Keep draining; a failed batch must not stop later ones
+                logger.error("%s batch of %d failed: %s", type(self).__name__, len(batch), exc)
+
+    @abc.abstractmethod
+    async def _process_batch(self, batch: List[Any]) -> None:
+        """Handle one batch of queued items."""
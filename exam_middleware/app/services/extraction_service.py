@@ -5,16 +5,18 @@ register number and subject code from scanned answer sheets.
 Models are loaded lazily on first extraction request to save memory.
 """
 
-import os
+import io
 import logging
+import os
 import tempfile
+import threading
 from pathlib import Path
 
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from PIL import Image
-from torchvision import transforms
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +30,21 @@ FALLBACK_YOLO_WEIGHTS = MODELS_DIR / "weights.pt"  # optional
 REGISTER_CRNN_WEIGHTS = MODELS_DIR / "best_crnn_model(git).pth"
 SUBJECT_CRNN_WEIGHTS = MODELS_DIR / "best_subject_model_final.pth"
 
+# Fixed CRNN input sizes (H, W); the models are traced at these shapes
+REGISTER_INPUT_SIZE = (32, 256)
+SUBJECT_INPUT_SIZE = (32, 128)
+
+# PDF rasterization resolution; an A4 page at 150 DPI is ~1240x1750 px,
+# still about twice the YOLO input size
+PDF_DPI = 150
+
+# Square YOLO input size; pages are letterboxed to it once per extraction
+YOLO_IMGSZ = 640
+
+# CTC class index -> character (index 0 = blank)
+REGISTER_CHARS = np.array([""] + [str(d) for d in range(10)])
+SUBJECT_CHARS = np.array([""] + [str(d) for d in range(10)] + [chr(c) for c in range(ord("A"), ord("Z") + 1)])
+
 
 # ---------------------------------------------------------------------------
 # CRNN architecture (must match training code exactly)
@@ -89,19 +106,248 @@ def _clean_state_dict(raw):
     return cleaned
 
 
+# ---------------------------------------------------------------------------
+# Helper: crop → normalized CRNN input tensor
+# ---------------------------------------------------------------------------
+_BGR_LUMA = torch.tensor([0.114, 0.587, 0.299])  # ITU-R 601, same weights as PIL "L"
+
+
+def _preprocess_crop(crop: np.ndarray, size: tuple, device: torch.device,
+                     dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    """
+    Grayscale, resize and normalize a BGR (or already gray) uint8 crop into a
+    (1, 1, H, W) tensor in [-1, 1], without going through PIL.
+    """
+    t = torch.from_numpy(np.ascontiguousarray(crop)).to(device).float()
+    if t.ndim == 3:
+        t = t[..., :3] @ _BGR_LUMA.to(device)
+    t = F.interpolate(t[None, None], size=size, mode="bilinear", align_corners=False, antialias=True)
+    return ((t / 255 - 0.5) / 0.5).to(dtype)
+
+
+# ---------------------------------------------------------------------------
+# Helper: rasterize the first page of a PDF
+# ---------------------------------------------------------------------------
+def _render_pdf_first_page(source: "str | bytes") -> np.ndarray:
+    """
+    Render page 1 of a PDF (file path or raw bytes) to a BGR uint8 array at
+    PDF_DPI. Uses PyMuPDF (in-process) when installed, otherwise
+    pdf2image/pdftoppm.
+    """
+    try:
+        import fitz
+    except ImportError:
+        from pdf2image import convert_from_bytes, convert_from_path
+        convert = convert_from_bytes if isinstance(source, bytes) else convert_from_path
+        images = convert(source, dpi=PDF_DPI, first_page=1, last_page=1)
+        if not images:
+            raise ValueError("PDF has no pages")
+        # PIL gives RGB, convert to BGR numpy for YOLO
+        return np.ascontiguousarray(np.asarray(images[0])[:, :, ::-1])
+
+    doc = fitz.open(stream=source, filetype="pdf") if isinstance(source, bytes) else fitz.open(source)
+    with doc:
+        pix = doc.load_page(0).get_pixmap(dpi=PDF_DPI, colorspace=fitz.csRGB, alpha=False)
+        rgb = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        return np.ascontiguousarray(rgb[:, :, ::-1])
+
+
+# ---------------------------------------------------------------------------
+# Helper: page → letterboxed YOLO input tensor
+# ---------------------------------------------------------------------------
+def _letterbox_tensor(image: np.ndarray, size: int, device: torch.device,
+                      dtype: torch.dtype = torch.float32) -> tuple[torch.Tensor, float, tuple]:
+    """
+    Convert a BGR uint8 page to the (1, 3, size, size) RGB [0, 1] tensor YOLO
+    expects, letterboxed with Ultralytics' grey (114) padding. Returns the
+    tensor, the resize scale and the (left, top) padding needed to map boxes
+    back onto the page.
+    """
+    h, w = image.shape[:2]
+    scale = min(size / h, size / w)
+    nh, nw = round(h * scale), round(w * scale)
+    top, left = (size - nh) // 2, (size - nw) // 2
+
+    # Upload the BGR page as-is and reorder channels on the device
+    t = torch.from_numpy(np.ascontiguousarray(image)).to(device)
+    t = t.permute(2, 0, 1)[[2, 1, 0]].unsqueeze(0).float()
+    t = F.interpolate(t, size=(nh, nw), mode="bilinear", align_corners=False, antialias=True)
+    canvas = torch.full((1, 3, size, size), 114.0, device=device)
+    canvas[:, :, top:top + nh, left:left + nw] = t
+    return (canvas / 255).to(dtype), scale, (left, top)
+
+
+# ---------------------------------------------------------------------------
+# Helper: greedy CTC decode
+# ---------------------------------------------------------------------------
+def _ctc_greedy_decode(logits: torch.Tensor) -> tuple[np.ndarray, float]:
+    """
+    Best-path CTC decode of (T, C) logits: collapse repeated classes and drop
+    blanks with tensor ops. Returns the kept class ids and the mean
+    probability of those steps (0.0 if nothing was decoded).
+    """
+    max_probs, preds = logits.softmax(1).max(1)
+    keep = preds != 0
+    keep[1:] &= preds[1:] != preds[:-1]
+    ids = preds[keep]
+    avg_conf = float(max_probs[keep].float().mean()) if ids.numel() else 0.0
+    return ids.cpu().numpy(), avg_conf
+
+
+# ---------------------------------------------------------------------------
+# Helper: prefer a TensorRT engine exported next to the .pt weights
+# ---------------------------------------------------------------------------
+def _yolo_weights(pt_path: Path, use_engine: bool) -> Path:
+    """
+    Return the TensorRT engine for `pt_path` if one was exported
+    (see export_yolo_engine.py) and CUDA is available, else the .pt file.
+    """
+    engine_path = pt_path.with_suffix(".engine")
+    if use_engine and engine_path.exists():
+        logger.info(f"Using TensorRT engine {engine_path.name}")
+        return engine_path
+    return pt_path
+
+
+# ---------------------------------------------------------------------------
+# Helper: map YOLO class names to ids once per model
+# ---------------------------------------------------------------------------
+def _role_class_ids(model) -> tuple[int, int]:
+    """Class ids of the RegisterNumber and SubjectCode labels (-1 if the model lacks one)."""
+    ids = {name: cls_id for cls_id, name in model.names.items()}
+    return ids.get("RegisterNumber", -1), ids.get("SubjectCode", -1)
+
+
+# ---------------------------------------------------------------------------
+# Helper: fold BatchNorm into the preceding convolutions
+# ---------------------------------------------------------------------------
+def _fuse_conv_bn(model: CRNN) -> CRNN:
+    """Fold each BatchNorm2d of an eval-mode CRNN into the Conv2d before it."""
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+    layers = model.cnn
+    for i in range(len(layers) - 1):
+        if isinstance(layers[i], nn.Conv2d) and isinstance(layers[i + 1], nn.BatchNorm2d):
+            layers[i] = fuse_conv_bn_eval(layers[i], layers[i + 1])
+            layers[i + 1] = nn.Identity()
+    return model
+
+
+# ---------------------------------------------------------------------------
+# Helper: reduce CRNN precision for inference
+# ---------------------------------------------------------------------------
+def _reduce_precision(model: nn.Module, device: torch.device) -> nn.Module:
+    """FP16 on CUDA; dynamic INT8 for the LSTM/Linear layers on CPU."""
+    if device.type == "cuda":
+        return model.half()
+    try:
+        return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    except Exception as e:
+        logger.warning(f"CRNN dynamic quantization failed, keeping FP32: {e}")
+        return model
+
+
+# ---------------------------------------------------------------------------
+# Helper: TorchScript-compile a CRNN for its fixed input shape
+# ---------------------------------------------------------------------------
+def _compile_crnn(model: nn.Module, input_size: tuple, device: torch.device,
+                  dtype: torch.dtype = torch.float32) -> nn.Module:
+    """
+    Trace an eval-mode CRNN, fold it for inference and warm it up so the
+    first real request doesn't pay the JIT cost. Falls back to the eager
+    model if tracing fails.
+    """
+    example = torch.zeros(1, 1, *input_size, device=device, dtype=dtype)
+    try:
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+            traced = torch.jit.optimize_for_inference(traced)
+            for _ in range(2):
+                traced(example)
+        return traced
+    except Exception as e:
+        logger.warning(f"CRNN TorchScript compilation failed, using eager model: {e}")
+        return model
+
+
+# ---------------------------------------------------------------------------
+# Helper: ONNX Runtime backend for CPU-only hosts
+# ---------------------------------------------------------------------------
+ONNX_CACHE_DIR = Path(tempfile.gettempdir()) / "exam_middleware_onnx"
+
+
+class _OrtCRNN:
+    """CRNN exported to ONNX and run by ONNX Runtime; called like the torch module."""
+
+    def __init__(self, session):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        out = self.session.run(None, {self.input_name: x.numpy()})[0]
+        return torch.from_numpy(out)
+
+
+def _onnx_crnn(model: nn.Module, input_size: tuple, name: str) -> "_OrtCRNN | None":
+    """
+    Export an FP32 eval-mode CRNN to ONNX, INT8-quantize its weights and load
+    it with the CPU execution provider. Returns None if onnxruntime is not
+    installed or any step fails (the torch path is used instead).
+
+    Several server workers run this at startup against the same cache dir,
+    so each writes under a per-process name and os.replace()s the finished
+    file into place; a reader never sees a partially written model.
+    """
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        return None
+
+    try:
+        ONNX_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fp32_path = ONNX_CACHE_DIR / f"{name}.onnx"
+        int8_path = ONNX_CACHE_DIR / f"{name}.int8.onnx"
+        fp32_tmp = ONNX_CACHE_DIR / f"{name}.{os.getpid()}.tmp.onnx"
+        int8_tmp = ONNX_CACHE_DIR / f"{name}.int8.{os.getpid()}.tmp.onnx"
+        torch.onnx.export(
+            model, torch.zeros(1, 1, *input_size), str(fp32_tmp),
+            input_names=["input"], output_names=["logits"], opset_version=17,
+        )
+        model_path = fp32_path
+        try:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(str(fp32_tmp), str(int8_tmp), weight_type=QuantType.QInt8)
+            os.replace(int8_tmp, int8_path)
+            model_path = int8_path
+        except Exception as e:
+            logger.warning(f"ONNX INT8 quantization of {name} CRNN failed, using FP32: {e}")
+            int8_tmp.unlink(missing_ok=True)
+        os.replace(fp32_tmp, fp32_path)
+        session = ort.InferenceSession(str(model_path), providers=["CPUExecutionProvider"])
+        logger.info(f"{name} CRNN running on ONNX Runtime ({model_path.name})")
+        return _OrtCRNN(session)
+    except Exception as e:
+        logger.warning(f"ONNX Runtime setup for {name} CRNN failed, using PyTorch: {e}")
+        return None
+
+
 # ---------------------------------------------------------------------------
 # Singleton extractor — loaded once, reused across requests
 # ---------------------------------------------------------------------------
 _extractor_instance: "AnswerSheetExtractor | None" = None
+_extractor_lock = threading.Lock()
 
 
 def get_extractor() -> "AnswerSheetExtractor":
     """Return (or lazily create) the global AnswerSheetExtractor."""
     global _extractor_instance
     if _extractor_instance is None:
-        logger.info("Loading extraction models for the first time …")
-        _extractor_instance = AnswerSheetExtractor()
-        logger.info("Extraction models loaded successfully.")
+        # Concurrent first requests must not each load a copy of the models
+        with _extractor_lock:
+            if _extractor_instance is None:
+                logger.info("Loading extraction models for the first time …")
+                _extractor_instance = AnswerSheetExtractor()
+                logger.info("Extraction models loaded successfully.")
     return _extractor_instance
 
 
@@ -116,17 +362,27 @@ def is_extraction_available() -> bool:
 class AnswerSheetExtractor:
     def __init__(self):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # Half precision on GPU (CRNN inputs are cast to match); CPU stays FP32
+        # with INT8 dynamic quantization of the CRNN LSTM/Linear layers
+        self.use_half = self.device.type == "cuda"
+        self.input_dtype = torch.float16 if self.use_half else torch.float32
+        if self.device.type == "cuda":
+            # Input shapes are fixed, so let cuDNN pick its fastest kernels once
+            torch.backends.cudnn.benchmark = True
 
         # ---- YOLO (detection) ------------------------------------------------
         from ultralytics import YOLO
 
         if not PRIMARY_YOLO_WEIGHTS.exists():
             raise FileNotFoundError(f"Primary YOLO weights not found: {PRIMARY_YOLO_WEIGHTS}")
-        self.primary_yolo = YOLO(str(PRIMARY_YOLO_WEIGHTS))
+        self.primary_yolo = YOLO(str(_yolo_weights(PRIMARY_YOLO_WEIGHTS, self.use_half)))
+        self.primary_role_ids = _role_class_ids(self.primary_yolo)
 
         self.fallback_yolo = None
+        self.fallback_role_ids = (-1, -1)
         if FALLBACK_YOLO_WEIGHTS.exists():
-            self.fallback_yolo = YOLO(str(FALLBACK_YOLO_WEIGHTS))
+            self.fallback_yolo = YOLO(str(_yolo_weights(FALLBACK_YOLO_WEIGHTS, self.use_half)))
+            self.fallback_role_ids = _role_class_ids(self.fallback_yolo)
             logger.info("Fallback YOLO model loaded.")
         else:
             logger.warning("Fallback YOLO weights not found — will use primary model only.")
@@ -136,35 +392,39 @@ class AnswerSheetExtractor:
         ckpt = torch.load(str(REGISTER_CRNN_WEIGHTS), map_location=self.device, weights_only=False)
         self.register_crnn.load_state_dict(_clean_state_dict(ckpt))
         self.register_crnn.eval()
+        self.register_crnn = _fuse_conv_bn(self.register_crnn)
+        self.register_crnn.requires_grad_(False)
+        self.register_crnn = self._optimize_crnn(self.register_crnn, REGISTER_INPUT_SIZE, "register")
 
         # ---- CRNN for subject codes (blank + 0-9 + A-Z = 37 classes) --------
         self.subject_crnn = CRNN(num_classes=37).to(self.device)
         ckpt2 = torch.load(str(SUBJECT_CRNN_WEIGHTS), map_location=self.device, weights_only=False)
         self.subject_crnn.load_state_dict(_clean_state_dict(ckpt2))
         self.subject_crnn.eval()
-
-        # ---- Transforms ------------------------------------------------------
-        self.register_transform = transforms.Compose([
-            transforms.Grayscale(num_output_channels=1),
-            transforms.Resize((32, 256)),
-            transforms.ToTensor(),
-            transforms.Normalize((0.5,), (0.5,)),
-        ])
-        self.subject_transform = transforms.Compose([
-            transforms.Grayscale(num_output_channels=1),
-            transforms.Resize((32, 128)),
-            transforms.ToTensor(),
-            transforms.Normalize((0.5,), (0.5,)),
-        ])
-
-        # Character map for subject code: index 0 = blank, 1-10 = digits 0-9, 11-36 = A-Z
-        self.char_map = {i: str(i - 1) for i in range(1, 11)}
-        self.char_map.update({i: chr(i - 11 + ord("A")) for i in range(11, 37)})
-        self.char_map[0] = ""
+        self.subject_crnn = _fuse_conv_bn(self.subject_crnn)
+        self.subject_crnn.requires_grad_(False)
+        self.subject_crnn = self._optimize_crnn(self.subject_crnn, SUBJECT_INPUT_SIZE, "subject")
+
+        # ---- CUDA streams so the two CRNNs can overlap on the GPU ----------
+        self.crnn_streams = (torch.cuda.Stream(), torch.cuda.Stream()) if self.device.type == "cuda" else None
+
+        # The extractor is shared by every request thread; the YOLO predictors
+        # and the CRNN streams are not safe to drive from two threads at once
+        self._inference_lock = threading.Lock()
+
+    def _optimize_crnn(self, model: nn.Module, input_size: tuple, name: str):
+        """Pick the fastest available inference backend for a loaded CRNN."""
+        if self.device.type == "cpu":
+            ort_model = _onnx_crnn(model, input_size, name)
+            if ort_model is not None:
+                return ort_model
+        model = _reduce_precision(model, self.device)
+        return _compile_crnn(model, input_size, self.device, self.input_dtype)
 
     # ------------------------------------------------------------------
     # Region detection (YOLO)
     # ------------------------------------------------------------------
+    @torch.inference_mode()
     def _detect_regions(self, image: np.ndarray):
         """
         Run YOLO on the image and return lists of
@@ -174,37 +434,41 @@ class AnswerSheetExtractor:
         PADDING = 10  # px around each detection box (prevents edge chars from being cut)
         CONF_THRESH = 0.2  # match the working Streamlit threshold
 
-        def _padded_crop(img, x1, y1, x2, y2):
-            """Crop with padding, clamped to image boundaries."""
-            px1 = max(0, x1 - PADDING)
-            py1 = max(0, y1 - PADDING)
-            px2 = min(w, x2 + PADDING)
-            py2 = min(h, y2 + PADDING)
-            return img[py1:py2, px1:px2]
-
-        results = self.primary_yolo(image)
-        boxes = results[0].boxes
-        names = results[0].names
-
-        reg_regions: list[tuple[np.ndarray, float]] = []
-        sub_regions: list[tuple[np.ndarray, float]] = []
-
-        for box in boxes:
-            x1, y1, x2, y2 = map(int, box.xyxy[0])
-            conf = float(box.conf[0])
-            label = names[int(box.cls[0])]
-            # Clamp to image boundaries
-            x1, y1 = max(0, x1), max(0, y1)
-            x2, y2 = min(w, x2), min(h, y2)
-            if x1 >= x2 or y1 >= y2:
-                continue
-
-            crop = _padded_crop(image, x1, y1, x2, y2)
-
-            if label == "RegisterNumber" and conf > CONF_THRESH:
-                reg_regions.append((crop, conf))
-            elif label == "SubjectCode" and conf > CONF_THRESH:
-                sub_regions.append((crop, conf))
+        # Preprocess the page once and share it between the primary and
+        # fallback models; Ultralytics skips its own preprocessing for tensors
+        source, scale, (left, top) = _letterbox_tensor(image, YOLO_IMGSZ, self.device, self.input_dtype)
+        offset = torch.tensor([left, top, left, top], dtype=torch.float32)
+
+        def _find_regions(model, role_ids):
+            reg_id, sub_id = role_ids
+            # verbose=False: Ultralytics otherwise prints a per-image summary on
+            # every call. conf is left at Ultralytics' default (0.25), which
+            # decides how many SubjectCode boxes the "second region" rule sees
+            boxes = model(source, half=self.use_half, verbose=False)[0].boxes
+            # One host transfer per field instead of per-box tensor indexing;
+            # boxes are mapped from letterbox space back onto the page
+            xyxy = ((boxes.xyxy.float().cpu() - offset) / scale).int().numpy()
+            confs = boxes.conf.cpu().numpy()
+            cls_ids = boxes.cls.int().cpu().numpy()
+
+            reg: list[tuple[np.ndarray, float]] = []
+            sub: list[tuple[np.ndarray, float]] = []
+            for (x1, y1, x2, y2), conf, cls_id in zip(xyxy, confs, cls_ids):
+                # Clamp to image boundaries
+                x1, y1 = max(0, x1), max(0, y1)
+                x2, y2 = min(w, x2), min(h, y2)
+                if x1 >= x2 or y1 >= y2 or conf <= CONF_THRESH:
+                    continue
+                if cls_id != reg_id and cls_id != sub_id:
+                    continue
+
+                # Crop with padding, clamped to image boundaries
+                crop = image[max(0, y1 - PADDING):min(h, y2 + PADDING),
+                             max(0, x1 - PADDING):min(w, x2 + PADDING)]
+                (reg if cls_id == reg_id else sub).append((crop, float(conf)))
+            return reg, sub
+
+        reg_regions, sub_regions = _find_regions(self.primary_yolo, self.primary_role_ids)
 
         # Fallback YOLO for BOTH register and subject if either is missing
         if (not reg_regions or not sub_regions) and self.fallback_yolo is not None:
@@ -215,86 +479,74 @@ class AnswerSheetExtractor:
                 missing.append("SubjectCode")
             logger.info(f"Primary YOLO missed regions — trying fallback: {missing}")
 
-            fb_results = self.fallback_yolo(image)
-            fb_boxes = fb_results[0].boxes
-            fb_names = fb_results[0].names
-            for box in fb_boxes:
-                x1, y1, x2, y2 = map(int, box.xyxy[0])
-                conf = float(box.conf[0])
-                label = fb_names[int(box.cls[0])]
-                x1, y1 = max(0, x1), max(0, y1)
-                x2, y2 = min(w, x2), min(h, y2)
-                if x1 >= x2 or y1 >= y2:
-                    continue
-
-                crop = _padded_crop(image, x1, y1, x2, y2)
-
-                if label == "RegisterNumber" and conf > CONF_THRESH and not reg_regions:
-                    reg_regions.append((crop, conf))
-                elif label == "SubjectCode" and conf > CONF_THRESH and not sub_regions:
-                    sub_regions.append((crop, conf))
+            fb_reg, fb_sub = _find_regions(self.fallback_yolo, self.fallback_role_ids)
+            # Only the first fallback detection fills a missing role
+            if not reg_regions:
+                reg_regions = fb_reg[:1]
+            if not sub_regions:
+                sub_regions = fb_sub[:1]
 
         return reg_regions, sub_regions
 
     # ------------------------------------------------------------------
     # CRNN inference helpers
     # ------------------------------------------------------------------
+    @torch.inference_mode()
     def _extract_register_number(self, crop: np.ndarray) -> tuple[str, float]:
         """Return (decoded_text, confidence)."""
         try:
-            # Convert BGR numpy array → grayscale PIL without cv2
-            gray = crop[:, :, ::-1] if len(crop.shape) == 3 else crop
-            pil = Image.fromarray(gray).convert("L")
-            tensor = self.register_transform(pil).unsqueeze(0).to(self.device)
-            with torch.no_grad():
-                out = self.register_crnn(tensor).squeeze(1)
-                probs = out.softmax(1)
-                max_probs, preds = probs.max(1)
-                seq = preds.cpu().numpy()
-                conf_vals = max_probs.cpu().numpy()
-                prev = -1
-                result = []
-                confs = []
-                for s, c in zip(seq, conf_vals):
-                    if s != 0 and s != prev:
-                        result.append(s - 1)
-                        confs.append(c)
-                    prev = s
-            text = "".join(map(str, result))
-            avg_conf = float(np.mean(confs)) if confs else 0.0
+            tensor = _preprocess_crop(crop, REGISTER_INPUT_SIZE, self.device, self.input_dtype)
+            ids, avg_conf = _ctc_greedy_decode(self.register_crnn(tensor).squeeze(1))
+            text = "".join(REGISTER_CHARS[ids])
             return text, avg_conf
         except Exception as e:
             logger.error(f"Register extraction error: {e}")
             return "", 0.0
 
+    @torch.inference_mode()
     def _extract_subject_code(self, crop: np.ndarray) -> tuple[str, float]:
         """Return (decoded_text, confidence)."""
         try:
-            # Convert BGR numpy array → grayscale PIL without cv2
-            gray = crop[:, :, ::-1] if len(crop.shape) == 3 else crop
-            pil = Image.fromarray(gray).convert("L")
-            tensor = self.subject_transform(pil).unsqueeze(0).to(self.device)
-            with torch.no_grad():
-                out = self.subject_crnn(tensor).squeeze(1)
-                probs = out.softmax(1)
-                max_probs, preds = probs.max(1)
-                seq = preds.cpu().numpy()
-                conf_vals = max_probs.cpu().numpy()
-                prev = 0
-                result = []
-                confs = []
-                for s, c in zip(seq, conf_vals):
-                    if s != 0 and s != prev:
-                        result.append(self.char_map.get(s, ""))
-                        confs.append(c)
-                    prev = s
-            text = "".join(result)
-            avg_conf = float(np.mean(confs)) if confs else 0.0
+            tensor = _preprocess_crop(crop, SUBJECT_INPUT_SIZE, self.device, self.input_dtype)
+            ids, avg_conf = _ctc_greedy_decode(self.subject_crnn(tensor).squeeze(1))
+            text = "".join(SUBJECT_CHARS[ids])
             return text, avg_conf
         except Exception as e:
             logger.error(f"Subject extraction error: {e}")
             return "", 0.0
 
+    @torch.inference_mode()
+    def _extract_on_streams(self, reg_crop: np.ndarray, sub_crop: np.ndarray):
+        """
+        Run the register and subject CRNNs on separate CUDA streams, then
+        decode both. Returns ((text, conf), (text, conf)).
+        """
+        try:
+            current = torch.cuda.current_stream()
+            jobs = (
+                (self.register_crnn, REGISTER_INPUT_SIZE, reg_crop),
+                (self.subject_crnn, SUBJECT_INPUT_SIZE, sub_crop),
+            )
+            logits = []
+            for stream, (model, size, crop) in zip(self.crnn_streams, jobs):
+                stream.wait_stream(current)
+                with torch.cuda.stream(stream):
+                    x = _preprocess_crop(crop, size, self.device, self.input_dtype)
+                    out = model(x).squeeze(1)
+                # Output is consumed on the current stream; keep the allocator
+                # from reusing its memory on the side stream too early
+                out.record_stream(current)
+                logits.append(out)
+            for stream in self.crnn_streams:
+                current.wait_stream(stream)
+
+            reg_ids, reg_conf = _ctc_greedy_decode(logits[0])
+            sub_ids, sub_conf = _ctc_greedy_decode(logits[1])
+            return ("".join(REGISTER_CHARS[reg_ids]), reg_conf), ("".join(SUBJECT_CHARS[sub_ids]), sub_conf)
+        except Exception as e:
+            logger.warning(f"Parallel CRNN inference failed, running sequentially: {e}")
+            return self._extract_register_number(reg_crop), self._extract_subject_code(sub_crop)
+
     # ------------------------------------------------------------------
     # Public API
     # ------------------------------------------------------------------
@@ -302,7 +554,12 @@ class AnswerSheetExtractor:
         """
         Run the full pipeline on a single OpenCV image (BGR).
         Returns dict with register_number, subject_code, and confidence scores.
+        Safe to call from several threads; inference runs one page at a time.
         """
+        with self._inference_lock:
+            return self._extract_from_image(image)
+
+    def _extract_from_image(self, image: np.ndarray) -> dict:
         reg_regions, sub_regions = self._detect_regions(image)
 
         register_number = ""
@@ -311,17 +568,24 @@ class AnswerSheetExtractor:
         subject_confidence = 0.0
 
         # Best register region by detection confidence
-        if reg_regions:
-            best_crop = max(reg_regions, key=lambda x: x[1])[0]
-            register_number, register_confidence = self._extract_register_number(best_crop)
+        best_crop = max(reg_regions, key=lambda x: x[1])[0] if reg_regions else None
 
         # Subject code: if >=2 regions, pick the second (matches training heuristic)
+        chosen = None
         if sub_regions:
             if len(sub_regions) >= 2:
                 chosen = sub_regions[1][0]
             else:
                 chosen = sub_regions[0][0]
-            subject_code, subject_confidence = self._extract_subject_code(chosen)
+
+        if best_crop is not None and chosen is not None and self.crnn_streams is not None:
+            (register_number, register_confidence), (subject_code, subject_confidence) = \
+                self._extract_on_streams(best_crop, chosen)
+        else:
+            if best_crop is not None:
+                register_number, register_confidence = self._extract_register_number(best_crop)
+            if chosen is not None:
+                subject_code, subject_confidence = self._extract_subject_code(chosen)
 
         return {
             "register_number": register_number,
@@ -339,45 +603,33 @@ class AnswerSheetExtractor:
         Run extraction on a file (image or PDF).
         For PDFs, only the first page is processed.
         """
-        ext = Path(file_path).suffix.lower()
+        return self._extract_from_source(file_path, Path(file_path).suffix.lower(), file_path)
 
+    def extract_from_bytes(self, data: bytes, filename: str) -> dict:
+        """
+        Run extraction on raw file bytes, decoded in memory
+        (no temp file round-trip).
+        """
+        ext = Path(filename).suffix.lower() or ".pdf"
+        return self._extract_from_source(data, ext, filename)
+
+    def _extract_from_source(self, source: "str | bytes", ext: str, name: str) -> dict:
+        """Decode a file path or raw bytes by extension and run the pipeline."""
         if ext == ".pdf":
             # Convert first page to image
             try:
-                from pdf2image import convert_from_path
-                images = convert_from_path(file_path, dpi=300, first_page=1, last_page=1)
-                if not images:
-                    return {"error": "Could not convert PDF to image"}
-                # PIL gives RGB, convert to BGR numpy for YOLO
-                image = np.array(images[0])[:, :, ::-1]
+                image = _render_pdf_first_page(source)
             except ImportError:
-                return {"error": "pdf2image not installed — cannot process PDFs"}
+                return {"error": "PyMuPDF or pdf2image required — cannot process PDFs"}
             except Exception as e:
                 return {"error": f"PDF conversion failed: {e}"}
         elif ext in (".jpg", ".jpeg", ".png", ".bmp", ".tiff"):
             # Load image with PIL, convert RGB→BGR numpy for YOLO
-            image = np.array(Image.open(file_path).convert("RGB"))[:, :, ::-1]
+            fp = io.BytesIO(source) if isinstance(source, bytes) else source
+            image = np.ascontiguousarray(np.asarray(Image.open(fp).convert("RGB"))[:, :, ::-1])
             if image is None or image.size == 0:
-                return {"error": f"Could not read image: {file_path}"}
+                return {"error": f"Could not read image: {name}"}
         else:
             return {"error": f"Unsupported file type: {ext}"}
 
         return self.extract_from_image(image)
-
-    def extract_from_bytes(self, data: bytes, filename: str) -> dict:
-        """
-        Run extraction on raw file bytes.
-        Writes to a temp file, processes, then cleans up.
-        """
-        ext = Path(filename).suffix.lower() or ".pdf"
-        with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
-            tmp.write(data)
-            tmp_path = tmp.name
-
-        try:
-            return self.extract_from_file(tmp_path)
-        finally:
-            try:
-                os.unlink(tmp_path)
-            except OSError:
-                pass
@@ -6,18 +6,33 @@ Handles email notifications via SendGrid (HTTP API) or SMTP fallback.
 import asyncio
 import logging
 import smtplib
-from datetime import datetime
+import threading
+from datetime import datetime, timezone
 from email.message import EmailMessage
-from typing import Optional, Tuple
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
 from app.core.config import settings
 
+if TYPE_CHECKING:
+    import httpx
+
 logger = logging.getLogger(__name__)
 
+SENDGRID_BASE_URL = "https://api.sendgrid.com"
+SENDGRID_SEND_PATH = "/v3/mail/send"
+
 
 class MailService:
     """Service for sending outbound emails via SendGrid or SMTP."""
 
+    def __init__(self):
+        # One long-lived SMTP session, shared by the worker threads that send
+        # mail; the lock serializes use of the connection
+        self._smtp_conn: Optional[smtplib.SMTP] = None
+        self._smtp_lock = threading.Lock()
+        # Keep-alive HTTP client for SendGrid, created on first use
+        self._sendgrid_client: Optional["httpx.AsyncClient"] = None
+
     def is_configured(self) -> bool:
         """Return True when email sending is configured (SendGrid or SMTP)."""
         # Prefer SendGrid (works from cloud platforms)
@@ -58,26 +73,16 @@ class MailService:
         if not recipient_email:
             return False, "Recipient email not available"
 
-        display_name = recipient_name or "Student"
-        paper_title = subject_name or subject_code
-        uploaded_at_text = (uploaded_at or datetime.utcnow()).strftime("%d %b %Y, %I:%M %p UTC")
-
-        subject = f"[{exam_type}] Paper Uploaded - {subject_code}"
-        body = (
-            f"Hello {display_name},\n\n"
-            f"A paper has been uploaded to your student portal.\n\n"
-            f"Details:\n"
-            f"- Exam Type: {exam_type}\n"
-            f"- Subject Code: {subject_code}\n"
-            f"- Subject Name: {paper_title}\n"
-            f"- Exam Session: {exam_session or 'Not specified'}\n"
-            f"- File: {filename}\n"
-            f"- Uploaded By: {uploaded_by}\n"
-            f"- Uploaded At: {uploaded_at_text}\n"
-            f"- Register Number: {register_number}\n\n"
-            f"Please login to the student portal to review and submit the paper.\n\n"
-            f"Regards,\n"
-            f"{settings.email_from_name}"
+        subject, body, display_name = self._compose_upload_notification(
+            recipient_name=recipient_name,
+            register_number=register_number,
+            subject_code=subject_code,
+            subject_name=subject_name,
+            exam_type=exam_type,
+            exam_session=exam_session,
+            filename=filename,
+            uploaded_by=uploaded_by,
+            uploaded_at=uploaded_at,
         )
 
         # Try SendGrid first (works from cloud platforms)
@@ -109,12 +114,120 @@ class MailService:
 
         return False, "No email backend available"
 
+    @staticmethod
+    def _compose_upload_notification(
+        *,
+        recipient_name: Optional[str],
+        register_number: str,
+        subject_code: str,
+        subject_name: Optional[str],
+        exam_type: str,
+        exam_session: Optional[str],
+        filename: str,
+        uploaded_by: str,
+        uploaded_at: Optional[datetime] = None,
+    ) -> Tuple[str, str, str]:
+        """Build (subject, body, display_name) for an upload notification."""
+        display_name = recipient_name or "Student"
+        paper_title = subject_name or subject_code
+        uploaded_at = uploaded_at or datetime.now(timezone.utc)
+        if uploaded_at.tzinfo is None:
+            # Naive timestamps in this app are UTC
+            uploaded_at = uploaded_at.replace(tzinfo=timezone.utc)
+        uploaded_at_text = uploaded_at.astimezone(timezone.utc).strftime("%d %b %Y, %I:%M %p UTC")
+
+        subject = f"[{exam_type}] Paper Uploaded - {subject_code}"
+        body = (
+            f"Hello {display_name},\n\n"
+            f"A paper has been uploaded to your student portal.\n\n"
+            f"Details:\n"
+            f"- Exam Type: {exam_type}\n"
+            f"- Subject Code: {subject_code}\n"
+            f"- Subject Name: {paper_title}\n"
+            f"- Exam Session: {exam_session or 'Not specified'}\n"
+            f"- File: {filename}\n"
+            f"- Uploaded By: {uploaded_by}\n"
+            f"- Uploaded At: {uploaded_at_text}\n"
+            f"- Register Number: {register_number}\n\n"
+            f"Please login to the student portal to review and submit the paper.\n\n"
+            f"Regards,\n"
+            f"{settings.email_from_name}"
+        )
+        return subject, body, display_name
+
+    async def send_student_upload_notifications(
+        self, notifications: List[Dict[str, Any]]
+    ) -> List[Tuple[bool, str]]:
+        """
+        Send several upload notifications over one connection.
+
+        Each item holds the keyword arguments of send_student_upload_notification.
+        SendGrid requests reuse the keep-alive HTTP client; SMTP messages are
+        sent in one worker-thread hop. Returns one (sent, message) tuple per item, in order.
+        """
+        if not self.is_configured():
+            return [(False, "Email service not configured")] * len(notifications)
+
+        results: List[Tuple[bool, str]] = [(False, "Recipient email not available")] * len(notifications)
+        outgoing = []  # (index, to_email, display_name, subject, body)
+        for index, item in enumerate(notifications):
+            fields = dict(item)
+            recipient_email = fields.pop("recipient_email", None)
+            if not recipient_email:
+                continue
+            subject, body, display_name = self._compose_upload_notification(**fields)
+            outgoing.append((index, recipient_email, display_name, subject, body))
+
+        if not outgoing:
+            return results
+
+        if settings.sendgrid_api_key:
+            for index, to_email, display_name, subject, body in outgoing:
+                try:
+                    results[index] = await self._send_via_sendgrid(
+                        to_email=to_email,
+                        to_name=display_name,
+                        subject=subject,
+                        body=body,
+                    )
+                except Exception as exc:
+                    logger.error("SendGrid send failed: %s", exc)
+                    results[index] = (False, f"SendGrid error: {exc}")
+            return results
+
+        if settings.smtp_enabled and settings.smtp_host:
+            messages = [
+                self._build_smtp_message(to_email, subject, body)
+                for _, to_email, _, subject, body in outgoing
+            ]
+            try:
+                sent = await asyncio.to_thread(self._send_messages_sync, messages)
+            except Exception as exc:
+                logger.error("SMTP bulk send failed: %s", exc)
+                sent = [(False, f"SMTP error: {exc}")] * len(messages)
+            for (index, *_), outcome in zip(outgoing, sent):
+                results[index] = outcome
+            return results
+
+        return [(False, "No email backend available")] * len(notifications)
+
+    def _get_sendgrid_client(self) -> "httpx.AsyncClient":
+        """Get or create the keep-alive SendGrid HTTP client."""
+        import httpx
+
+        if self._sendgrid_client is None or self._sendgrid_client.is_closed:
+            self._sendgrid_client = httpx.AsyncClient(
+                base_url=SENDGRID_BASE_URL,
+                headers={"Authorization": f"Bearer {settings.sendgrid_api_key}"},
+                timeout=20,
+                limits=httpx.Limits(max_keepalive_connections=10),
+            )
+        return self._sendgrid_client
+
     async def _send_via_sendgrid(
         self, to_email: str, to_name: str, subject: str, body: str
     ) -> Tuple[bool, str]:
         """Send email via SendGrid v3 REST API using httpx (no extra library)."""
-        import httpx
-
         sender_email = settings.email_sender_email
         if not sender_email:
             return False, "EMAIL_FROM_EMAIL (or SMTP_FROM_EMAIL) is not set — cannot send via SendGrid"
@@ -133,17 +246,7 @@ class MailService:
             "content": [{"type": "text/plain", "value": body}],
         }
 
-        headers = {
-            "Authorization": f"Bearer {settings.sendgrid_api_key}",
-            "Content-Type": "application/json",
-        }
-
-        async with httpx.AsyncClient(timeout=20) as client:
-            response = await client.post(
-                "https://api.sendgrid.com/v3/mail/send",
-                json=payload,
-                headers=headers,
-            )
+        response = await self._get_sendgrid_client().post(SENDGRID_SEND_PATH, json=payload)
 
         if response.status_code in (200, 201, 202):
             logger.info("SendGrid email sent to %s (status: %s)", to_email, response.status_code)
@@ -163,30 +266,87 @@ class MailService:
         self, to_email: str, to_name: str, subject: str, body: str
     ) -> Tuple[bool, str]:
         """Send email via SMTP (fallback for local dev)."""
+        email_message = self._build_smtp_message(to_email, subject, body)
+        await asyncio.to_thread(self._send_message_sync, email_message)
+        return True, "Notification sent"
+
+    @staticmethod
+    def _build_smtp_message(to_email: str, subject: str, body: str) -> EmailMessage:
         email_message = EmailMessage()
         email_message["From"] = f"{settings.smtp_from_name} <{settings.smtp_sender_email}>"
         email_message["To"] = to_email
         email_message["Subject"] = subject
         email_message.set_content(body)
+        return email_message
 
-        await asyncio.to_thread(self._send_message_sync, email_message)
-        return True, "Notification sent"
+    @staticmethod
+    def _open_smtp() -> smtplib.SMTP:
+        """Connect (and log in) to the configured SMTP server."""
+        if settings.smtp_use_ssl:
+            server = smtplib.SMTP_SSL(settings.smtp_host, settings.smtp_port, timeout=20)
+        else:
+            server = smtplib.SMTP(settings.smtp_host, settings.smtp_port, timeout=20)
+            if settings.smtp_use_tls:
+                server.starttls()
+        if settings.smtp_username and settings.smtp_password:
+            server.login(settings.smtp_username, settings.smtp_password)
+        return server
+
+    def _smtp_connection(self) -> smtplib.SMTP:
+        """Return the shared SMTP session, reconnecting if it went stale. Hold _smtp_lock."""
+        if self._smtp_conn is not None:
+            try:
+                self._smtp_conn.noop()
+                return self._smtp_conn
+            except (smtplib.SMTPException, OSError):
+                self._drop_smtp()
+        self._smtp_conn = self._open_smtp()
+        return self._smtp_conn
+
+    def _drop_smtp(self) -> None:
+        """Close the shared SMTP session, ignoring errors. Hold _smtp_lock."""
+        server, self._smtp_conn = self._smtp_conn, None
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+    def _send_on_shared_connection(self, message: EmailMessage) -> None:
+        """Send one message on the shared session, reconnecting once if it was dropped."""
+        try:
+            self._smtp_connection().send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            self._drop_smtp()
+            self._smtp_connection().send_message(message)
+
+    def _close_smtp(self) -> None:
+        with self._smtp_lock:
+            self._drop_smtp()
+
+    async def close(self) -> None:
+        """Close the SendGrid client and the shared SMTP session (application shutdown)."""
+        if self._sendgrid_client is not None and not self._sendgrid_client.is_closed:
+            await self._sendgrid_client.aclose()
+        await asyncio.to_thread(self._close_smtp)
 
     def _send_message_sync(self, message: EmailMessage) -> None:
         """Blocking SMTP send, executed in a worker thread."""
-        if settings.smtp_use_ssl:
-            with smtplib.SMTP_SSL(settings.smtp_host, settings.smtp_port, timeout=20) as server:
-                if settings.smtp_username and settings.smtp_password:
-                    server.login(settings.smtp_username, settings.smtp_password)
-                server.send_message(message)
-            return
+        with self._smtp_lock:
+            self._send_on_shared_connection(message)
 
-        with smtplib.SMTP(settings.smtp_host, settings.smtp_port, timeout=20) as server:
-            if settings.smtp_use_tls:
-                server.starttls()
-            if settings.smtp_username and settings.smtp_password:
-                server.login(settings.smtp_username, settings.smtp_password)
-            server.send_message(message)
+    def _send_messages_sync(self, messages: List[EmailMessage]) -> List[Tuple[bool, str]]:
+        """Blocking SMTP send of several messages over the shared session."""
+        results: List[Tuple[bool, str]] = []
+        with self._smtp_lock:
+            for message in messages:
+                try:
+                    self._send_on_shared_connection(message)
+                    results.append((True, "Notification sent"))
+                except (smtplib.SMTPException, OSError) as exc:
+                    logger.error("SMTP send to %s failed: %s", message["To"], exc)
+                    results.append((False, f"SMTP error: {exc}"))
+        return results
 
 
 mail_service = MailService()
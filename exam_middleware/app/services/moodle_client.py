@@ -67,6 +67,7 @@ class MoodleClient:
             self._client = httpx.AsyncClient(
                 timeout=self.timeout,
                 follow_redirects=True,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
                 headers={
                     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
                     "Accept": "application/json",
@@ -0,0 +1,90 @@
+"""
+Moodle User Cache
+Short-lived in-process cache of Moodle user profiles (email, full name)
+used to address student notifications.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from app.core.config import settings
+from app.services.moodle_client import MoodleAPIError, moodle_client
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_TTL_SECONDS = 900
+USER_CACHE_MAX_ENTRIES = 10_000
+
+_cache: Dict[str, Tuple[float, Dict[str, Optional[str]]]] = {}  # username -> (expires_at, profile)
+# username -> lookup in progress; each entry removes itself when it finishes
+_inflight: Dict[str, asyncio.Task] = {}
+
+
+async def get_cached_user(username: str) -> Optional[Dict[str, Optional[str]]]:
+    """
+    Return {"email", "fullname"} for a Moodle username.
+
+    Served from the cache while fresh; concurrent misses for the same
+    username share one Moodle request. Returns None when the user is not
+    found or the lookup fails (neither is cached).
+    """
+    profile = _get_fresh(username)
+    if profile is not None:
+        return profile
+
+    task = _inflight.get(username)
+    if task is None:
+        task = asyncio.create_task(_fetch_and_store(username))
+        _inflight[username] = task
+        task.add_done_callback(lambda _: _inflight.pop(username, None))
+    # Shielded so one cancelled caller doesn't cancel the lookup for the rest
+    return await asyncio.shield(task)
+
+
+def invalidate_cached_user(username: Optional[str] = None) -> None:
+    """Drop one cached profile, or all of them when no username is given."""
+    if username is None:
+        _cache.clear()
+    else:
+        _cache.pop(username, None)
+
+
+def _get_fresh(username: str) -> Optional[Dict[str, Optional[str]]]:
+    entry = _cache.get(username)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def _evict() -> None:
+    """Drop expired entries; if still full, drop the oldest insertions."""
+    now = time.monotonic()
+    for key in [k for k, (expires_at, _) in _cache.items() if expires_at <= now]:
+        del _cache[key]
+    while len(_cache) >= USER_CACHE_MAX_ENTRIES:
+        del _cache[next(iter(_cache))]
+
+
+async def _fetch_and_store(username: str) -> Optional[Dict[str, Optional[str]]]:
+    profile = await _fetch_user(username)
+    if profile is not None:
+        if len(_cache) >= USER_CACHE_MAX_ENTRIES:
+            _evict()
+        _cache[username] = (time.monotonic() + USER_CACHE_TTL_SECONDS, profile)
+    return profile
+
+
+async def _fetch_user(username: str) -> Optional[Dict[str, Optional[str]]]:
+    # Shared client: keeps its keep-alive connections to Moodle across lookups
+    try:
+        user_data = await moodle_client.get_user_by_username(username, token=settings.moodle_admin_token)
+        if not user_data:
+            return None
+        return {"email": user_data.get("email"), "fullname": user_data.get("fullname")}
+    except MoodleAPIError as exc:
+        logger.warning("Failed to fetch Moodle user/email for %s: %s", username, exc)
+    except Exception as exc:
+        logger.error("Unexpected error during Moodle user lookup for %s: %s", username, exc)
+    return None
@@ -3,28 +3,37 @@ Notification Service
 Coordinates student notifications for artifact lifecycle events.
 """
 
+import asyncio
 import logging
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
 
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import defer
 
 from app.core.config import settings
-from app.db.models import ExaminationArtifact, StudentUsernameRegister
-from app.services.artifact_service import AuditService, SubjectMappingService
+from app.db.database import async_session_maker
+from app.db.models import ExaminationArtifact
+from app.services.batching import BatchWorker
+from app.services.artifact_service import AuditService, SubjectMappingInfo, SubjectMappingService
 from app.services.mail_service import mail_service
-from app.services.moodle_client import MoodleAPIError, MoodleClient
+from app.services import username_map_cache
+from app.services.moodle_user_cache import get_cached_user
 
 logger = logging.getLogger(__name__)
 
+# Concurrent Moodle profile lookups when notifying a batch of students
+MOODLE_LOOKUP_CONCURRENCY = 8
+
 
 class NotificationService:
     """Service for dispatching upload notifications to students."""
 
     def __init__(self, db: AsyncSession):
         self.db = db
-        self.audit_service = AuditService(db)
+        # Notification audits are best-effort; write them in batches
+        self.audit_service = AuditService(db, deferred=True)
         self.mapping_service = SubjectMappingService(db)
 
     async def notify_student_on_upload(
@@ -52,6 +61,93 @@ class NotificationService:
                 getattr(artifact, 'id', '?'), exc,
             )
 
+    async def notify_students_on_upload(
+        self,
+        artifacts: List[ExaminationArtifact],
+        uploaded_by_username: str,
+        actor_ip: Optional[str] = None,
+    ) -> None:
+        """
+        Notify the students of several uploaded papers (bulk upload).
+
+        Same best-effort contract as notify_student_on_upload, but username
+        and subject mappings are fetched with one query each, Moodle profiles
+        are looked up concurrently, and the emails go out through one mail
+        connection instead of one per artifact.
+        """
+        username_lookup: Optional[Dict[str, str]] = None
+        mapping_lookup: Optional[Dict[tuple, Any]] = None
+        try:
+            if mail_service.is_configured():
+                username_lookup, mapping_lookup = await self._prefetch_lookups(artifacts)
+        except Exception as exc:
+            # Fall back to per-artifact lookups
+            logger.error("Bulk notification prefetch failed: %s", exc)
+
+        pending = []  # (artifact, mail kwargs)
+        for artifact in artifacts:
+            try:
+                notification = await self._prepare_upload_notification(
+                    artifact=artifact,
+                    uploaded_by_username=uploaded_by_username,
+                    actor_ip=actor_ip,
+                    username_lookup=username_lookup,
+                    mapping_lookup=mapping_lookup,
+                )
+                if notification:
+                    pending.append((artifact, notification))
+            except Exception as exc:
+                logger.error(
+                    "Notification failed for artifact %s (best-effort, swallowed): %s",
+                    getattr(artifact, 'id', '?'), exc,
+                )
+
+        if not pending:
+            return
+
+        try:
+            outcomes = await mail_service.send_student_upload_notifications(
+                [notification for _, notification in pending]
+            )
+            for (artifact, notification), (sent, message) in zip(pending, outcomes):
+                await self._record_notification_result(
+                    artifact=artifact,
+                    recipient_email=notification["recipient_email"],
+                    sent=sent,
+                    message=message,
+                    actor_ip=actor_ip,
+                )
+        except Exception as exc:
+            logger.error("Bulk notification failed (best-effort, swallowed): %s", exc)
+
+    async def _prefetch_lookups(self, artifacts: List[ExaminationArtifact]) -> tuple:
+        """
+        Resolve register number → Moodle username (from the cached map) and
+        (subject_code, exam_type) → subject mapping for a batch in one query,
+        and warm the Moodle profile cache for the batch's students concurrently.
+        """
+        eligible = [a for a in artifacts if a.parsed_reg_no and a.parsed_subject_code]
+        if not eligible:
+            return {}, {}
+
+        username_lookup = await username_map_cache.resolve_many(
+            {a.parsed_reg_no for a in eligible}, self.db
+        )
+        mapping_lookup = await self.mapping_service.get_mappings(
+            [(a.parsed_subject_code, a.exam_type) for a in eligible]
+        )
+
+        if settings.moodle_admin_token and username_lookup:
+            slots = asyncio.Semaphore(MOODLE_LOOKUP_CONCURRENCY)
+
+            async def _warm(username: str) -> None:
+                async with slots:
+                    await get_cached_user(username)
+
+            await asyncio.gather(*(_warm(u) for u in set(username_lookup.values())))
+
+        return username_lookup, mapping_lookup
+
     async def _do_notify_student_on_upload(
         self,
         artifact: ExaminationArtifact,
@@ -59,21 +155,47 @@ class NotificationService:
         actor_ip: Optional[str] = None,
     ) -> None:
         """Internal implementation — exceptions propagate to caller wrapper."""
-        if not artifact.parsed_reg_no or not artifact.parsed_subject_code:
+        notification = await self._prepare_upload_notification(
+            artifact=artifact,
+            uploaded_by_username=uploaded_by_username,
+            actor_ip=actor_ip,
+        )
+        if not notification:
             return
 
-        if not mail_service.is_configured():
-            logger.debug("Skipping notification: email service not configured")
-            return
+        sent, message = await mail_service.send_student_upload_notification(**notification)
 
-        result = await self.db.execute(
-            select(StudentUsernameRegister).where(
-                StudentUsernameRegister.register_number == artifact.parsed_reg_no
-            )
+        await self._record_notification_result(
+            artifact=artifact,
+            recipient_email=notification["recipient_email"],
+            sent=sent,
+            message=message,
+            actor_ip=actor_ip,
         )
-        username_mapping = result.scalar_one_or_none()
 
-        if not username_mapping:
+    async def _prepare_upload_notification(
+        self,
+        artifact: ExaminationArtifact,
+        uploaded_by_username: str,
+        actor_ip: Optional[str] = None,
+        username_lookup: Optional[Dict[str, str]] = None,
+        mapping_lookup: Optional[Dict[tuple, Any]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Resolve recipient and subject details for an upload notification.
+        Returns mail_service keyword arguments, or None (audited) when skipped.
+
+        username_lookup / mapping_lookup are batch results from
+        _prefetch_lookups; without them each lookup is queried here.
+        """
+        if not artifact.parsed_reg_no or not artifact.parsed_subject_code:
+            return None
+
+        if not mail_service.is_configured():
+            logger.debug("Skipping notification: email service not configured")
+            return None
+
+        if not settings.moodle_admin_token:
             await self.audit_service.log_action(
                 action="student_notification_skipped",
                 action_category="notification",
@@ -81,13 +203,21 @@ class NotificationService:
                 actor_username="notification_service",
                 actor_ip=actor_ip,
                 artifact_id=artifact.id,
-                description=(
-                    f"No username mapping found for register number {artifact.parsed_reg_no}"
-                ),
+                description="Moodle admin token not configured for user-email lookup",
             )
-            return
+            return None
 
-        if not settings.moodle_admin_token:
+        if username_lookup is not None and mapping_lookup is not None:
+            moodle_username = username_lookup.get(artifact.parsed_reg_no)
+            subject_mapping = mapping_lookup.get((artifact.parsed_subject_code.upper(), artifact.exam_type))
+            # Profiles were warmed by _prefetch_lookups, so this is a cache hit
+            user_data = await get_cached_user(moodle_username) if moodle_username else None
+        else:
+            moodle_username, user_data, subject_mapping = await self._lookup_recipient_and_subject(
+                artifact.parsed_reg_no, artifact.parsed_subject_code, artifact.exam_type
+            )
+
+        if not moodle_username:
             await self.audit_service.log_action(
                 action="student_notification_skipped",
                 action_category="notification",
@@ -95,26 +225,15 @@ class NotificationService:
                 actor_username="notification_service",
                 actor_ip=actor_ip,
                 artifact_id=artifact.id,
-                description="Moodle admin token not configured for user-email lookup",
+                description=(
+                    f"No username mapping found for register number {artifact.parsed_reg_no}"
+                ),
             )
-            return
+            return None
 
-        moodle_username = username_mapping.moodle_username
-
-        recipient_email = None
-        recipient_name = None
-        client = MoodleClient(token=settings.moodle_admin_token)
-        try:
-            user_data = await client.get_user_by_username(moodle_username)
-            if user_data:
-                recipient_email = user_data.get("email")
-                recipient_name = user_data.get("fullname")
-        except MoodleAPIError as exc:
-            logger.warning("Failed to fetch Moodle user/email for %s: %s", moodle_username, exc)
-        except Exception as exc:
-            logger.error("Unexpected error during Moodle user lookup for %s: %s", moodle_username, exc)
-        finally:
-            await client.close()
+        user_data = user_data or {}
+        recipient_email = user_data.get("email")
+        recipient_name = user_data.get("fullname")
 
         if not recipient_email:
             await self.audit_service.log_action(
@@ -126,14 +245,9 @@ class NotificationService:
                 artifact_id=artifact.id,
                 description=f"No email available in Moodle profile for user {moodle_username}",
             )
-            return
-
-        subject_mapping = await self.mapping_service.get_mapping(
-            artifact.parsed_subject_code,
-            artifact.exam_type,
-        )
+            return None
 
-        sent, message = await mail_service.send_student_upload_notification(
+        return dict(
             recipient_email=recipient_email,
             recipient_name=recipient_name,
             register_number=artifact.parsed_reg_no,
@@ -146,6 +260,36 @@ class NotificationService:
             uploaded_at=artifact.uploaded_at,
         )
 
+    async def _lookup_recipient_and_subject(
+        self, register_number: str, subject_code: str, exam_type: str
+    ) -> Tuple[Optional[str], Optional[Dict[str, Optional[str]]], Optional[SubjectMappingInfo]]:
+        """
+        Resolve (moodle_username, Moodle profile, subject mapping).
+
+        The username comes from the cached username map; the Moodle profile
+        lookup (HTTP) and the subject mapping query (DB) are independent, so
+        they run concurrently. All three are None when the register number
+        has no username mapping.
+        """
+        moodle_username = await username_map_cache.resolve(register_number, self.db)
+        if not moodle_username:
+            return None, None, None
+
+        user_data, subject_mapping = await asyncio.gather(
+            get_cached_user(moodle_username),
+            self.mapping_service.get_mapping(subject_code, exam_type),
+        )
+        return moodle_username, user_data, subject_mapping
+
+    async def _record_notification_result(
+        self,
+        artifact: ExaminationArtifact,
+        recipient_email: str,
+        sent: bool,
+        message: str,
+        actor_ip: Optional[str] = None,
+    ) -> None:
+        """Audit the outcome of a notification send."""
         if sent:
             await self.audit_service.log_action(
                 action="student_notification_sent",
@@ -195,35 +339,21 @@ class NotificationService:
                 "message": "Moodle admin token not configured",
             }
 
-        result = await self.db.execute(
-            select(StudentUsernameRegister).where(
-                StudentUsernameRegister.register_number == register_number
-            )
+        moodle_username, user_data, subject_mapping = await self._lookup_recipient_and_subject(
+            register_number, subject_code, exam_type
         )
-        username_mapping = result.scalar_one_or_none()
 
-        if not username_mapping:
+        if not moodle_username:
             return {
                 "success": False,
                 "message": f"No username mapping found for register number {register_number}",
             }
 
-        moodle_username = username_mapping.moodle_username
-
-        recipient_email = None
-        recipient_name = None
-        client = MoodleClient(token=settings.moodle_admin_token)
-        try:
-            user_data = await client.get_user_by_username(moodle_username)
-            if user_data:
-                recipient_email = user_data.get("email")
-                recipient_name = user_data.get("fullname")
-        except MoodleAPIError as exc:
-            logger.warning("Failed to fetch Moodle user/email for %s: %s", moodle_username, exc)
-        except Exception as exc:
-            logger.error("Unexpected error during Moodle user lookup for %s: %s", moodle_username, exc)
-        finally:
-            await client.close()
+        user_data = user_data or {}
+        recipient_email = user_data.get("email")
+        recipient_name = user_data.get("fullname")
+        subject_name = subject_mapping.subject_name if subject_mapping else None
+        exam_session = subject_mapping.exam_session if subject_mapping else None
 
         if not recipient_email:
             return {
@@ -231,19 +361,17 @@ class NotificationService:
                 "message": f"No email available in Moodle profile for user {moodle_username}",
             }
 
-        subject_mapping = await self.mapping_service.get_mapping(subject_code, exam_type)
-
         sent, message = await mail_service.send_student_upload_notification(
             recipient_email=recipient_email,
             recipient_name=recipient_name,
             register_number=register_number,
             subject_code=subject_code,
-            subject_name=subject_mapping.subject_name if subject_mapping else None,
+            subject_name=subject_name,
             exam_type=exam_type,
-            exam_session=subject_mapping.exam_session if subject_mapping else None,
+            exam_session=exam_session,
             filename=filename,
             uploaded_by=uploaded_by_username,
-            uploaded_at=datetime.utcnow(),
+            uploaded_at=datetime.now(timezone.utc),
         )
 
         return {
@@ -251,6 +379,66 @@ class NotificationService:
             "message": message,
             "recipient_email": recipient_email,
             "moodle_username": moodle_username,
-            "subject_name": subject_mapping.subject_name if subject_mapping else None,
-            "exam_session": subject_mapping.exam_session if subject_mapping else None,
+            "subject_name": subject_name,
+            "exam_session": exam_session,
         }
+
+
+class UploadNotificationQueue(BatchWorker):
+    """
+    In-process queue for upload notifications.
+
+    Upload routes enqueue artifact ids and return straight away. A worker
+    started in the app lifespan drains the queue in small batches (up to
+    BATCH_SIZE items or BATCH_WINDOW_SECONDS) so each batch shares one mail
+    connection, across requests as well as within a bulk upload.
+    """
+
+    BATCH_SIZE = 20
+    BATCH_WINDOW_SECONDS = 2.0
+
+    def enqueue(
+        self,
+        artifact_id: int,
+        uploaded_by_username: str,
+        actor_ip: Optional[str] = None,
+    ) -> None:
+        """Queue a student notification for an uploaded artifact."""
+        if not mail_service.is_configured():
+            # Delivery would skip it anyway; don't load the artifact for nothing
+            return
+        self._submit((artifact_id, uploaded_by_username, actor_ip))
+
+    async def _process_batch(self, batch: List[tuple]) -> None:
+        await self._deliver(batch)
+
+    async def _deliver(self, batch: List[tuple]) -> None:
+        """Notify a batch, one DB session and mail connection per uploader."""
+        groups: Dict[tuple, List[int]] = {}
+        for artifact_id, uploaded_by_username, actor_ip in batch:
+            groups.setdefault((uploaded_by_username, actor_ip), []).append(artifact_id)
+
+        for (uploaded_by_username, actor_ip), artifact_ids in groups.items():
+            try:
+                async with async_session_maker() as session:
+                    # The emails never touch the uploaded bytes; don't load them
+                    result = await session.execute(
+                        select(ExaminationArtifact)
+                        .options(defer(ExaminationArtifact.file_content))
+                        .where(ExaminationArtifact.id.in_(artifact_ids))
+                    )
+                    artifacts = list(result.scalars().all())
+                    if artifacts:
+                        await NotificationService(session).notify_students_on_upload(
+                            artifacts=artifacts,
+                            uploaded_by_username=uploaded_by_username,
+                            actor_ip=actor_ip,
+                        )
+                        await session.commit()
+            except Exception as exc:
+                logger.error(
+                    "Background notification failed for artifacts %s: %s", artifact_ids, exc
+                )
+
+
+upload_notification_queue = UploadNotificationQueue()
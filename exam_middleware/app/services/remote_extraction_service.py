@@ -6,39 +6,161 @@ and offloads computation to HF Spaces (which can have GPU).
 Falls back to local extraction if HF_SPACE_URL is not configured.
 """
 
+import asyncio
+import hashlib
 import os
 import logging
-import io
+import mimetypes
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Dict, Optional
 
 import httpx
 import structlog
 
+from app.core.config import settings
+
+if TYPE_CHECKING:
+    from app.services.extraction_service import AnswerSheetExtractor
+
 logger = structlog.get_logger(__name__)
 
 # HF Space configuration
 HF_SPACE_URL = os.getenv("HF_SPACE_URL", "").strip()
 EXTRACT_ENDPOINT = f"{HF_SPACE_URL}/extract" if HF_SPACE_URL else None
 HEALTH_ENDPOINT = f"{HF_SPACE_URL}/health" if HF_SPACE_URL else None
+# HF_SPACE_URL is read once at import, so the mode is fixed for the process
+EXTRACTOR_MODE = "remote" if EXTRACT_ENDPOINT else "local"
 
 # Request timeout (HF Spaces can be slow if waking up from sleep)
 REQUEST_TIMEOUT = 300  # 5 minutes
+HEALTH_TIMEOUT = 10
+HEALTH_CACHE_TTL_SECONDS = 30
+# Longest response body / error text written to the log
+LOG_BODY_LIMIT = 512
+
+# Local model load and inference run on one dedicated thread: the extractor
+# is a process-wide singleton, so concurrent fallbacks queue here instead of
+# sharing it, and sync routes keep the default pool to themselves
+_local_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-extraction")
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing remote for a while.
+
+    After `fail_max` consecutive failures the breaker opens and calls are
+    skipped for `reset_timeout` seconds; then one trial call is let through
+    (half-open). Its success closes the breaker, its failure re-opens it.
+    """
+
+    def __init__(self, fail_max: int = 3, reset_timeout: float = 60.0):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Whether a call may go out now."""
+        state = self.state
+        if state == "half_open":
+            # Let this one trial through; others keep skipping until it reports
+            self.opened_at = time.monotonic()
+            return True
+        return state == "closed"
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.fail_max or self.opened_at is not None:
+            self.trip()
+
+    def trip(self) -> None:
+        """Open the breaker now."""
+        self.opened_at = time.monotonic()
+
+    def reset(self) -> None:
+        """Close the breaker (manual override)."""
+        self.record_success()
+
+
+hf_breaker = CircuitBreaker(fail_max=3, reset_timeout=60)
+
+# Shared keep-alive client for all HF Space calls, created on first use
+_hf_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_hf_client() -> httpx.AsyncClient:
+    """Get or create the HF Space HTTP client."""
+    global _hf_client
+    if _hf_client is None or _hf_client.is_closed:
+        _hf_client = httpx.AsyncClient(
+            timeout=REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_keepalive_connections=10),
+        )
+    return _hf_client
+
+
+async def close_hf_client() -> None:
+    """Close the HF Space HTTP client (application shutdown)."""
+    if _hf_client is not None and not _hf_client.is_closed:
+        await _hf_client.aclose()
+
+
+_health_cache: Optional[tuple] = None  # (expires_at, healthy)
+_health_probe: Optional[asyncio.Task] = None
 
 
 async def check_hf_space_health() -> bool:
-    """Check if HF Space API is available."""
+    """
+    Check if HF Space API is available.
+
+    The result is cached for HEALTH_CACHE_TTL_SECONDS, and concurrent callers
+    share one in-flight probe instead of each sending their own.
+    """
+    global _health_probe
     if not HEALTH_ENDPOINT:
         logger.warning("HF_SPACE_URL not configured — using local extraction")
         return False
 
-    import asyncio
+    if _health_cache and _health_cache[0] > time.monotonic():
+        return _health_cache[1]
+
+    if _health_probe is None or _health_probe.done():
+        _health_probe = asyncio.create_task(_probe_hf_space_health())
+    # shield: a cancelled caller must not cancel the probe others await
+    return await asyncio.shield(_health_probe)
+
+
+async def _probe_hf_space_health() -> bool:
+    global _health_cache
+    healthy = await _request_hf_space_health()
+    _health_cache = (time.monotonic() + HEALTH_CACHE_TTL_SECONDS, healthy)
+    if healthy:
+        hf_breaker.record_success()
+    else:
+        hf_breaker.trip()
+    return healthy
+
+
+async def _request_hf_space_health() -> bool:
     for attempt in range(3):
         try:
-            async with httpx.AsyncClient(timeout=10) as client:
-                resp = await client.get(HEALTH_ENDPOINT)
-                if resp.status_code == 200:
-                    return True
+            resp = await _get_hf_client().get(HEALTH_ENDPOINT, timeout=HEALTH_TIMEOUT)
+            if resp.status_code == 200:
+                return True
         except Exception as e:
             logger.warning(f"HF Space health check failed (attempt {attempt + 1})", error=str(e))
         
@@ -54,40 +176,50 @@ async def extract_from_hf_space(file_bytes: bytes, filename: str) -> dict:
         return {"success": False, "error": "HF_SPACE_URL not configured"}
 
     try:
-        async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-            files = {"file": (filename, io.BytesIO(file_bytes))}
-            resp = await client.post(EXTRACT_ENDPOINT, files=files)
+        # Raw bytes go into the multipart body as-is (no BytesIO wrapper copy)
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        files = {"file": (filename, file_bytes, content_type)}
+        resp = await _get_hf_client().post(EXTRACT_ENDPOINT, files=files)
 
-            if resp.status_code == 200:
-                return resp.json()
-            else:
-                logger.error("HF Space extraction failed", status=resp.status_code, text=resp.text)
-                return {"success": False, "error": f"HF Space error: {resp.status_code}"}
+        if resp.status_code == 200:
+            hf_breaker.record_success()
+            return resp.json()
+        else:
+            hf_breaker.record_failure()
+            # Only decode a prefix: error bodies can be large HTML pages
+            logger.error(
+                "HF Space extraction failed",
+                status=resp.status_code,
+                text=resp.content[:LOG_BODY_LIMIT].decode("utf-8", errors="replace"),
+            )
+            return {"success": False, "error": f"HF Space error: {resp.status_code}"}
     except httpx.ReadTimeout:
+        hf_breaker.record_failure()
         logger.warning("HF Space request timeout")
         return {"success": False, "error": "Extraction service timeout"}
     except Exception as e:
+        hf_breaker.record_failure()
         logger.error("HF Space extraction error", error=str(e))
         return {"success": False, "error": str(e)}
 
 
 def get_extractor_mode() -> str:
     """Return whether we're using 'remote' (HF) or 'local' extraction."""
-    if EXTRACT_ENDPOINT and HF_SPACE_URL:
-        return "remote"
-    return "local"
+    return EXTRACTOR_MODE
 
 
 # ============================================================================
 # Fallback to local extraction if HF Space is not available
 # ============================================================================
 
-_local_extractor: Optional[object] = None
-_use_local_fallback = not bool(EXTRACT_ENDPOINT)
+_local_extractor: Optional["AnswerSheetExtractor"] = None
 
 
-def _get_local_extractor():
-    """Lazy load local extractor as fallback."""
+def _get_local_extractor() -> Optional["AnswerSheetExtractor"]:
+    """
+    Lazy load local extractor as fallback. Blocking (model load); concurrent
+    first callers are serialized by get_extractor's lock.
+    """
     global _local_extractor
     if _local_extractor is None:
         try:
@@ -100,12 +232,70 @@ def _get_local_extractor():
     return _local_extractor
 
 
+async def _run_local(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_local_executor, func, *args)
+
+
+async def warm_local_extractor() -> None:
+    """Load the local extractor off the event loop (app startup)."""
+    await _run_local(_get_local_extractor)
+
+
+EXTRACTION_CACHE_TTL_SECONDS = 3600
+EXTRACTION_CACHE_MAX_ENTRIES = 1024
+
+_extraction_cache: Dict[str, tuple] = {}  # content key -> (expires_at, result)
+_inflight_extractions: Dict[str, asyncio.Task] = {}
+
+
 async def extract_from_bytes_with_fallback(file_bytes: bytes, filename: str) -> dict:
     """
     Try HF Space first, fall back to local extraction if needed.
+
+    With settings.extraction_cache_enabled, byte-identical uploads reuse a
+    cached result and concurrent identical uploads share one extraction.
     """
-    # Try remote first
-    if EXTRACT_ENDPOINT:
+    if not settings.extraction_cache_enabled:
+        return await _extract_with_fallback(file_bytes, filename)
+
+    # Extension is part of the key: it decides how the bytes are decoded
+    key = hashlib.blake2b(file_bytes, digest_size=16).hexdigest() + Path(filename).suffix.lower()
+    entry = _extraction_cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        logger.info("Extraction served from content cache")
+        return dict(entry[1])
+
+    task = _inflight_extractions.get(key)
+    if task is None:
+        task = asyncio.create_task(_extract_with_fallback(file_bytes, filename))
+        _inflight_extractions[key] = task
+        task.add_done_callback(lambda t: _finish_extraction(key, t))
+    # shield: a cancelled caller must not cancel the extraction others await
+    return dict(await asyncio.shield(task))
+
+
+def _finish_extraction(key: str, task: asyncio.Task) -> None:
+    _inflight_extractions.pop(key, None)
+    if task.cancelled() or task.exception() is not None:
+        return
+    result = task.result()
+    # Only successful extractions are cached
+    if "error" in result or result.get("success") is False:
+        return
+    if len(_extraction_cache) >= EXTRACTION_CACHE_MAX_ENTRIES:
+        now = time.monotonic()
+        for stale in [k for k, (expires_at, _) in _extraction_cache.items() if expires_at <= now]:
+            del _extraction_cache[stale]
+        while len(_extraction_cache) >= EXTRACTION_CACHE_MAX_ENTRIES:
+            del _extraction_cache[next(iter(_extraction_cache))]
+    _extraction_cache[key] = (time.monotonic() + EXTRACTION_CACHE_TTL_SECONDS, result)
+
+
+async def _extract_with_fallback(file_bytes: bytes, filename: str) -> dict:
+    # Try remote first, unless it has been failing (breaker open)
+    if EXTRACT_ENDPOINT and not hf_breaker.allow():
+        logger.warning("HF Space circuit open — skipping remote extraction")
+    elif EXTRACT_ENDPOINT:
         logger.info("Attempting remote extraction via HF Space")
         result = await extract_from_hf_space(file_bytes, filename)
         if result.get("success"):
@@ -117,13 +307,15 @@ async def extract_from_bytes_with_fallback(file_bytes: bytes, filename: str) ->
     # Fallback to local
     logger.info("Falling back to local extraction")
     try:
-        local_extractor = _get_local_extractor()
+        # Model load (if not warmed at startup) and inference both block,
+        # so keep them off the event loop, one extraction at a time
+        local_extractor = await _run_local(_get_local_extractor)
         if local_extractor:
-            return local_extractor.extract_from_bytes(file_bytes, filename)
+            return await _run_local(local_extractor.extract_from_bytes, file_bytes, filename)
         else:
             return {"success": False, "error": "No extraction service available"}
     except Exception as e:
-        logger.error("Local extraction fallback failed", error=str(e))
+        logger.error("Local extraction fallback failed", error=str(e)[:LOG_BODY_LIMIT])
         return {"success": False, "error": str(e)}
 
 
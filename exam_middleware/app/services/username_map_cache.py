@@ -0,0 +1,66 @@
+"""
+Username Map Cache
+In-process copy of the register number → Moodle username mapping table,
+reloaded with one SELECT every few minutes and dropped on admin writes.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import StudentUsernameRegister
+
+logger = logging.getLogger(__name__)
+
+USERNAME_MAP_TTL_SECONDS = 300
+
+_map: Dict[str, str] = {}
+_loaded_at: Optional[float] = None
+# Bumped on every invalidation; a reload that was in flight across one may
+# have read the old table, so it isn't marked fresh
+_generation = 0
+_refresh_lock = asyncio.Lock()
+
+
+async def resolve(register_number: str, db: AsyncSession) -> Optional[str]:
+    """Return the Moodle username mapped to a register number, if any."""
+    await _ensure_fresh(db)
+    return _map.get(register_number)
+
+
+async def resolve_many(register_numbers: Iterable[str], db: AsyncSession) -> Dict[str, str]:
+    """Return {register_number: moodle_username} for the mapped register numbers."""
+    await _ensure_fresh(db)
+    return {reg_no: _map[reg_no] for reg_no in register_numbers if reg_no in _map}
+
+
+def invalidate() -> None:
+    """Force a reload on next use (call after the mapping table changes)."""
+    global _loaded_at, _generation
+    _generation += 1
+    _loaded_at = None
+
+
+def _is_fresh() -> bool:
+    return _loaded_at is not None and time.monotonic() - _loaded_at < USERNAME_MAP_TTL_SECONDS
+
+
+async def _ensure_fresh(db: AsyncSession) -> None:
+    global _map, _loaded_at
+    if _is_fresh():
+        return
+    async with _refresh_lock:
+        if _is_fresh():
+            return
+        generation = _generation
+        result = await db.execute(
+            select(StudentUsernameRegister.register_number, StudentUsernameRegister.moodle_username)
+        )
+        _map = {reg_no: username for reg_no, username in result.all()}
+        if generation == _generation:
+            _loaded_at = time.monotonic()
+        logger.debug("Loaded %d username mappings", len(_map))
@@ -0,0 +1,47 @@
+"""
+YOLO TensorRT Export Script
+===========================
+Builds INT8 TensorRT engines for the local extraction YOLO models.
+Run once on the GPU host that will serve extraction (engines are tied to
+the GPU model and TensorRT version):
+
+    python export_yolo_engine.py --data calibration.yaml
+
+`calibration.yaml` is an Ultralytics dataset file whose images are a few
+hundred real scanned answer sheets; TensorRT uses them to calibrate INT8
+ranges. The engines are written next to the .pt weights
+(models/improved_weights.engine, models/weights.engine) and picked up
+automatically by the extraction service and the Streamlit demo
+(models/answer_sheet_streamlit.py) when CUDA is available.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.services.extraction_service import PRIMARY_YOLO_WEIGHTS, FALLBACK_YOLO_WEIGHTS
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export YOLO weights to TensorRT INT8 engines")
+    parser.add_argument("--data", required=True, help="Ultralytics dataset YAML with calibration images")
+    parser.add_argument("--workspace", type=int, default=4, help="TensorRT workspace size (GiB)")
+    args = parser.parse_args()
+
+    from ultralytics import YOLO
+
+    for weights in (PRIMARY_YOLO_WEIGHTS, FALLBACK_YOLO_WEIGHTS):
+        if not weights.exists():
+            print(f"- Skipping {weights.name} (not found)")
+            continue
+        print(f"Exporting {weights.name} ...")
+        engine_path = YOLO(str(weights)).export(
+            format="engine", int8=True, data=args.data, workspace=args.workspace
+        )
+        print(f"✓ {engine_path}")
+
+
+if __name__ == "__main__":
+    main()
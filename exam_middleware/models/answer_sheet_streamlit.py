@@ -1,14 +1,15 @@
 import streamlit as st
+import contextlib
+import hashlib
 import os
+import pickle
 import torch
 import cv2
 import numpy as np
 from ultralytics import YOLO
-from PIL import Image
-from torchvision import transforms
 import torch.nn as nn
-from pdf2image import convert_from_path, pdfinfo_from_path # Import pdf2image
-import tempfile # Import tempfile for creating temporary files
+import torch.nn.functional as F
+from concurrent.futures import ThreadPoolExecutor
 
 # Define the CRNN model class (remains the same)
 class CRNN(nn.Module):
@@ -56,102 +57,188 @@ class CRNN(nn.Module):
         x = self.fc(x)
         return x
 
+# YOLO input size; pages are shrunk to this before detection
+YOLO_IMGSZ = 640
+
+# PDF render resolution: A4 comes out ~1240x1750 px, about twice the YOLO
+# input and still well above the 32 px tall CRNN inputs the crops become
+PDF_DPI = 150
+
+def render_pdf_first_page(pdf, dpi=PDF_DPI):
+    """
+    Render page 1 of a PDF (file path or raw bytes) to a BGR uint8 array.
+    Uses PyMuPDF (in-process) when installed, otherwise pdf2image/Poppler.
+    Returns None for an empty PDF.
+    """
+    try:
+        import fitz
+    except ImportError:
+        from pdf2image import convert_from_bytes, convert_from_path
+        convert = convert_from_bytes if isinstance(pdf, bytes) else convert_from_path
+        images = convert(pdf, dpi=dpi, first_page=1, last_page=1)
+        if not images:
+            return None
+        return cv2.cvtColor(np.asarray(images[0].convert('RGB')), cv2.COLOR_RGB2BGR)
+
+    doc = fitz.open(stream=pdf, filetype="pdf") if isinstance(pdf, bytes) else fitz.open(pdf)
+    with doc:
+        if doc.page_count == 0:
+            return None
+        pix = doc.load_page(0).get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+        rgb = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+def quantize_crnn(model):
+    """Dynamically quantize a CPU CRNN's LSTM and Linear layers to INT8."""
+    try:
+        return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    except Exception as e:
+        # No quantized engine on this CPU/build: keep FP32
+        st.warning(f"CRNN quantization unavailable, using FP32: {e}")
+        return model
+
+def decode_image(image_bytes):
+    """Decode PNG/JPEG bytes to a BGR uint8 array (None if undecodable)."""
+    return cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def yolo_weights(pt_path):
+    """
+    Prefer a TensorRT engine exported next to the .pt weights
+    (see export_yolo_engine.py) when CUDA is available.
+    """
+    engine_path = os.path.splitext(pt_path)[0] + ".engine"
+    if torch.cuda.is_available() and os.path.exists(engine_path):
+        return engine_path
+    return pt_path
+
 # Define the AnswerSheetExtractor class (remains mostly the same, detection logic updated)
 class AnswerSheetExtractor:
     def __init__(self, primary_yolo_weights_path, fallback_yolo_weights_path, register_crnn_model_path, subject_crnn_model_path):
-        # Ensure directories exist
-        os.makedirs("cropped_register_numbers", exist_ok=True)
-        os.makedirs("cropped_subject_codes", exist_ok=True)
-        os.makedirs("results", exist_ok=True)
-
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if self.device.type == 'cuda':
+            # CRNN inputs have fixed sizes, so cuDNN's per-shape algorithm
+            # search runs once (during warm_up) and is reused
+            torch.backends.cudnn.benchmark = True
+
+        # Side stream for CRNN work, so both CRNNs are queued before any sync
+        self.crnn_stream = torch.cuda.Stream() if self.device.type == 'cuda' else None
+
+        # Side stream/thread so the fallback YOLO runs alongside the primary
+        if self.device.type == 'cuda':
+            self.fallback_stream = torch.cuda.Stream()
+            self.fallback_executor = ThreadPoolExecutor(max_workers=1)
+        else:
+            self.fallback_executor = None
 
         # Load both YOLO models
-        self.primary_yolo_model = YOLO(primary_yolo_weights_path)
-        self.fallback_yolo_model = YOLO(fallback_yolo_weights_path) # Load the second model
-
-        # Load Register Number CRNN model
-        self.register_crnn_model = CRNN(num_classes=11)  # 10 digits + blank
-        self.register_crnn_model.to(self.device)
-        checkpoint = torch.load(register_crnn_model_path, map_location=self.device)
-        # Handle potential 'module.' prefix if model was trained with DataParallel
+        self.primary_yolo_model = YOLO(yolo_weights(primary_yolo_weights_path))
+        self.fallback_yolo_model = YOLO(yolo_weights(fallback_yolo_weights_path)) # Load the second model
+
+        # Load the CRNN models
+        self.register_crnn_model = self.load_crnn(register_crnn_model_path, num_classes=11)  # 10 digits + blank
+        self.subject_crnn_model = self.load_crnn(subject_crnn_model_path, num_classes=37)  # blank + 0-9 + A-Z
+
+        # Run the CRNNs in FP16 on GPU (half the memory traffic, tensor cores)
+        self.dtype = torch.float16 if self.device.type == 'cuda' else torch.float32
+        self.register_crnn_model.to(self.dtype)
+        self.subject_crnn_model.to(self.dtype)
+        if self.device.type == 'cpu':
+            # INT8 weights for the LSTM/Linear layers, which dominate CPU time
+            self.register_crnn_model = quantize_crnn(self.register_crnn_model)
+            self.subject_crnn_model = quantize_crnn(self.subject_crnn_model)
+
+        # CRNN input sizes (height, width)
+        self.register_size = (32, 256)
+        self.subject_size = (32, 128)
+
+        # Class id -> character lookup tables: blank (0) -> '', then 0-9 (and A-Z)
+        digits = [str(i) for i in range(10)]
+        self.register_lut = np.array([''] + digits)
+        self.subject_lut = np.array([''] + digits + [chr(ord('A') + i) for i in range(26)])
+
+        self.warm_up()
+
+    def load_crnn(self, path, num_classes):
+        """Build a CRNN on the device and load its checkpoint in eval mode."""
+        try:
+            # Tensors-only unpickling: faster, and safe for untrusted files
+            checkpoint = torch.load(path, map_location=self.device, weights_only=True)
+        except pickle.UnpicklingError:
+            # Checkpoint also pickles non-tensor training state
+            checkpoint = torch.load(path, map_location=self.device, weights_only=False)
         state_dict = checkpoint.get('model_state_dict', checkpoint) # Handle if state_dict was saved directly
-        new_state_dict = {}
-        for k, v in state_dict.items():
-            if k.startswith('module.'):
-                new_state_dict[k[7:]] = v # remove 'module.' prefix
-            else:
-                new_state_dict[k] = v
-        self.register_crnn_model.load_state_dict(new_state_dict)
-        self.register_crnn_model.eval()
-
-        # Load Subject Code CRNN model
-        self.subject_crnn_model = CRNN(num_classes=37)  # blank + 0-9 + A-Z
-        self.subject_crnn_model.to(self.device)
-        # Handle potential 'module.' prefix similarly for subject model
-        subject_checkpoint = torch.load(subject_crnn_model_path, map_location=self.device)
-        subject_state_dict = subject_checkpoint.get('model_state_dict', subject_checkpoint) # Handle if state_dict was saved directly
-        new_subject_state_dict = {}
-        for k, v in subject_state_dict.items():
-             if k.startswith('module.'):
-                 new_subject_state_dict[k[7:]] = v # remove 'module.' prefix
-             else:
-                 new_subject_state_dict[k] = v
-        self.subject_crnn_model.load_state_dict(new_subject_state_dict)
-        self.subject_crnn_model.eval()
-
-        # Define image transforms
-        self.register_transform = transforms.Compose([
-            transforms.Resize((32, 256)),
-            transforms.ToTensor(),
-            transforms.Normalize((0.5,), (0.5,))
-        ])
-        self.subject_transform = transforms.Compose([
-            transforms.Resize((32, 128)),
-            transforms.ToTensor(),
-            transforms.Normalize((0.5,), (0.5,))
-        ])
-
-        # Define character map for subject code
-        self.char_map = {i: str(i-1) for i in range(1, 11)} # 1-10 -> 0-9
-        self.char_map.update({i: chr(i - 11 + ord('A')) for i in range(11, 37)}) # 11-36 -> A-Z
-        self.char_map[0] = '' # Map blank (index 0) to empty string
-
-
-    def detect_regions(self, image_path):
-        image = cv2.imread(image_path)
-        if image is None:
-            raise ValueError(f"Could not load image from {image_path}")
+        model = CRNN(num_classes=num_classes).to(self.device)
+        # Strip the 'module.' prefix left by DataParallel training
+        model.load_state_dict({k.removeprefix('module.'): v for k, v in state_dict.items()})
+        return model.eval()
+
+    def warm_up(self):
+        """
+        Run each model once on dummy input so CUDA kernel selection and
+        engine setup happen while loading, not on the first user request.
+        """
+        blank_page = np.zeros((640, 640, 3), dtype=np.uint8)
+        self.run_yolo(self.primary_yolo_model, blank_page)
+        self.run_yolo(self.fallback_yolo_model, blank_page)
+        with torch.inference_mode():
+            self.register_crnn_model(torch.zeros(1, 1, *self.register_size, device=self.device, dtype=self.dtype))
+            self.subject_crnn_model(torch.zeros(1, 1, *self.subject_size, device=self.device, dtype=self.dtype))
+
+    def run_yolo(self, model, image):
+        """
+        Run a YOLO model on a copy of the page shrunk to YOLO_IMGSZ, so only
+        the small image is copied to the GPU. Returns (result, scale); divide
+        box coordinates by scale to map them onto the full-resolution page.
+        """
+        scale = min(1.0, YOLO_IMGSZ / max(image.shape[:2]))
+        if scale < 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        results = model(image, imgsz=YOLO_IMGSZ, half=self.device.type == 'cuda',
+                        device=self.device, verbose=False)
+        return results[0], scale
+
+    def start_fallback(self, image):
+        """Run the fallback YOLO on its own thread and CUDA stream; returns a Future."""
+        def run():
+            with torch.cuda.stream(self.fallback_stream):
+                return self.run_yolo(self.fallback_yolo_model, image)
+        return self.fallback_executor.submit(run)
+
+    def regions_by_label(self, result, scale, image):
+        """
+        Crop every detection above 0.5 confidence from the full-resolution
+        page, grouped by label: {label: [(crop, confidence)]} in detection
+        order. Boxes, scores and classes each come to the host in one copy.
+        """
+        boxes = result.boxes
+        # Crop from the full-resolution page to keep CRNN input quality
+        xyxy = (boxes.xyxy / scale).int().cpu().numpy()
+        confidences = boxes.conf.cpu().numpy()
+        class_ids = boxes.cls.int().cpu().numpy()
+        regions = {}
+        for (x1, y1, x2, y2), confidence, class_id in zip(xyxy, confidences, class_ids):
+            if confidence > 0.5:
+                label = result.names[int(class_id)]
+                regions.setdefault(label, []).append((image[y1:y2, x1:x2], float(confidence)))
+        return regions
+
+    def detect_regions(self, image):
+        """Detect regions on a BGR page array."""
 
         # --- Step 1: Run Primary YOLO Model ---
         st.info("Running primary YOLO model...")
-        results_primary = self.primary_yolo_model(image)
-        detections_primary = results_primary[0].boxes
-        classes_primary = results_primary[0].names
-
-        register_regions = []
-        subject_regions_primary = [] # Keep primary subject detections separate initially
-
-        # Process primary detections
-        for i, box in enumerate(detections_primary):
-            x1, y1, x2, y2 = map(int, box.xyxy[0])
-            confidence = float(box.conf[0])
-            class_id = int(box.cls[0])
-            label = classes_primary[class_id]
-            cropped_region = image[y1:y2, x1:x2]
-
-            # Keep all register number detections from primary
-            if label == "RegisterNumber" and confidence > 0.5:
-                # Use a distinct name for primary detections
-                save_path = f"cropped_register_numbers/register_number_primary_{i}.jpg"
-                cv2.imwrite(save_path, cropped_region)
-                register_regions.append((save_path, confidence))
-            # Temporarily store subject detections from primary
-            elif label == "SubjectCode" and confidence > 0.5:
-                 # Use a distinct name for primary detections
-                 save_path = f"cropped_subject_codes/subject_code_primary_{i}.jpg"
-                 cv2.imwrite(save_path, cropped_region)
-                 subject_regions_primary.append((save_path, confidence))
+        # On CUDA both detectors run at once, so a page that needs the fallback
+        # costs max(primary, fallback) rather than the sum; the fallback result
+        # is simply dropped when the primary finds a Subject Code. On CPU they
+        # would compete for the same cores, so the fallback stays on demand.
+        speculative_fallback = self.start_fallback(image) if self.fallback_executor is not None else None
+        results_primary, scale = self.run_yolo(self.primary_yolo_model, image)
+        regions_primary = self.regions_by_label(results_primary, scale, image)
+
+        # Keep all register number detections from primary
+        register_regions = regions_primary.get("RegisterNumber", [])
+        # Keep primary subject detections separate initially
+        subject_regions_primary = regions_primary.get("SubjectCode", [])
 
 
         # --- Step 2: Check if Primary found SubjectCode and run fallback if necessary ---
@@ -159,24 +246,15 @@ class AnswerSheetExtractor:
 
         if not final_subject_regions: # If primary model found NO subject codes
             st.warning("Primary model did not detect Subject Code. Running fallback YOLO model...")
-            results_fallback = self.fallback_yolo_model(image)
-            detections_fallback = results_fallback[0].boxes
-            classes_fallback = results_fallback[0].names # Should be same classes as primary
-
-            subject_regions_fallback = []
-            # Process fallback detections, but only look for SubjectCode
-            for i, box in enumerate(detections_fallback):
-                x1, y1, x2, y2 = map(int, box.xyxy[0])
-                confidence = float(box.conf[0])
-                class_id = int(box.cls[0])
-                label = classes_fallback[class_id]
-                cropped_region = image[y1:y2, x1:x2]
-
-                if label == "SubjectCode" and confidence > 0.5:
-                    # Use a distinct name for fallback detections
-                    save_path = f"cropped_subject_codes/subject_code_fallback_{i}.jpg"
-                    cv2.imwrite(save_path, cropped_region)
-                    subject_regions_fallback.append((save_path, confidence))
+            if speculative_fallback is not None:
+                results_fallback, scale = speculative_fallback.result()
+                # The boxes were produced on the fallback stream; order the
+                # reads below after that work
+                torch.cuda.current_stream().wait_stream(self.fallback_stream)
+            else:
+                results_fallback, scale = self.run_yolo(self.fallback_yolo_model, image)
+            # Only SubjectCode is taken from the fallback detections
+            subject_regions_fallback = self.regions_by_label(results_fallback, scale, image).get("SubjectCode", [])
 
             # Replace final subject regions with fallback results
             final_subject_regions = subject_regions_fallback
@@ -192,89 +270,157 @@ class AnswerSheetExtractor:
         # and the subject regions (either from primary or fallback)
         return register_regions, final_subject_regions
 
-    # Keep extract_register_number method as is
-    def extract_register_number(self, image_path):
+    def preprocess(self, crops, size):
+        """
+        Grayscale BGR crops on the CPU, then resize and normalize them to
+        [-1, 1] on the device. Returns a (N, 1, H, W) batch.
+        """
+        images = []
+        for crop in crops:
+            gray = torch.from_numpy(cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY))
+            # Crops are a few KB; a plain pageable copy is cheaper than
+            # pinning a fresh host buffer for each one
+            gray = gray.to(self.device).float()[None, None]
+            # antialias matches PIL's Resize when shrinking large crops
+            images.append(F.interpolate(gray, size=size, mode='bilinear', align_corners=False, antialias=True))
+        # ToTensor + Normalize(0.5, 0.5) is x / 255 * 2 - 1; apply it in place
+        return torch.cat(images).mul_(2.0 / 255.0).sub_(1.0).to(self.dtype)
+
+    def launch_crnn(self, model, size, crops, score=False):
+        """
+        Queue preprocessing, one batched forward pass and the greedy CTC
+        collapse for all BGR crops (on the CRNN stream on CUDA) without
+        waiting for the results. Pass the returned job to finish_crnn.
+        """
+        stream = torch.cuda.stream(self.crnn_stream) if self.crnn_stream is not None else contextlib.nullcontext()
+        confidences = None
+        with stream, torch.inference_mode():
+            batch = self.preprocess(crops, size)
+            output = model(batch).float()  # (T, N, C)
+            # argmax of the logits equals argmax of their softmax
+            best, seq = output.max(2)
+            if score:
+                # Probability of the best class without materializing the softmax
+                confidences = (best - output.logsumexp(2)).exp().mean(0)
+            seq = seq.t()  # (N, T)
+            # Keep a step if it is not blank (0) and differs from the step before
+            keep = seq != 0
+            keep[:, 1:] &= seq[:, 1:] != seq[:, :-1]
+        return seq, keep, confidences
+
+    def finish_crnn(self, job):
+        """
+        Wait for a launched CRNN job. Returns, per crop, the non-blank class
+        ids left after collapsing repeats, and the mean confidences (N,) when
+        it was launched with score=True (otherwise None).
+        """
+        seq, keep, confidences = job
+        if self.crnn_stream is not None:
+            self.crnn_stream.synchronize()
+        seq, keep = seq.cpu().numpy(), keep.cpu().numpy()
+        if confidences is not None:
+            confidences = confidences.cpu().numpy()
+        return [row[mask] for row, mask in zip(seq, keep)], confidences
+
+    def launch_register_numbers(self, crops):
+        # Confidence is only needed to choose between several candidates
+        return self.launch_crnn(self.register_crnn_model, self.register_size, crops, score=len(crops) > 1)
+
+    def launch_subject_codes(self, crops):
+        return self.launch_crnn(self.subject_crnn_model, self.subject_size, crops)
+
+    def extract_register_numbers(self, crops, job=None):
+        """
+        Decode every register number crop; returns [(text, confidence)].
+        job is the launch_register_numbers job for these crops, if already queued.
+        """
         try:
-            image = Image.open(image_path).convert('L')
-            image_tensor = self.register_transform(image).unsqueeze(0).to(self.device)
-            with torch.no_grad():
-                output = self.register_crnn_model(image_tensor).squeeze(1)
-                output = output.softmax(1).argmax(1)
-                seq = output.cpu().numpy()
-                prev = -1 # CTC decoding requires tracking previous character
-                result = []
-                for s in seq:
-                    if s != 0 and s != prev: # s != 0 is blank token (index 0 for digits usually)
-                        result.append(s - 1) # Map 1-10 to 0-9
-                    prev = s
-            return ''.join(map(str, result))
+            decoded, confidences = self.finish_crnn(job or self.launch_register_numbers(crops))
+            texts = [''.join(self.register_lut[ids]) for ids in decoded]
+            confidences = confidences.tolist() if confidences is not None else [1.0] * len(texts)
+            return list(zip(texts, confidences))
         except Exception as e:
-            st.error(f"Error extracting register number from {image_path}: {e}")
-            return "EXTRACTION ERROR"
-
-    # Keep extract_subject_code method as is
-    def extract_subject_code(self, image_path):
+            st.error(f"Error extracting register number: {e}")
+            return [("EXTRACTION ERROR", 0.0)]
+
+    def extract_subject_codes(self, crops, job=None):
+        """
+        Decode every subject code crop; returns [text].
+        job is the launch_subject_codes job for these crops, if already queued.
+        """
         try:
-            image = Image.open(image_path).convert('L')
-            image_tensor = self.subject_transform(image).unsqueeze(0).to(self.device)
-            with torch.no_grad():
-                output = self.subject_crnn_model(image_tensor).squeeze(1)
-                output = output.softmax(1).argmax(1)
-                seq = output.cpu().numpy()
-                prev = 0 # Blank token index is 0 for subject code mapping
-                result = []
-                for s in seq:
-                    if s != 0 and s != prev: # s != 0 checks for blank token (index 0)
-                         # Map index to character using self.char_map
-                         result.append(self.char_map.get(s, ''))
-                    prev = s
-            return ''.join(result)
+            decoded, _ = self.finish_crnn(job or self.launch_subject_codes(crops))
+            return [''.join(self.subject_lut[ids]) for ids in decoded]
         except Exception as e:
-            st.error(f"Error extracting subject code from {image_path}: {e}")
-            return "EXTRACTION ERROR"
+            st.error(f"Error extracting subject code: {e}")
+            return ["EXTRACTION ERROR"]
 
-    # process_answer_sheet method remains the same, it takes an image path
+    # process_answer_sheet takes an image path or an already-decoded BGR array
     # The PDF to image conversion happens before calling this method in main()
-    def process_answer_sheet(self, image_path):
+    def process_answer_sheet(self, image):
+        if isinstance(image, str):
+            image_path = image
+            image = cv2.imread(image_path)
+            if image is None:
+                raise ValueError(f"Could not load image from {image_path}")
         # detect_regions now handles the fallback logic internally for subject code
-        register_regions, subject_regions = self.detect_regions(image_path)
+        register_regions, subject_regions = self.detect_regions(image)
         results = []
-        register_cropped_path = None
-        subject_cropped_path = None # Initialize to None
-
-        # Select the best Register Number region (highest confidence)
-        if register_regions:
-            best_region = max(register_regions, key=lambda x: x[1])
-            register_cropped_path = best_region[0]
-            st.info(f"Extracting Register Number from: {register_cropped_path}")
-            register_number = self.extract_register_number(register_cropped_path)
-            results.append(("Register Number", register_number))
-        else:
-             st.warning("No Register Number region detected.")
+        register_crop = None
+        subject_crop = None # Initialize to None
 
+        register_crops = [crop for crop, _ in register_regions]
+        if not register_crops:
+             st.warning("No Register Number region detected.")
 
         # Select the Subject Code region based on the new rule
-        if subject_regions: # Only proceed if at least one subject region was found
-            if len(subject_regions) >= 2:
-                # Select the SECOND detected region (index 1)
-                # Ensure index 1 exists before accessing
-                best_subject = subject_regions[1] if len(subject_regions) > 1 else subject_regions[0]
-                subject_cropped_path = best_subject[0]
-                st.info(f"Multiple Subject Code regions detected ({len(subject_regions)}). Selecting the second one: {subject_cropped_path}")
-            else: # len(subject_regions) == 1
-                # Select the only detected region (index 0)
-                best_subject = subject_regions[0]
-                subject_cropped_path = best_subject[0]
-                st.info(f"One Subject Code region detected. Selecting it: {subject_cropped_path}")
-
-            # Now extract the subject code from the selected region
-            subject_code = self.extract_subject_code(subject_cropped_path)
-            results.append(("Subject Code", subject_code))
+        if len(subject_regions) >= 2:
+            # Select the SECOND detected region (index 1)
+            subject_crop = subject_regions[1][0]
+            st.info(f"Multiple Subject Code regions detected ({len(subject_regions)}). Selecting the second one.")
+        elif subject_regions: # len(subject_regions) == 1
+            # Select the only detected region (index 0)
+            subject_crop = subject_regions[0][0]
+            st.info("One Subject Code region detected. Selecting it.")
         else:
             st.warning("No Subject Code region detected.")
 
+        # Queue both CRNNs before reading either back, so the subject crop is
+        # prepared while the register batch runs on the GPU. A failed launch
+        # leaves its job empty; extract_* then retries and reports the error.
+        register_job = subject_job = None
+        try:
+            if register_crops:
+                register_job = self.launch_register_numbers(register_crops)
+            if subject_crop is not None:
+                subject_job = self.launch_subject_codes([subject_crop])
+        except Exception:
+            pass
+
+        # Read every Register Number candidate in one batch and keep the
+        # most confident reading
+        if register_crops:
+            st.info(f"Extracting Register Number from {len(register_crops)} region(s)")
+            readings = self.extract_register_numbers(register_crops, register_job)
+            best = max(range(len(readings)), key=lambda i: readings[i][1])
+            register_crop = register_crops[best]
+            results.append(("Register Number", readings[best][0]))
+
+        # Now extract the subject code from the selected region
+        if subject_crop is not None:
+            subject_code = self.extract_subject_codes([subject_crop], subject_job)[0]
+            results.append(("Subject Code", subject_code))
+
 
-        return results, register_cropped_path, subject_cropped_path
+        # Crops are BGR ndarrays, kept in memory rather than written to disk
+        return results, register_crop, subject_crop
+
+# Results keyed by the SHA-256 of the uploaded file, so re-clicking "Extract
+# Information" or re-uploading the same scan skips YOLO and the CRNNs.
+# Underscored arguments are not part of the cache key.
+@st.cache_data(show_spinner=False, max_entries=64)
+def process_answer_sheet_cached(image_sha256, _image, _extractor):
+    return _extractor.process_answer_sheet(_image)
 
 # Streamlit app
 def main():
@@ -310,64 +456,38 @@ def main():
     # Input source selection
     input_source = st.radio("Select Input Source", ("Upload File", "Webcam (Experimental)"))
 
-    image_to_process_path = None # This will store the path to the image file
-
-    # Create a temporary directory for uploads and processed images
-    temp_dir = "temp_uploads"
-    os.makedirs(temp_dir, exist_ok=True)
+    page_image = None # BGR ndarray of the page to process
+    page_sha256 = None # Hash of the uploaded bytes, used as the result cache key
 
     if input_source == "Upload File":
         uploaded_file = st.file_uploader("Upload Answer Sheet PDF or Image", type=["pdf", "png", "jpg", "jpeg"])
 
         if uploaded_file is not None:
-            temp_file_path = os.path.join(temp_dir, uploaded_file.name)
-
-            # Save the uploaded file
-            with open(temp_file_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-
+            file_bytes = uploaded_file.getvalue()
+            page_sha256 = hashlib.sha256(file_bytes).hexdigest()
             file_extension = uploaded_file.name.split('.')[-1].lower()
 
             if file_extension == 'pdf':
                 st.info(f"Processing uploaded PDF: {uploaded_file.name}")
                 try:
-                    # Convert the first page of the PDF to an image
-                    images_from_pdf = convert_from_path(temp_file_path, dpi=300, first_page=1, last_page=1)
-                    if images_from_pdf:
-                        first_page_image = images_from_pdf[0]
-                        # Save the converted image to a temporary file
-                        image_filename = os.path.splitext(uploaded_file.name)[0] + "_page_1.jpg"
-                        image_to_process_path = os.path.join(temp_dir, image_filename)
-                        first_page_image.save(image_to_process_path, "JPEG")
+                    # Convert the first page of the PDF to an image, in memory
+                    page_image = render_pdf_first_page(file_bytes)
+                    if page_image is not None:
                         st.success("Successfully converted first page of PDF to image.")
                     else:
                         st.error("Could not convert first page of PDF to image.")
-                        # Clean up the temporary PDF file
-                        os.remove(temp_file_path)
-
-
                 except Exception as e:
                     st.error(f"Error converting PDF to image: {e}")
                     st.exception(e)
-                    # Clean up the temporary PDF file
-                    os.remove(temp_file_path)
-
-
-                finally:
-                    # Clean up the temporary PDF file after processing attempt
-                    if os.path.exists(temp_file_path):
-                        os.remove(temp_file_path)
-
 
             elif file_extension in ['png', 'jpg', 'jpeg']:
                 st.info(f"Processing uploaded image: {uploaded_file.name}")
-                # If it's already an image, the temporary file is the one to process
-                image_to_process_path = temp_file_path
+                page_image = decode_image(file_bytes)
+                if page_image is None:
+                    st.error(f"Could not decode image: {uploaded_file.name}")
 
             else:
                 st.error(f"Unsupported file type: {file_extension}")
-                # Clean up the temporary file
-                os.remove(temp_file_path)
 
 
     elif input_source == "Webcam":
@@ -375,24 +495,24 @@ def main():
         camera_image = st.camera_input("Take a picture of the answer sheet")
 
         if camera_image is not None:
-            # Save the captured image to a temporary file
-            # Use tempfile to create a unique temporary file
-            with tempfile.NamedTemporaryFile(dir=temp_dir, suffix=".jpg", delete=False) as tmp_file:
-                tmp_file.write(camera_image.getvalue())
-                image_to_process_path = tmp_file.name
+            image_bytes = camera_image.getvalue()
+            page_sha256 = hashlib.sha256(image_bytes).hexdigest()
+            page_image = decode_image(image_bytes)
             st.success("Image captured from webcam.")
 
 
     # Process the image if one is available from either source
-    if image_to_process_path and os.path.exists(image_to_process_path):
+    if page_image is not None:
          # Display the image that will be processed
-         st.image(image_to_process_path, caption="Image to Process", use_column_width=True)
+         st.image(page_image, channels="BGR", caption="Image to Process", use_column_width=True)
 
          # Process image
          if st.button("Extract Information"):
              with st.spinner("Processing image..."):
                  try:
-                     results, register_cropped, subject_cropped = extractor.process_answer_sheet(image_to_process_path)
+                     results, register_cropped, subject_cropped = process_answer_sheet_cached(
+                         page_sha256, page_image, extractor
+                     )
                      st.success("Extraction complete")
 
                      # Display results
@@ -405,39 +525,19 @@ def main():
 
                      # Display cropped images
                      st.subheader("Detected Regions:")
-                     if register_cropped and os.path.exists(register_cropped):
-                          register_img = Image.open(register_cropped)
-                          st.image(register_img, caption="Cropped Register Number", width=250)
+                     if register_cropped is not None:
+                          st.image(register_cropped, channels="BGR", caption="Cropped Register Number", width=250)
                      else:
                           st.info("No Register Number region found to display.")
 
-                     if subject_cropped and os.path.exists(subject_cropped):
-                          subject_img = Image.open(subject_cropped)
-                          st.image(subject_img, caption="Cropped Subject Code", width=250)
+                     if subject_cropped is not None:
+                          st.image(subject_cropped, channels="BGR", caption="Cropped Subject Code", width=250)
                      else:
                           st.info("No Subject Code region found to display.")
 
                  except Exception as e:
                      st.error(f"Failed to process image: {e}")
                      st.exception(e) # Display full traceback in Streamlit logs
-                 finally:
-                     # Clean up temporary cropped images after processing
-                     for folder in ["cropped_register_numbers", "cropped_subject_codes", "results"]:
-                         if os.path.exists(folder):
-                             # Iterate over a copy of the list to avoid issues when deleting
-                             for file in list(os.listdir(folder)):
-                                 file_path = os.path.join(folder, file)
-                                 try:
-                                     os.remove(file_path)
-                                 except OSError as e:
-                                     st.warning(f"Could not remove temporary file {file_path}: {e}")
-
-                     # Clean up the temporary image file that was processed
-                     if os.path.exists(image_to_process_path):
-                         try:
-                             os.remove(image_to_process_path)
-                         except OSError as e:
-                             st.warning(f"Could not remove temporary processed image {image_to_process_path}: {e}")
 
 
     # Add a placeholder to keep the "Extract Information" button visible
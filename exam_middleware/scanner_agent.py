@@ -4,17 +4,20 @@ the Ricoh scanner. It watches a folder for new scanned files and
 automatically sends them to the server for AI extraction + upload.
 
 === SETUP ===
-1. pip install requests
+1. pip install requests watchdog
 2. Configure SETTINGS below (server URL, credentials, scan folder)
 3. Run:  python scanner_agent.py
 
 === HOW IT WORKS ===
-Scanner saves to WATCH_FOLDER → Agent detects new file → waits for
-file to finish writing → adds to QUEUE → processes ONE file at a time →
-POSTs to /extract/scan-upload → waits for server response → verifies
-artifact UUID is unique → moves original file → processes NEXT file.
-
-Each file is fully uploaded and confirmed before the next one starts.
+Scanner saves to WATCH_FOLDER → Agent is notified of the new file by the
+OS (watchdog; falls back to polling on network shares or when watchdog is
+not installed) → waits for file to finish writing → adds to QUEUE →
+up to CONCURRENT_UPLOADS files at a time: POST to /extract/scan-upload →
+wait for server response → verify artifact UUID is unique → move
+original file.
+
+While uploads are in flight the next file is already being opened and
+hashed, so a batch of scans takes roughly as long as its slowest upload.
 """
 
 import os
@@ -26,11 +29,25 @@ import hashlib
 import logging
 import argparse
 import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
 from collections import deque
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+    from watchdog.observers.polling import PollingObserver
+except ImportError:  # Agent still works without watchdog, by polling the folder
+    FileSystemEventHandler = object
+    Observer = None
+    PollingObserver = None
 
 
 def _disable_windows_quick_edit():
@@ -78,23 +95,29 @@ WATCH_FOLDER = r"C:\ScanInbox"
 # Exam type to tag files with (CIA1 or CIA2)
 DEFAULT_EXAM_TYPE = "CIA1"
 
-# How often to check for new files (seconds)
+# How often to check for new files (seconds) when the folder has to be
+# polled (network share, or watchdog not installed)
 POLL_INTERVAL = 3
 
 # Wait this long after detecting a file before processing
 # (ensures scanner has finished writing)
 FILE_STABLE_WAIT = 1
 
-# Delay between processing each file in the queue (seconds)
-# Prevents server overload and ensures DB commits complete
-QUEUE_DELAY = 3
+# How many files may be uploading to the server at the same time
+CONCURRENT_UPLOADS = 4
 
-# Maximum retries for a single file
+# Maximum retries for a single request (connection errors and 502/503/504
+# while the server wakes up), with exponential backoff. Uploads that time
+# out waiting for the response are not re-sent.
 MAX_RETRIES = 2
 
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {".pdf", ".jpg", ".jpeg", ".png", ".bmp", ".tiff"}
 
+# Filesystems that don't deliver native change notifications for writes made
+# by other machines — the watch folder is polled on these
+NETWORK_FS_TYPES = {"nfs", "nfs4", "cifs", "smbfs", "smb3", "9p", "fuse.sshfs"}
+
 # ─────────────────────────────────────────────────────────────────
 
 logging.basicConfig(
@@ -115,15 +138,82 @@ def file_sha256(file_path: Path) -> str:
     return h.hexdigest()[:16]
 
 
+def _is_network_path(path: Path) -> bool:
+    """True if path lives on a network share (SMB/NFS mapped drive or mount)."""
+    resolved = path.resolve()
+    if platform.system() == "Windows":
+        if str(resolved).startswith("\\\\"):
+            return True
+        try:
+            import ctypes
+            DRIVE_REMOTE = 4
+            return ctypes.windll.kernel32.GetDriveTypeW(resolved.anchor) == DRIVE_REMOTE  # type: ignore[attr-defined]
+        except Exception:
+            return False
+
+    # Linux: find the longest mount point containing the folder
+    try:
+        with open("/proc/mounts") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False
+    best_mount, best_type = "", ""
+    for mount_point, fs_type in mounts:
+        if resolved.is_relative_to(mount_point) and len(mount_point) > len(best_mount):
+            best_mount, best_type = mount_point, fs_type
+    return best_type in NETWORK_FS_TYPES
+
+
+class _UploadRetry(Retry):
+    """
+    Retry policy that never re-sends a POST after a read error (timeout or
+    dropped connection while waiting for the response): the server may
+    already have extracted and submitted the scan, so a resend would
+    duplicate or overwrite that submission. A 504 is the same case seen
+    through a proxy, so POSTs are only re-sent on 502/503; connect errors
+    are still retried for every method.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == "POST" and status_code == 504:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if method == "POST" and isinstance(error, (ReadTimeoutError, ProtocolError)):
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class _ScanFolderHandler(FileSystemEventHandler):
+    """Hands files that appear in the watch folder to the agent."""
+
+    def __init__(self, agent: "ScannerAgent"):
+        super().__init__()
+        self._agent = agent
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._agent._add_candidate(Path(event.src_path))
+
+    def on_moved(self, event):
+        # Scanners that write to a temporary name and rename it land here
+        if not event.is_directory:
+            self._agent._add_candidate(Path(event.dest_path))
+
+
 class ScannerAgent:
     def __init__(self, server_url: str, username: str, password: str,
-                 watch_folder: str, exam_type: str):
+                 watch_folder: str, exam_type: str,
+                 concurrent_uploads: int = CONCURRENT_UPLOADS):
         self.server_url = server_url.rstrip("/")
         self.username = username
         self.password = password
         self.watch_folder = Path(watch_folder)
         self.exam_type = exam_type
         self.auth_token = None
+        self.concurrent_uploads = max(1, concurrent_uploads)
 
         # Create subfolders
         self.processed_folder = self.watch_folder / "processed"
@@ -131,22 +221,58 @@ class ScannerAgent:
         self.processed_folder.mkdir(parents=True, exist_ok=True)
         self.failed_folder.mkdir(parents=True, exist_ok=True)
 
-        # Sequential queue — files wait here until processed one-by-one
+        # Upload queue — files wait here until a worker picks them up
         self._queue: deque[Path] = deque()
+        # New files reported by the watcher, waiting for their size to settle
+        self._candidates: set[Path] = set()
+        self._candidates_lock = threading.Lock()
+        # Set by the watcher thread whenever a candidate arrives
+        self._wake = threading.Event()
         # Track files already queued/processed (by path) to avoid duplicates
         self._seen_files: set[str] = set()
         # Track artifact UUIDs returned by server to detect overwrites
         self._uploaded_uuids: set[str] = set()
-        # Track file sizes from previous scan for stability checks
-        self._pending_sizes: dict[str, int] = {}
+        # (size, mtime) of each candidate at the previous check, for stability checks
+        self._pending_sizes: dict[str, tuple[int, float]] = {}
         # Stats
         self._stats = {"processed": 0, "failed": 0, "skipped": 0}
+        self._started = 0
+        # Guards stats and UUIDs, which upload workers update concurrently
+        self._state_lock = threading.Lock()
+        # One re-login at a time when several uploads see an expired token
+        self._login_lock = threading.Lock()
+        # Caps in-flight POSTs; the executor has one extra worker so the next
+        # file is hashed and opened while the uploads run
+        self._upload_slots = threading.BoundedSemaphore(self.concurrent_uploads)
+
+        # One session for every request: uploads reuse kept-alive TLS
+        # connections to the server instead of handshaking each time
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=max(8, self.concurrent_uploads),
+            max_retries=_UploadRetry(
+                total=MAX_RETRIES,
+                backoff_factor=2,
+                status_forcelist=(502, 503, 504),
+                # Uploads are retried too (the multipart body is already in
+                # memory), but only when the server can't have processed them
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+                raise_on_status=False,  # hand the last response back to the caller
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def login(self) -> bool:
         """Authenticate with the server and get a JWT token."""
+        with self._login_lock:
+            return self._login()
+
+    def _login(self) -> bool:
         log.info(f"Logging in to {self.server_url} as '{self.username}'...")
         try:
-            resp = requests.post(
+            resp = self.session.post(
                 f"{self.server_url}/auth/staff/login",
                 data={"username": self.username, "password": self.password},
                 timeout=30,
@@ -155,6 +281,7 @@ class ScannerAgent:
                 data = resp.json()
                 self.auth_token = data.get("access_token") or data.get("token")
                 if self.auth_token:
+                    self.session.headers["Authorization"] = f"Bearer {self.auth_token}"
                     log.info("✓ Logged in successfully")
                     return True
                 log.error(f"Login response missing token: {data}")
@@ -167,7 +294,7 @@ class ScannerAgent:
     def check_extraction_ready(self) -> bool:
         """Check if AI models are loaded on the server."""
         try:
-            resp = requests.get(f"{self.server_url}/extract/status", timeout=15)
+            resp = self.session.get(f"{self.server_url}/extract/status", timeout=15)
             data = resp.json()
             if data.get("extraction_available"):
                 log.info("✓ AI extraction models are ready on server")
@@ -179,14 +306,28 @@ class ScannerAgent:
             log.error(f"Could not check extraction status: {e}")
             return False
 
-    def process_file(self, file_path: Path, retry_count: int = 0) -> bool:
+    def _post_scan(self, file_path: Path) -> requests.Response:
+        with open(file_path, "rb") as f, self._upload_slots:
+            return self.session.post(
+                f"{self.server_url}/extract/scan-upload",
+                files={"file": (file_path.name, f, "application/octet-stream")},
+                data={"exam_type": self.exam_type},
+                timeout=180,  # generous timeout for HF Space wake-up
+            )
+
+    def process_file(self, file_path: Path) -> bool:
         """
         Send a single scanned file to the server for extraction + upload.
         Blocks until the server responds. Returns True if successful.
+
+        Connect and gateway errors are retried by the session; an expired
+        token gets one re-login and one more attempt.
         """
         file_hash = file_sha256(file_path)
-        log.info(f"── Processing [{self._stats['processed']+self._stats['failed']+1}]: "
-                 f"{file_path.name}  (hash: {file_hash})")
+        with self._state_lock:
+            self._started += 1
+            number = self._started
+        log.info(f"── Processing [{number}]: {file_path.name}  (hash: {file_hash})")
 
         if not self.auth_token:
             if not self.login():
@@ -194,20 +335,23 @@ class ScannerAgent:
                 return False
 
         try:
-            with open(file_path, "rb") as f:
-                resp = requests.post(
-                    f"{self.server_url}/extract/scan-upload",
-                    files={"file": (file_path.name, f, "application/octet-stream")},
-                    data={"exam_type": self.exam_type},
-                    headers={"Authorization": f"Bearer {self.auth_token}"},
-                    timeout=180,  # generous timeout for HF Space wake-up
-                )
+            resp = self._post_scan(file_path)
+
+            if resp.status_code == 504:
+                # Not re-sent: the server may still finish and submit this scan
+                log.error("   ✗ Gateway timed out — the server may still "
+                          "process this file; check the portal before re-scanning")
+                self._count("failed")
+                return False
 
             if resp.status_code == 401:
                 log.warning("   Token expired — re-authenticating...")
-                if self.login() and retry_count < MAX_RETRIES:
-                    return self.process_file(file_path, retry_count + 1)
-                return False
+                if not self.login():
+                    return False
+                resp = self._post_scan(file_path)
+                if resp.status_code == 401:
+                    log.error("   ✗ Still unauthorized after re-login")
+                    return False
 
             data = resp.json()
 
@@ -224,16 +368,18 @@ class ScannerAgent:
                 log.info(f"   ✓ Artifact UUID: {uuid}")
 
                 # Warn if server returned a UUID we've already seen (overwrite)
-                if uuid in self._uploaded_uuids:
+                with self._state_lock:
+                    duplicate = uuid in self._uploaded_uuids
+                    self._uploaded_uuids.add(uuid)
+                if duplicate:
                     log.warning(f"   ⚠ DUPLICATE UUID detected! Server overwrote a previous upload.")
                     log.warning(f"   ⚠ This file may have the same extracted reg+subject as another file.")
-                self._uploaded_uuids.add(uuid)
 
                 # Move to processed folder (include hash to distinguish files)
                 dest = self.processed_folder / f"{renamed}__{file_hash}__{file_path.name}"
                 shutil.move(str(file_path), str(dest))
                 log.info(f"   ✓ Moved to: processed/{dest.name}")
-                self._stats["processed"] += 1
+                self._count("processed")
                 return True
             else:
                 error = data.get("error") or data.get("detail") or str(data)
@@ -246,54 +392,69 @@ class ScannerAgent:
                     dest = self.failed_folder / f"{file_hash}__{file_path.name}"
                 shutil.move(str(file_path), str(dest))
                 log.warning(f"   Moved to: failed/{dest.name}")
-                self._stats["failed"] += 1
+                self._count("failed")
                 return False
 
-        except requests.exceptions.Timeout:
-            log.error(f"   ✗ Request timed out (server may be starting up)")
-            if retry_count < MAX_RETRIES:
-                log.info(f"   Retrying ({retry_count + 1}/{MAX_RETRIES})...")
-                time.sleep(5)
-                return self.process_file(file_path, retry_count + 1)
-            self._stats["failed"] += 1
+        except requests.exceptions.ReadTimeout:
+            # Not re-sent: the server may still finish and submit this scan
+            log.error("   ✗ No response within the timeout — the server may still "
+                      "process this file; check the portal before re-scanning")
+            self._count("failed")
+            return False
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            # Raised once the session's retries are used up
+            log.error(f"   ✗ Server unreachable (it may be starting up): {e}")
+            self._count("failed")
             return False
         except Exception as e:
             log.error(f"   ✗ Error: {e}")
-            self._stats["failed"] += 1
+            self._count("failed")
             return False
 
+    def _count(self, outcome: str):
+        with self._state_lock:
+            self._stats[outcome] += 1
+
     def _is_file_stable(self, file_path: Path) -> bool:
         """
         Non-blocking stability check.
 
         Instead of sleeping inside this method (which blocks the entire
         agent for every single file), we compare the file's current size
-        to the size recorded on the *previous* poll cycle.  If the size
-        hasn't changed and is > 0, the file is stable.  First time we
-        see a file we just record its size and return False (will be
-        picked up on the next poll, ~POLL_INTERVAL seconds later).
+        and modification time to those recorded on the *previous* check.
+        If neither has changed and the size is > 0, the file is stable.
+        The mtime catches scanners that rewrite a file in place without
+        changing its length.  First time we see a file we just record it
+        and return False (it is re-checked ~FILE_STABLE_WAIT seconds later,
+        together with every other pending file).
         """
         key = str(file_path)
         try:
-            current_size = file_path.stat().st_size
+            st = file_path.stat()
         except OSError:
             self._pending_sizes.pop(key, None)
             return False
 
-        if current_size == 0:
+        if st.st_size == 0:
             return False
 
-        prev_size = self._pending_sizes.get(key)
-        self._pending_sizes[key] = current_size
+        current = (st.st_size, st.st_mtime)
+        previous = self._pending_sizes.get(key)
+        self._pending_sizes[key] = current
 
-        if prev_size is None:
-            # First sighting — record size and wait for next poll
-            return False
+        # First sighting records the stat and waits for the next check
+        return current == previous
 
-        return current_size == prev_size
+    def _add_candidate(self, file_path: Path):
+        """Note a new file in the watch folder (called from the watcher thread)."""
+        if file_path.suffix.lower() not in ALLOWED_EXTENSIONS:
+            return
+        with self._candidates_lock:
+            self._candidates.add(file_path)
+        self._wake.set()
 
-    def _discover_new_files(self):
-        """Scan the watch folder and add new files to the queue."""
+    def _scan_folder(self):
+        """List the watch folder and note every file in it as a candidate."""
         if not self.watch_folder.exists():
             log.error(f"Watch folder does not exist: {self.watch_folder}")
             return
@@ -305,56 +466,90 @@ class ScannerAgent:
             return
 
         for entry in entries:
-            if not entry.is_file():
-                continue
-            if entry.suffix.lower() not in ALLOWED_EXTENSIONS:
-                continue
-            if str(entry) in self._seen_files:
+            if entry.is_file() and str(entry) not in self._seen_files:
+                self._add_candidate(entry)
+
+    def _discover_new_files(self):
+        """Add candidates that have finished writing to the queue."""
+        with self._candidates_lock:
+            candidates = sorted(self._candidates)
+
+        for entry in candidates:
+            if str(entry) in self._seen_files or not entry.is_file():
+                self._forget_candidate(entry)
                 continue
 
-            # Non-blocking stability check (compares size across poll cycles)
+            # Non-blocking stability check (compares size across checks)
             if not self._is_file_stable(entry):
                 log.debug(f"File still writing: {entry.name}")
                 continue
 
-            # Clean up tracking dict
-            self._pending_sizes.pop(str(entry), None)
+            self._forget_candidate(entry)
             self._seen_files.add(str(entry))
             self._queue.append(entry)
             log.info(f"   ⊕ Queued: {entry.name}  (queue size: {len(self._queue)})")
             sys.stdout.flush()
 
-    def _process_queue(self):
-        """Process files from the queue ONE AT A TIME, sequentially."""
-        while self._queue:
-            file_path = self._queue.popleft()
-
-            # Skip if file was already moved/deleted
-            if not file_path.exists():
-                log.warning(f"   Skipping (file gone): {file_path.name}")
-                self._stats["skipped"] += 1
-                continue
+    def _forget_candidate(self, file_path: Path):
+        with self._candidates_lock:
+            self._candidates.discard(file_path)
+        self._pending_sizes.pop(str(file_path), None)
+
+    def _start_observer(self):
+        """
+        Start watching the folder for new files.
 
-            # Process this file — block until complete
-            success = self.process_file(file_path)
+        Returns None when the folder has to be listed every POLL_INTERVAL
+        instead (watchdog not installed).
+        """
+        if Observer is None:
+            log.warning("watchdog is not installed — polling the folder instead "
+                        "(pip install watchdog)")
+            return None
+        if _is_network_path(self.watch_folder):
+            # inotify / ReadDirectoryChangesW miss files written by the scanner
+            # over SMB/NFS, so let watchdog diff directory snapshots
+            log.info("Watch folder is on a network share — using polling observer")
+            observer = PollingObserver(timeout=POLL_INTERVAL)
+        else:
+            observer = Observer()
+        observer.schedule(_ScanFolderHandler(self), str(self.watch_folder), recursive=False)
+        observer.start()
+        return observer
 
-            # Wait before processing next file to let server DB commit
-            if self._queue:
-                remaining = len(self._queue)
-                log.info(f"   ⏳ Waiting {QUEUE_DELAY}s before next file... "
-                         f"({remaining} remaining in queue)")
-                time.sleep(QUEUE_DELAY)
+    def _process_queue(self):
+        """Upload every queued file, CONCURRENT_UPLOADS at a time; returns when all are done."""
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.concurrent_uploads + 1,
+                                thread_name_prefix="upload") as executor:
+            while self._queue:
+                file_path = self._queue.popleft()
+
+                # Skip if file was already moved/deleted
+                if not file_path.exists():
+                    log.warning(f"   Skipping (file gone): {file_path.name}")
+                    self._count("skipped")
+                    continue
+
+                futures[executor.submit(self.process_file, file_path)] = file_path
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    # e.g. the file vanished before it could be hashed
+                    log.error(f"   ✗ {futures[future].name}: {e}")
+                    self._count("failed")
 
     def run(self):
-        """Main loop — discover files and process them sequentially."""
+        """Main loop — discover files and upload them."""
         log.info("=" * 60)
-        log.info("  Scanner Agent — Sequential Queue Pipeline")
+        log.info("  Scanner Agent — Concurrent Upload Pipeline")
         log.info("=" * 60)
         log.info(f"  Server:       {self.server_url}")
         log.info(f"  Watch folder: {self.watch_folder}")
         log.info(f"  Exam type:    {self.exam_type}")
-        log.info(f"  Poll every:   {POLL_INTERVAL}s")
-        log.info(f"  Queue delay:  {QUEUE_DELAY}s between files")
+        log.info(f"  Uploads:      {self.concurrent_uploads} at a time")
         log.info("=" * 60)
 
         # Pre-flight checks
@@ -366,19 +561,26 @@ class ScannerAgent:
             log.warning("⚠ Extraction models may not be ready yet. "
                         "Will retry when first file is processed.")
 
+        observer = self._start_observer()
+        # Pick up files that were scanned while the agent wasn't running
+        self._scan_folder()
+
         log.info(f"\nWatching '{self.watch_folder}' for new scanned files...")
-        log.info("Files will be uploaded ONE AT A TIME in sequence.")
+        log.info(f"Up to {self.concurrent_uploads} files will be uploaded at a time.")
         log.info("Press Ctrl+C to stop.\n")
         sys.stdout.flush()
 
         try:
             while True:
                 # Step 1: Discover new files and add to queue
+                self._wake.clear()
+                if observer is None:
+                    self._scan_folder()
                 self._discover_new_files()
 
-                # Step 2: Process queue sequentially (blocks until empty)
+                # Step 2: Upload the queue (blocks until empty)
                 if self._queue:
-                    log.info(f"── Queue has {len(self._queue)} file(s) — processing sequentially...")
+                    log.info(f"── Queue has {len(self._queue)} file(s) — uploading...")
                     sys.stdout.flush()
                     self._process_queue()
                     log.info(f"── Queue empty. Stats: "
@@ -387,17 +589,26 @@ class ScannerAgent:
                              f"⊘ {self._stats['skipped']} skipped")
                     sys.stdout.flush()
 
-                time.sleep(POLL_INTERVAL)
+                if observer is None:
+                    time.sleep(POLL_INTERVAL)
+                else:
+                    # Sleep until the watcher reports a file; while candidates
+                    # are still being written, re-check them every FILE_STABLE_WAIT.
+                    # The timeout also keeps Ctrl+C responsive on Windows.
+                    self._wake.wait(FILE_STABLE_WAIT if self._candidates else POLL_INTERVAL)
         except KeyboardInterrupt:
             log.info(f"\nStopped by user. Final stats: "
                      f"✓ {self._stats['processed']} processed | "
                      f"✗ {self._stats['failed']} failed | "
                      f"⊘ {self._stats['skipped']} skipped")
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+            self.session.close()
 
 
 def main():
-    global QUEUE_DELAY
-
     # ── Fix Windows terminal freeze-on-click ──
     _disable_windows_quick_edit()
 
@@ -408,18 +619,17 @@ def main():
     parser.add_argument("--folder", default=WATCH_FOLDER, help=f"Scanner output folder (default: {WATCH_FOLDER})")
     parser.add_argument("--exam-type", default=DEFAULT_EXAM_TYPE, choices=["CIA1", "CIA2"],
                         help=f"Exam type (default: {DEFAULT_EXAM_TYPE})")
-    parser.add_argument("--delay", type=int, default=QUEUE_DELAY,
-                        help=f"Seconds between processing each file (default: {QUEUE_DELAY})")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENT_UPLOADS,
+                        help=f"Files uploaded at the same time (default: {CONCURRENT_UPLOADS})")
     args = parser.parse_args()
 
-    QUEUE_DELAY = args.delay
-
     agent = ScannerAgent(
         server_url=args.server,
         username=args.username,
         password=args.password,
         watch_folder=args.folder,
         exam_type=args.exam_type,
+        concurrent_uploads=args.concurrency,
     )
     agent.run()
 
@@ -0,0 +1,23 @@
+-- Migration Script: Add Denormalized Active Report Count
+-- Target: PostgreSQL / Examination Middleware Database
+-- Purpose: Let staff list views read report counts without scanning audit_logs
+
+-- Add report_count_active column to examination_artifacts table
+-- Kept in sync by AuditService whenever a report is filed, withdrawn or resolved
+ALTER TABLE examination_artifacts ADD COLUMN IF NOT EXISTS report_count_active INTEGER NOT NULL DEFAULT 0;
+
+-- Backfill from existing audit logs: count report_issue entries that
+-- have not been withdrawn (report_deleted) or resolved (report_resolved)
+UPDATE examination_artifacts a SET report_count_active = (
+    SELECT COUNT(*) FROM audit_logs i
+    WHERE i.artifact_id = a.id
+      AND i.action = 'report_issue'
+      AND NOT EXISTS (
+          SELECT 1 FROM audit_logs c
+          WHERE c.action IN ('report_deleted', 'report_resolved')
+            AND c.target_id = i.id::text
+      )
+);
+
+-- Verification query (run after migration):
+-- SELECT COUNT(*) FROM examination_artifacts WHERE report_count_active > 0;
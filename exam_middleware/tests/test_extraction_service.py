@@ -0,0 +1,46 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from app.services.extraction_service import AnswerSheetExtractor
+
+
+class _FakeRegisterCRNN:
+    """Decodes a dark crop as "0" and a light crop as "1", slowly."""
+
+    def __call__(self, x):
+        time.sleep(0.05)
+        digit = 1 if float(x.mean()) < 0 else 2  # class 1 = "0", class 2 = "1"
+        logits = torch.full((2, 1, 11), -10.0)
+        logits[0, 0, digit] = 10.0
+        logits[1, 0, 0] = 10.0  # blank
+        return logits
+
+
+def _make_extractor():
+    extractor = object.__new__(AnswerSheetExtractor)
+    extractor.device = torch.device("cpu")
+    extractor.input_dtype = torch.float32
+    extractor.crnn_streams = None
+    extractor._inference_lock = threading.Lock()
+    extractor.register_crnn = _FakeRegisterCRNN()
+    # The "page" is the register crop itself
+    extractor._detect_regions = lambda image: ([(image, 0.9)], [])
+    return extractor
+
+
+def test_concurrent_extractions_keep_their_own_crops():
+    extractor = _make_extractor()
+    dark = np.zeros((40, 200, 3), dtype=np.uint8)
+    light = np.full((40, 200, 3), 255, dtype=np.uint8)
+    pages = [dark, light] * 4
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(extractor.extract_from_image, pages))
+
+    assert [r["register_number"] for r in results] == ["0", "1"] * 4
@@ -1,3 +1,5 @@
+import smtplib
+
 import pytest
 
 from app.core.config import settings
@@ -70,3 +72,76 @@ async def test_send_notification_success(monkeypatch):
     assert sent is True
     assert message == "Notification sent"
     assert captured["called"] is True
+
+
+@pytest.mark.asyncio
+async def test_send_bulk_notifications_share_one_smtp_session(monkeypatch):
+    monkeypatch.setattr(settings, "sendgrid_api_key", "")
+    monkeypatch.setattr(settings, "email_from_email", "")
+
+    monkeypatch.setattr(settings, "smtp_enabled", True)
+    monkeypatch.setattr(settings, "smtp_host", "smtp.example.com")
+    monkeypatch.setattr(settings, "smtp_from_email", "noreply@example.com")
+
+    batches = []
+
+    def fake_send_many(messages):
+        batches.append([m["To"] for m in messages])
+        return [(True, "Notification sent")] * len(messages)
+
+    service = MailService()
+    monkeypatch.setattr(service, "_send_messages_sync", fake_send_many)
+
+    common = dict(
+        recipient_name="Student",
+        subject_code="19AI405",
+        subject_name="Deep Learning",
+        exam_type="CIA1",
+        exam_session="2025-2026",
+        uploaded_by="staff1",
+    )
+    results = await service.send_student_upload_notifications([
+        dict(common, recipient_email="a@example.com", register_number="1", filename="1_19AI405.pdf"),
+        dict(common, recipient_email=None, register_number="2", filename="2_19AI405.pdf"),
+        dict(common, recipient_email="c@example.com", register_number="3", filename="3_19AI405.pdf"),
+    ])
+
+    assert batches == [["a@example.com", "c@example.com"]]
+    assert [sent for sent, _ in results] == [True, False, True]
+
+
+def test_smtp_session_is_reused_and_reopened_when_stale(monkeypatch):
+    opened = []
+
+    class FakeSMTP:
+        def __init__(self):
+            self.sent = []
+            self.stale = False
+
+        def noop(self):
+            if self.stale:
+                raise smtplib.SMTPServerDisconnected("gone")
+
+        def send_message(self, message):
+            self.sent.append(message["To"])
+
+        def quit(self):
+            pass
+
+    def fake_open():
+        opened.append(FakeSMTP())
+        return opened[-1]
+
+    service = MailService()
+    monkeypatch.setattr(service, "_open_smtp", fake_open)
+
+    message = service._build_smtp_message("a@example.com", "subject", "body")
+    service._send_message_sync(message)
+    service._send_message_sync(message)
+    assert len(opened) == 1
+    assert opened[0].sent == ["a@example.com", "a@example.com"]
+
+    opened[0].stale = True
+    service._send_message_sync(message)
+    assert len(opened) == 2
+    assert opened[1].sent == ["a@example.com"]
@@ -1,8 +1,12 @@
+import asyncio
 from types import SimpleNamespace
 
 import pytest
 
-from app.services.notification_service import NotificationService
+from app.services.artifact_service import invalidate_subject_mapping_cache
+from app.services import moodle_user_cache, username_map_cache
+from app.services.moodle_user_cache import get_cached_user, invalidate_cached_user
+from app.services.notification_service import NotificationService, UploadNotificationQueue
 
 
 class _ScalarResult:
@@ -12,6 +16,9 @@ class _ScalarResult:
     def scalar_one_or_none(self):
         return self._value
 
+    def one_or_none(self):
+        return self._value
+
 
 class _FakeDB:
     def __init__(self, mapping_obj):
@@ -25,7 +32,7 @@ class _FakeMoodleClient:
     def __init__(self, token=None):
         self.token = token
 
-    async def get_user_by_username(self, username):
+    async def get_user_by_username(self, username, token=None):
         return {
             "username": username,
             "email": "student@example.com",
@@ -36,6 +43,12 @@ class _FakeMoodleClient:
         return None
 
 
+def _fake_resolve(usernames):
+    async def resolve(register_number, _db):
+        return usernames.get(register_number)
+    return resolve
+
+
 @pytest.mark.asyncio
 async def test_notify_student_on_upload_skips_without_smtp(monkeypatch):
     artifact = SimpleNamespace(
@@ -79,23 +92,21 @@ async def test_notify_student_on_upload_success(monkeypatch):
         uploaded_at=None,
     )
 
-    db = _FakeDB(mapping_obj=SimpleNamespace(moodle_username="demo.user", register_number="212222240047"))
+    # Row of the subject-mapping lookup (subject_name, exam_session, assignment id, assignment name)
+    db = _FakeDB(mapping_obj=("Deep Learning", "2025-2026", 42, "CIA1 Upload"))
     service = NotificationService(db)
 
     monkeypatch.setattr("app.services.notification_service.settings.moodle_admin_token", "token-1")
     monkeypatch.setattr("app.services.notification_service.mail_service.is_configured", lambda: True)
-    monkeypatch.setattr("app.services.notification_service.MoodleClient", _FakeMoodleClient)
-
-    async def fake_get_mapping(subject_code, exam_type):
-        assert subject_code == "19AI405"
-        assert exam_type == "CIA2"
-        return SimpleNamespace(subject_name="Deep Learning", exam_session="2025-2026")
-
-    monkeypatch.setattr(service.mapping_service, "get_mapping", fake_get_mapping)
+    monkeypatch.setattr("app.services.username_map_cache.resolve", _fake_resolve({"212222240047": "demo.user"}))
+    monkeypatch.setattr("app.services.moodle_user_cache.moodle_client", _FakeMoodleClient())
+    invalidate_cached_user()
+    invalidate_subject_mapping_cache()
 
     async def fake_send_mail(**kwargs):
         assert kwargs["recipient_email"] == "student@example.com"
         assert kwargs["subject_code"] == "19AI405"
+        assert kwargs["subject_name"] == "Deep Learning"
         assert kwargs["exam_type"] == "CIA2"
         return True, "Notification sent"
 
@@ -124,6 +135,7 @@ async def test_send_test_upload_notification_returns_failure_without_mapping(mon
 
     monkeypatch.setattr("app.services.notification_service.settings.moodle_admin_token", "token-1")
     monkeypatch.setattr("app.services.notification_service.mail_service.is_configured", lambda: True)
+    monkeypatch.setattr("app.services.username_map_cache.resolve", _fake_resolve({}))
 
     result = await service.send_test_upload_notification(
         register_number="212222240047",
@@ -135,3 +147,120 @@ async def test_send_test_upload_notification_returns_failure_without_mapping(mon
 
     assert result["success"] is False
     assert "No username mapping" in result["message"]
+
+
+@pytest.mark.asyncio
+async def test_moodle_user_lookups_are_cached_and_coalesced(monkeypatch):
+    calls = []
+
+    class _CountingMoodleClient(_FakeMoodleClient):
+        async def get_user_by_username(self, username, token=None):
+            calls.append(username)
+            await asyncio.sleep(0)
+            return await super().get_user_by_username(username, token)
+
+    monkeypatch.setattr("app.services.moodle_user_cache.moodle_client", _CountingMoodleClient())
+    invalidate_cached_user()
+
+    first, second = await asyncio.gather(get_cached_user("demo.user"), get_cached_user("demo.user"))
+    third = await get_cached_user("demo.user")
+
+    assert calls == ["demo.user"]
+    assert first == second == third == {"email": "student@example.com", "fullname": "Demo Student"}
+    # Finished lookups don't leave per-username state behind
+    assert moodle_user_cache._inflight == {}
+
+    invalidate_cached_user("demo.user")
+    await get_cached_user("demo.user")
+    assert calls == ["demo.user", "demo.user"]
+
+
+@pytest.mark.asyncio
+async def test_subject_mappings_are_shared_across_services():
+    invalidate_subject_mapping_cache()
+    calls = 0
+
+    class _CountingDB(_FakeDB):
+        async def execute(self, query):
+            nonlocal calls
+            calls += 1
+            return await super().execute(query)
+
+    row = ("Deep Learning", "2025-2026", 42, "CIA1 Upload")
+    first = await NotificationService(_CountingDB(row)).mapping_service.get_mapping("19ai405", "CIA1")
+    second = await NotificationService(_CountingDB(None)).mapping_service.get_mapping("19AI405", "CIA1")
+    assert first == second and first.subject_name == "Deep Learning"
+    assert calls == 1
+
+    invalidate_subject_mapping_cache()
+    assert await NotificationService(_CountingDB(None)).mapping_service.get_mapping("19AI405", "CIA1") is None
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_subject_mapping_lookup_racing_a_commit_is_not_cached():
+    invalidate_subject_mapping_cache()
+
+    class _CommitDuringReadDB(_FakeDB):
+        async def execute(self, query):
+            # The admin write commits and invalidates while this read is in flight
+            invalidate_subject_mapping_cache()
+            return await super().execute(query)
+
+    stale = await NotificationService(_CommitDuringReadDB(None)).mapping_service.get_mapping("19AI405", "CIA1")
+    assert stale is None
+
+    row = ("Deep Learning", "2025-2026", 42, "CIA1 Upload")
+    fresh = await NotificationService(_FakeDB(row)).mapping_service.get_mapping("19AI405", "CIA1")
+    assert fresh is not None and fresh.moodle_assignment_id == 42
+
+
+@pytest.mark.asyncio
+async def test_username_map_reload_racing_a_commit_is_not_marked_fresh():
+    username_map_cache.invalidate()
+
+    class _RowsResult:
+        def __init__(self, rows):
+            self._rows = rows
+
+        def all(self):
+            return self._rows
+
+    class _MapDB:
+        def __init__(self, rows, on_execute=None):
+            self.rows = rows
+            self.on_execute = on_execute
+
+        async def execute(self, _query):
+            if self.on_execute:
+                self.on_execute()
+            return _RowsResult(self.rows)
+
+    # The admin write commits and invalidates while this reload is in flight
+    stale_db = _MapDB([("212222240047", "old.user")], on_execute=username_map_cache.invalidate)
+    assert await username_map_cache.resolve("212222240047", stale_db) == "old.user"
+
+    fresh_db = _MapDB([("212222240047", "new.user")])
+    assert await username_map_cache.resolve("212222240047", fresh_db) == "new.user"
+
+
+@pytest.mark.asyncio
+async def test_upload_notification_queue_stop_delivers_pending_batch(monkeypatch):
+    monkeypatch.setattr("app.services.notification_service.mail_service.is_configured", lambda: True)
+    queue = UploadNotificationQueue()
+    delivered = []
+
+    async def fake_deliver(batch):
+        await asyncio.sleep(0.01)
+        delivered.extend(batch)
+
+    monkeypatch.setattr(queue, "_deliver", fake_deliver)
+    queue.start()
+    for artifact_id in range(5):
+        queue.enqueue(artifact_id, "staff", None)
+    # Let the worker pull items into its batch and start the batching window
+    await asyncio.sleep(0)
+
+    await asyncio.wait_for(queue.stop(), timeout=1)
+
+    assert sorted(artifact_id for artifact_id, _, _ in delivered) == [0, 1, 2, 3, 4]